@@ -1,9 +1,11 @@
 import argparse
 import inspect
+import json
 import os
 from itertools import zip_longest
 
 from ban.core import config, context
+from ban.core.metrics import Metrics
 
 from .reporter import Reporter
 
@@ -26,7 +28,13 @@ class Command:
         'session_user': None,
         'workers': os.cpu_count(),
         'batch_executor': 'thread',
+        'chunksize': {'type': int, 'default': None},
         'verbose': {'action': 'count', 'default': None},
+        'metrics_output': None,
+        'metrics_every': {'type': int, 'default': None},
+        'report_file': None,
+        'report_sample': {'type': int, 'default': None},
+        'progress_file': None,
     }
 
     def __init__(self, command):
@@ -41,8 +49,12 @@ class Command:
 
     def __call__(self, *args, **kwargs):
         """Run command."""
-        reporter = Reporter(config.get('VERBOSE'))
+        sample = config.get('REPORT_SAMPLE') or Reporter.SAMPLE_SIZE
+        reporter = Reporter(config.get('VERBOSE'), sample=int(sample),
+                            spill=config.get('REPORT_FILE'))
         context.set('reporter', reporter)
+        metrics = Metrics(progress=config.get('PROGRESS_FILE'))
+        context.set('metrics', metrics)
         for func in self._on_before_call:
             func(self, args, kwargs)
         try:
@@ -55,6 +67,14 @@ class Command:
         finally:
             # Display reports, if any.
             print(reporter)
+            reporter.close()
+            metrics.close()
+            if metrics.has_metrics:
+                print(metrics)
+            output = config.get('METRICS_OUTPUT')
+            if output:
+                with open(output, 'w') as f:
+                    json.dump(metrics.__json__(), f, indent=2)
 
     def invoke(self, parsed):
         """Run command from command line args."""
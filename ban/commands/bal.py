@@ -1,3 +1,5 @@
+from itertools import islice
+
 import peewee
 
 from ban.commands import command, reporter
@@ -10,16 +12,19 @@ __namespace__ = 'import'
 
 
 @command
+@helpers.dry_run
 @helpers.nodiff
-def bal(path, limit=0, **kwargs):
+@helpers.lookup_cache
+def bal(path, limit=0, dry_run=False, **kwargs):
     """Import from BAL files (AITF 1.1 format)
     cf https://github.com/etalab/ban/issues/75
+
+    dry_run Validate rows and resolve their references, without writing.
     """
     # We need to support BOM.
-    rows = list(helpers.load_csv(path, encoding='utf-8-sig'))
-    if limit:
-        rows = rows[:limit]
-    helpers.batch(process_row, rows, total=len(rows))
+    reader = helpers.load_csv(path, encoding='utf-8-sig')
+    rows = islice(reader, limit) if limit else reader
+    helpers.batch(process_row, rows, progress=reader)
 
 
 @helpers.session
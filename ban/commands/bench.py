@@ -0,0 +1,500 @@
+"""
+Synthetic import datasets and benchmarks.
+
+generate writes the same synthetic territory, reproducible from its size and
+seed, in every importer format. run imports each format in a fresh database
+(the configured one, which is wiped!) and measures its throughput.
+"""
+import csv
+import json
+import multiprocessing
+import resource
+import threading
+import time
+from contextlib import ExitStack
+from pathlib import Path
+from random import Random
+
+from ban.auth.models import Session, User
+from ban.commands import command, reporter
+from ban.core import config, context
+from ban.core.models import Municipality
+from ban.core.versioning import Diff
+from ban.utils import compute_cia
+
+from . import helpers, sna
+
+__namespace__ = 'bench'
+
+# Words to build names from (latin1 only, for SNA files).
+PREFIXES = ['Saint', 'Sainte', 'Mont', 'Villers', 'Bourg', 'Fontaine',
+            'Champ', 'Val', 'Roche', 'Pont']
+SUFFIXES = ['Pierre', 'Martin', 'Anne', 'Bocage', 'Rivière', 'les-Chênes',
+            'sur-Mer', 'la-Forêt', 'des-Prés', 'le-Château']
+# (label, SNA kind)
+WAYS = [('Rue', 'RUE'), ('Avenue', 'AV'), ('Chemin', 'CHE'),
+        ('Impasse', 'IMP'), ('Allée', 'ALL'), ('Place', 'PL'),
+        ('Boulevard', 'BD'), ('Lieu-dit', 'LD')]
+NAMES = ['des Pyrénées', 'Victor Hugo', 'du Moulin', 'de la Gare',
+         'des Lilas', 'Jean Jaurès', "de l'Église", 'du Stade',
+         'des Écoles', 'Pasteur', 'du Général de Gaulle', 'des Vignes',
+         'du Lavoir', 'de la République', 'des Tilleuls']
+ORDINALS = ['bis', 'ter', 'A', 'B']
+IGN_LOCALISATIONS = ['A la plaque', 'Interpolée',
+                     'Projetée du centre parcelle']
+MUNICIPALITIES_PER_DEPARTEMENT = 999
+
+
+def make_municipality(seed, index):
+    """Municipality number `index` of the territory, only depending on the
+    seed, so it can be rebuilt without generating the whole territory."""
+    rng = Random('{}:{}'.format(seed, index))
+    departement, number = divmod(index, MUNICIPALITIES_PER_DEPARTEMENT)
+    insee = '{:02d}{:03d}'.format(departement + 1, number + 1)
+    return rng, {
+        'insee': insee,
+        'name': '{}-{}'.format(rng.choice(PREFIXES), rng.choice(SUFFIXES)),
+        'siren': '2{}000'.format(insee),
+        # Unique within the departement.
+        'postcode': '{:02d}{:03d}'.format(departement + 1,
+                                          (number + 1) * 7 % 1000),
+        'lon': rng.uniform(-4.5, 7.5),
+        'lat': rng.uniform(42.5, 50.5),
+    }
+
+
+def territory(size, seed):
+    """Yield the municipalities of a territory of `size` housenumbers, with
+    their groups and housenumbers, one municipality at a time."""
+    remaining = size
+    index = 0
+    # Territory wide counters, to build unique identifiers.
+    groups = 0
+    housenumbers = 0
+    while remaining > 0:
+        rng, municipality = make_municipality(seed, index)
+        municipality['groups'] = []
+        for position in range(1, rng.randint(2, 40)):
+            if remaining <= 0:
+                break
+            count = min(remaining, rng.randint(1, 30))
+            municipality['groups'].append(make_group(
+                rng, municipality, position, groups, housenumbers, count))
+            remaining -= count
+            groups += 1
+            housenumbers += count
+        yield municipality
+        index += 1
+
+
+def make_group(rng, municipality, position, index, first, count):
+    label, kind = rng.choice(WAYS)
+    insee = municipality['insee']
+    fantoir = '{}{:04d}'.format(insee, position)
+    lon = municipality['lon'] + rng.uniform(-0.02, 0.02)
+    lat = municipality['lat'] + rng.uniform(-0.02, 0.02)
+    housenumbers = []
+    number = 0
+    for i in range(first, first + count):
+        number += rng.choice([1, 1, 2])
+        ordinal = rng.choice(ORDINALS) if rng.random() < .1 else ''
+        housenumbers.append({
+            'number': str(number),
+            'ordinal': ordinal,
+            'cia': compute_cia(insee, fantoir[5:], str(number), ordinal),
+            'ign': 'ADRNIVX_{:016d}'.format(i),
+            'laposte': 'H{:09d}'.format(i),
+            'lon': round(lon + rng.uniform(-0.001, 0.001), 6),
+            'lat': round(lat + rng.uniform(-0.001, 0.001), 6),
+        })
+    return {
+        'name': '{} {}'.format(label, rng.choice(NAMES)),
+        'kind': 'area' if kind == 'LD' else 'way',
+        'sna_kind': kind,
+        'fantoir': fantoir,
+        'ign': 'VOIE{:020d}'.format(index),
+        'matricule': '{:08d}'.format(index),
+        'laposte': 'V{:09d}'.format(index),
+        'housenumbers': housenumbers,
+    }
+
+
+class Writer:
+    """Write the territory in one importer format, counting written rows by
+    benchmark step."""
+
+    def __init__(self, path, stack):
+        self.path = path
+        self.stack = stack
+        self.rows = {}
+
+    def open(self, name, encoding='utf-8'):
+        path = self.path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return self.stack.enter_context(path.open('w', encoding=encoding,
+                                                  newline=''))
+
+    def count(self, step, rows=1):
+        self.rows[step] = self.rows.get(step, 0) + rows
+
+
+class InitWriter(Writer):
+
+    def __init__(self, path, stack):
+        super().__init__(path, stack)
+        self.file = self.open('init.json')
+
+    def row(self, **data):
+        self.file.write(json.dumps(data) + '\n')
+        self.count('init')
+
+    def write(self, municipality):
+        insee = municipality['insee']
+        self.row(type='municipality', source='bench', insee=insee,
+                 name=municipality['name'])
+        self.row(type='postcode', source='bench',
+                 postcode=municipality['postcode'],
+                 name=municipality['name'].upper(),
+                 **{'municipality:insee': insee})
+        for group in municipality['groups']:
+            self.row(type='group', source='bench', group=group['kind'],
+                     name=group['name'], **{'municipality:insee': insee,
+                                            'group:fantoir': group['fantoir']})
+            for hn in group['housenumbers']:
+                self.row(type='housenumber', source='bench',
+                         numero=hn['number'], ordinal=hn['ordinal'],
+                         postcode=municipality['postcode'],
+                         **{'group:fantoir': group['fantoir'],
+                            'ref:ign': hn['ign'], 'poste:cea': hn['laposte']})
+                self.row(type='position', source='bench', kind='entrance',
+                         geometry={'type': 'Point',
+                                   'coordinates': [hn['lon'], hn['lat']]},
+                         **{'housenumber:cia': hn['cia']})
+
+
+class BalWriter(Writer):
+
+    HEADERS = ['cle_interop', 'uid_adresse', 'voie_nom', 'numero', 'suffixe',
+               'commune_nom', 'position', 'x', 'y', 'long', 'lat', 'source',
+               'date_der_maj']
+
+    def __init__(self, path, stack):
+        super().__init__(path, stack)
+        self.file = csv.DictWriter(self.open('bal.csv'), self.HEADERS)
+        self.file.writeheader()
+
+    def row(self, **data):
+        data.update(source='bench', date_der_maj='2016-01-01')
+        self.file.writerow(data)
+        self.count('bal')
+
+    def write(self, municipality):
+        insee = municipality['insee']
+        for group in municipality['groups']:
+            prefix = '{}_{}'.format(insee, group['fantoir'][5:])
+            self.row(cle_interop='{}_99999'.format(prefix),
+                     voie_nom=group['name'], numero='99999',
+                     commune_nom=municipality['name'])
+            for hn in group['housenumbers']:
+                key = '{}_{:0>5}'.format(prefix, hn['number'])
+                if hn['ordinal']:
+                    key += '_' + hn['ordinal']
+                self.row(cle_interop=key, voie_nom=group['name'],
+                         numero=hn['number'], suffixe=hn['ordinal'],
+                         commune_nom=municipality['name'], position='entrée',
+                         long=hn['lon'], lat=hn['lat'])
+
+
+class IgnWriter(Writer):
+
+    FILES = {
+        'ign_group': ['nom', 'id_fantoir', 'code_insee', 'identifiant_fpb',
+                      'id_poste'],
+        'ign_postcode': ['libelle', 'code_insee', 'code_post'],
+        'ign_housenumber': ['numero', 'rep', 'identifiant_fpb', 'code_post',
+                            'designation_de_l_entree', 'id', 'lat', 'lon',
+                            'type_de_localisation', 'cea'],
+    }
+
+    def __init__(self, path, stack):
+        super().__init__(path, stack)
+        self.files = {}
+        for step, headers in self.FILES.items():
+            self.files[step] = csv.DictWriter(
+                self.open('ign/{}.csv'.format(step)), headers)
+            self.files[step].writeheader()
+
+    def row(self, step, **data):
+        self.files[step].writerow(data)
+        self.count(step)
+
+    def write(self, municipality):
+        insee = municipality['insee']
+        code = municipality['postcode']
+        self.row('ign_postcode', libelle=municipality['name'].upper(),
+                 code_insee=insee, code_post=code)
+        for group in municipality['groups']:
+            self.row('ign_group', nom=group['name'],
+                     id_fantoir=group['fantoir'], code_insee=insee,
+                     identifiant_fpb=group['ign'], id_poste=group['laposte'])
+            for hn in group['housenumbers']:
+                # Pick the localisation from the (unique) ign id, to stay
+                # reproducible without a random generator.
+                localisation = IGN_LOCALISATIONS[
+                    int(hn['ign'][-1]) % len(IGN_LOCALISATIONS)]
+                self.row('ign_housenumber', numero=hn['number'],
+                         rep=hn['ordinal'], identifiant_fpb=group['ign'],
+                         code_post=code, id=hn['ign'], lat=hn['lat'],
+                         lon=hn['lon'], type_de_localisation=localisation,
+                         cea=hn['laposte'])
+
+
+def hexa(layout, width, **values):
+    """Fixed-width line of `width` chars, with `values` at the start of their
+    `layout` column."""
+    line = [' '] * width
+    for name, value in values.items():
+        start = layout.columns[name][0]
+        line[start:start + len(value)] = value
+    return ''.join(line) + '\n'
+
+
+class SnaWriter(Writer):
+
+    def __init__(self, path, stack):
+        super().__init__(path, stack)
+        self.hsv7 = self.open('sna/hsv7aaaa.ai', encoding='latin1')
+        self.hsp7 = self.open('sna/hsp7aaaa.ai', encoding='latin1')
+        self.hsw4 = self.open('sna/hsw4aaaa.ai', encoding='latin1')
+
+    def write(self, municipality):
+        insee = municipality['insee']
+        line = hexa(sna.HSP7, 126, insee=insee, cedex='M',
+                    code=municipality['postcode'])
+        # Name starts after the code in real files.
+        line = line[:94] + municipality['name'].upper()[:32].ljust(32) + '\n'
+        self.hsp7.write(line)
+        self.count('sna')
+        for group in municipality['groups']:
+            self.hsv7.write(hexa(
+                sna.HSV7, 96, kind='V', insee=insee,
+                matricule=group['matricule'],
+                name=group['name'].upper()[:32],
+                group_kind=group['sna_kind']))
+            self.hsw4.write(hexa(sna.HSW4, 33, matricule=group['matricule'],
+                                 laposte=group['laposte']))
+            self.count('sna', 2)
+            for hn in group['housenumbers']:
+                self.hsw4.write(hexa(
+                    sna.HSW4, 33, matricule=group['matricule'],
+                    number=hn['number'].rjust(4), ordinal=hn['ordinal'],
+                    laposte=hn['laposte']))
+                self.count('sna')
+
+
+class OldbanWriter(Writer):
+
+    def __init__(self, path, stack):
+        super().__init__(path, stack)
+        self.file = self.open('oldban.json')
+
+    def write(self, municipality):
+        for group in municipality['groups']:
+            housenumbers = {}
+            for hn in group['housenumbers']:
+                key = ' '.join(filter(None, [hn['number'], hn['ordinal']]))
+                housenumbers[key] = {'lon': hn['lon'], 'lat': hn['lat'],
+                                     'id': hn['ign']}
+            self.file.write(json.dumps({
+                'id': '{}_{}'.format(municipality['insee'],
+                                     group['fantoir'][5:]),
+                'name': group['name'],
+                'citycode': municipality['insee'],
+                'postcode': municipality['postcode'],
+                'type': 'locality' if group['kind'] == 'area' else 'street',
+                'housenumbers': housenumbers,
+            }) + '\n')
+            self.count('oldban')
+
+
+WRITERS = {
+    'init': InitWriter,
+    'bal': BalWriter,
+    'ign': IgnWriter,
+    'sna': SnaWriter,
+    'oldban': OldbanWriter,
+}
+
+
+@command
+def generate(path, size=1000, seed=1, formats=[], **kwargs):
+    """Generate a synthetic territory of `size` addresses, in importers
+    formats, with a manifest.json to be used by bench:run.
+
+    path    directory where to write the files
+    size    number of addresses (housenumbers)
+    seed    random seed, same size and seed give the same files
+    formats only generate those formats (init, bal, ign, sna, oldban)
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    formats = formats or list(WRITERS)
+    bar = helpers.Bar(total=size, throttle=1000)
+    municipalities = 0
+    with ExitStack() as stack:
+        writers = [WRITERS[name](path, stack) for name in formats]
+        for municipality in territory(size, seed):
+            for writer in writers:
+                writer.write(municipality)
+            municipalities += 1
+            bar(step=sum(len(g['housenumbers'])
+                         for g in municipality['groups']))
+    rows = {}
+    for writer in writers:
+        rows.update(writer.rows)
+    manifest = {'size': size, 'seed': seed, 'formats': formats,
+                'municipalities': municipalities, 'rows': rows}
+    with (path / 'manifest.json').open('w') as f:
+        json.dump(manifest, f, indent=2)
+    reporter.notice('Generated', manifest)
+
+
+class QueryCounter:
+    """Count the queries run through `database`, by this process and its
+    threads."""
+
+    def __init__(self, database):
+        self.database = database
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        execute_sql = self.database.execute_sql
+
+        def counting(*args, **kwargs):
+            with self.lock:
+                self.count += 1
+            return execute_sql(*args, **kwargs)
+        self.database.execute_sql = counting
+        return self
+
+    def __exit__(self, *args):
+        del self.database.execute_sql
+
+
+def importers(path):
+    """{format: [(step, callable running the import)]}, steps of a format
+    run in order on the same database."""
+    from .bal import bal
+    from .ign import ign_group, ign_housenumber, ign_postcode
+    from .init import init
+    from .oldban import oldban
+    return {
+        'init': [('init', lambda: init(str(path / 'init.json')))],
+        'bal': [('bal', lambda: bal(str(path / 'bal.csv')))],
+        'ign': [
+            ('ign_group',
+             lambda: ign_group(paths=[str(path / 'ign/ign_group.csv')])),
+            ('ign_postcode',
+             lambda: ign_postcode(str(path / 'ign/ign_postcode.csv'))),
+            ('ign_housenumber',
+             lambda: ign_housenumber(str(path / 'ign/ign_housenumber.csv'))),
+        ],
+        'sna': [('sna', lambda: sna.sna(str(path / 'sna'), group=True,
+                                        postcode=True, housenumber=True))],
+        'oldban': [('oldban', lambda: oldban(str(path / 'oldban.json')))],
+    }
+
+
+def reset_database(manifest, with_municipalities):
+    """Empty the database, then create a staff session and, unless the
+    format creates them itself, the territory municipalities."""
+    from .db import truncate
+    truncate(force=True)
+    user = User.create(username='bench', email='bench@example.com',
+                       is_staff=True)
+    session = Session.create(user=user)
+    if with_municipalities:
+        municipalities = []
+        for index in range(manifest['municipalities']):
+            rng, data = make_municipality(manifest['seed'], index)
+            municipalities.append(Municipality(
+                insee=data['insee'], name=data['name'], siren=data['siren'],
+                version=1, created_by=session, modified_by=session))
+        Municipality.bulk_create(municipalities)
+    return session
+
+
+def measure(func, session, conn):
+    """Run `func` in a process of its own, so peak RSS is its own, and send
+    its timings back through `conn`."""
+    context.set('session', session)
+    with QueryCounter(Diff._meta.database) as counter:
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+    # In KiB on Linux.
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Set by the command, see ban.core.metrics.
+    metrics = context.get('metrics').__json__()
+    conn.send({'duration': duration, 'queries': counter.count,
+               'peak_rss': rss * 1024, 'stages': metrics['stages'],
+               'workers': metrics['workers']})
+    conn.close()
+
+
+@command
+def run(path, formats=[], force=False, **kwargs):
+    """Import the files generated by bench:generate, each format in a
+    freshly emptied database, and report rows/s, queries per row and peak
+    memory of each import step.
+
+    Queries are counted in the importing process and its threads only: use
+    the thread batch executor to count them all.
+
+    path    directory of the generated files
+    formats only benchmark those formats (init, bal, ign, sna, oldban)
+    force   do not ask for confirmation before emptying the database
+    """
+    path = Path(path)
+    with (path / 'manifest.json').open() as f:
+        manifest = json.load(f)
+    formats = formats or manifest['formats']
+    msg = 'Database {} will be emptied. Continue?'.format(config.DB_NAME)
+    if not force and not helpers.confirm(msg, default=False):
+        helpers.abort('Aborted.')
+    steps = importers(path)
+    results = []
+    for name in formats:
+        session = reset_database(manifest, with_municipalities=name != 'init')
+        for step, func in steps[name]:
+            # Let the child process open its own connection.
+            Diff._meta.database.close()
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=measure,
+                                              args=(func, session, sender))
+            process.start()
+            # Only the child writes, recv fails instead of waiting forever if
+            # it dies.
+            sender.close()
+            try:
+                result = receiver.recv()
+            except EOFError:
+                reporter.error('Benchmark failed', step)
+                continue
+            finally:
+                process.join()
+            rows = manifest['rows'][step]
+            result.update(step=step, rows=rows,
+                          rows_per_second=rows / result['duration'],
+                          queries_per_row=result['queries'] / rows)
+            print('{step}: {rows} rows in {duration:.1f}s, '
+                  '{rows_per_second:.0f} rows/s, '
+                  '{queries_per_row:.2f} queries/row, peak RSS '
+                  '{rss:.0f} MiB'.format(rss=result['peak_rss'] / 2 ** 20,
+                                         **result))
+            reporter.notice('Benchmark', result)
+            results.append(result)
+    with (path / 'results.json').open('w') as f:
+        json.dump({'manifest': manifest, 'results': results}, f, indent=2)
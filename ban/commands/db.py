@@ -1,7 +1,15 @@
+import json
+import os
+from concurrent.futures import as_completed
+
+import peewee
+
 from ban.auth import models as amodels
 from ban.commands import command, reporter
-from ban.core import models as cmodels
+from ban.core import config, models as cmodels
+from ban.core.jobs import Job
 from ban.core.versioning import Diff, Version, IdentifierRedirect, Flag
+from ban.utils import make_diff
 
 from . import helpers
 
@@ -9,20 +17,38 @@ models = [Version, Diff, IdentifierRedirect, amodels.User, amodels.Client,
           amodels.Grant, amodels.Session, amodels.Token, cmodels.Municipality,
           cmodels.PostCode, cmodels.Group, cmodels.HouseNumber,
           cmodels.HouseNumber.ancestors.get_through_model(),
-          cmodels.Position, Flag]
+          cmodels.Position, Flag, Job]
 
 
 @command
 def create(fail_silently=False, **kwargs):
     """Create database tables.
 
-    fail_silently   Do not raise error if table already exists.
+    fail_silently   Do not raise error if table already exists, only create
+                    its missing indexes.
     """
     for model in models:
         model.create_table(fail_silently=fail_silently)
+        if fail_silently:
+            # Indexes added to the model since the table has been created.
+            create_indexes(model)
         reporter.notice('Created', model.__name__)
 
 
+def create_indexes(model):
+    """Create `model` indexes that do not exist yet, by name."""
+    database = model._meta.database
+    compiler = database.compiler()
+    table = model._meta.db_table
+    for fields, unique in model._index_data():
+        columns = [model._meta.fields[f].db_column if isinstance(f, str)
+                   else f.db_column for f in fields]
+        sql = 'CREATE {}INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+            'UNIQUE ' if unique else '', compiler.index_name(table, columns),
+            table, ', '.join('"{}"'.format(c) for c in columns))
+        database.execute_sql(sql)
+
+
 @command
 def truncate(*names, force=False, **kwargs):
     """Truncate database tables.
@@ -45,3 +71,149 @@ def truncate(*names, force=False, **kwargs):
             continue
         model.delete().execute()
         reporter.notice('Truncated', name)
+
+
+# Maps each version to the increment of the diff it will produce.
+REBUILD_TABLE = 'diff_rebuild'
+# Rebuilt diffs, until they replace the current ones.
+REBUILT_TABLE = 'diff_rebuilt'
+REBUILT_FIELDS = ('pk', 'old', 'new', 'diff', 'created_at')
+
+
+@command
+def rebuild_diffs(partition=10000, force=False, **kwargs):
+    """Rebuild diffs from versions history (eg. after a nodiff import).
+
+    partition   number of resources processed by each worker task
+    force       Do not ask for confirm.
+    """
+    if not force and not helpers.confirm('Delete and rebuild all diffs?',
+                                         default=False):
+        helpers.abort('Aborted.')
+    database = Version._meta.database
+    partitions = []
+    qs = (Version.select(Version.model_name, peewee.fn.Min(Version.model_pk),
+                         peewee.fn.Max(Version.model_pk))
+                 .group_by(Version.model_name).tuples())
+    for model_name, first, last in qs:
+        for start in range(first, last + 1, partition):
+            partitions.append((model_name, start, start + partition - 1))
+    try:
+        with database.atomic():
+            # Do not reuse already published increments.
+            offset = (Diff.select(peewee.fn.Max(Diff.pk)).order_by()
+                          .scalar() or 0)
+            drop_rebuild_tables(database)
+            database.execute_sql(
+                'CREATE UNLOGGED TABLE "{rebuild}" AS SELECT pk AS version, '
+                '%s + row_number() OVER (ORDER BY lower(period), pk) AS '
+                'increment FROM "{version}"'.format(
+                    rebuild=REBUILD_TABLE, version=Version._meta.db_table),
+                (offset, ))
+            database.execute_sql(
+                'CREATE UNIQUE INDEX ON "{}" (version)'.format(REBUILD_TABLE))
+            database.execute_sql(
+                'CREATE UNLOGGED TABLE "{}" (LIKE "{}")'.format(
+                    REBUILT_TABLE, Diff._meta.db_table))
+        pool = helpers.get_pool('process')
+        bar = helpers.Bar(total=len(partitions))
+        workers = int(config.get('WORKERS', os.cpu_count()))
+        with pool(max_workers=workers) as executor:
+            futures = [executor.submit(rebuild_partition, *p)
+                       for p in partitions]
+            for future in as_completed(futures):
+                model_name, count = future.result()
+                reporter.notice('Rebuilt diffs', (model_name, count))
+                bar()
+        # Current diffs are only replaced once all of them are rebuilt.
+        with database.atomic():
+            swap_rebuilt(database, offset)
+    finally:
+        drop_rebuild_tables(database)
+
+
+def swap_rebuilt(database, offset):
+    """Replace the current diffs with the rebuilt ones.
+
+    Diffs written since the rebuild started (their version is not in the
+    rebuild table, or they are deletions above the `offset` high-water mark)
+    are kept, with new increments following the rebuilt ones. Writers are
+    locked out meanwhile, readers are not."""
+    columns = ['"{}"'.format(Diff._meta.fields[name].db_column)
+               for name in REBUILT_FIELDS]
+    new = '"{}"'.format(Diff.new.db_column)
+    database.execute_sql('LOCK TABLE "{}" IN EXCLUSIVE MODE'.format(
+        Diff._meta.db_table))
+    database.execute_sql(
+        'INSERT INTO "{rebuilt}" ({columns}) '
+        'SELECT (SELECT COALESCE(MAX(pk), %s) FROM "{rebuilt}") '
+        '+ row_number() OVER (ORDER BY d.pk), {others} FROM "{diff}" AS d '
+        'WHERE (d.{new} IS NULL AND d.pk > %s) OR (d.{new} IS NOT NULL '
+        'AND NOT EXISTS (SELECT 1 FROM "{rebuild}" AS r '
+        'WHERE r.version = d.{new}))'.format(
+            rebuilt=REBUILT_TABLE, rebuild=REBUILD_TABLE,
+            columns=', '.join(columns), diff=Diff._meta.db_table, new=new,
+            # All but the pk.
+            others=', '.join('d.' + c for c in columns[1:])),
+        (offset, offset))
+    Diff.delete().execute()
+    database.execute_sql(
+        'INSERT INTO "{diff}" SELECT * FROM "{rebuilt}"'.format(
+            diff=Diff._meta.db_table, rebuilt=REBUILT_TABLE))
+    database.execute_sql(
+        "SELECT setval(pg_get_serial_sequence('\"{diff}\"', 'pk'), "
+        "(SELECT COALESCE(MAX(pk), 0) + 1 FROM \"{diff}\"), false)"
+        .format(diff=Diff._meta.db_table))
+
+
+def drop_rebuild_tables(database):
+    for table in (REBUILD_TABLE, REBUILT_TABLE):
+        database.execute_sql('DROP TABLE IF EXISTS "{}"'.format(table))
+
+
+def insert_rebuilt(database, rows):
+    """Insert diffs `rows` in the rebuilt diffs table, at once."""
+    fields = [Diff._meta.fields[name] for name in REBUILT_FIELDS]
+    values = '({})'.format(', '.join(['%s'] * len(fields)))
+    sql = 'INSERT INTO "{}" ({}) VALUES {}'.format(
+        REBUILT_TABLE, ', '.join('"{}"'.format(f.db_column) for f in fields),
+        ', '.join([values] * len(rows)))
+    database.execute_sql(sql, [f.db_value(row[f.name])
+                               for row in rows for f in fields])
+
+
+def rebuild_partition(model_name, start, end, insert_size=500):
+    """Rebuild diffs for versions of `model_name` resources with pk between
+    `start` and `end`."""
+    database = Version._meta.database
+    sql = ('SELECT v.pk, v.model_pk, v.raw, lower(v.period), r.increment '
+           'FROM "{version}" AS v JOIN "{rebuild}" AS r ON r.version = v.pk '
+           'WHERE v.model_name = %s AND v.model_pk BETWEEN %s AND %s '
+           'ORDER BY v.model_pk, v.sequential').format(
+               version=Version._meta.db_table, rebuild=REBUILD_TABLE)
+    count = 0
+    rows = []
+    previous_pk, previous_version, previous_data = None, None, {}
+    with database.atomic():
+        cursor = database.execute_sql(sql, (model_name, start, end))
+        for pk, model_pk, raw, lower, increment in cursor.fetchall():
+            data = json.loads(raw)
+            if model_pk != previous_pk:
+                # First version of this resource: it's a creation.
+                previous_version, previous_data = None, {}
+            rows.append({
+                'pk': increment,
+                'old': previous_version,
+                'new': pk,
+                'diff': make_diff(previous_data, data),
+                'created_at': lower
+            })
+            previous_pk, previous_version, previous_data = model_pk, pk, data
+            if len(rows) >= insert_size:
+                insert_rebuilt(database, rows)
+                count += len(rows)
+                rows = []
+        if rows:
+            insert_rebuilt(database, rows)
+            count += len(rows)
+    return model_name, count
@@ -1,20 +1,32 @@
+import bz2
 import csv
-from datetime import timedelta
+from datetime import datetime, timedelta
 import getpass
-from itertools import repeat
+import gzip
+import inspect
+import io
+import json
+import lzma
+import mmap
+from itertools import chain
 import os
 import pkgutil
 import sys
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+import time
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
 from importlib import import_module
 from pathlib import Path
 
 import decorator
+import peewee
 from progressist import ProgressBar
 
 from ban.auth.models import Session, User
-from ban.commands.reporter import Reporter
-from ban.core import context, config
+from ban.commands.reporter import Reporter, report
+from ban.core import context, config, lookups, metrics
+from ban.core.metrics import Metrics
 from ban.core.versioning import Diff
 
 
@@ -28,30 +40,283 @@ def load_commands():
         import_module(modname, package=commands.__name__)
 
 
+class CountingFile(io.RawIOBase):
+    """Raw binary file wrapper counting the bytes read from it (or skipped)."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.done = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.raw.readinto(buffer)
+        if size:
+            self.done += size
+        return size
+
+    def seekable(self):
+        return self.raw.seekable()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Skipped bytes count as done.
+        self.done = self.raw.seek(offset, whence)
+        return self.done
+
+    def tell(self):
+        return self.raw.tell()
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+# Magic bytes of the supported compression formats.
+COMPRESSIONS = [
+    (b'\x1f\x8b', lambda f: gzip.GzipFile(fileobj=f)),
+    (b'BZh', bz2.BZ2File),
+    (b'\xfd7zXZ\x00', lzma.LZMAFile),
+]
+
+
+def open_binary(path):
+    """Open `path` for reading bytes, transparently decompressing gzip, bzip2
+    and xz files, whatever their name.
+
+    Return the stream and the CountingFile of the bytes read from disk (the
+    compressed ones): close them both when done."""
+    counter = CountingFile(Path(path).open('rb', buffering=0))
+    stream = io.BufferedReader(counter)
+    head = stream.peek(max(len(magic) for magic, _ in COMPRESSIONS))
+    for magic, opener in COMPRESSIONS:
+        if head.startswith(magic):
+            stream = opener(stream)
+            break
+    return stream, counter
+
+
+class CSVReader:
+    """Lazily yield csv rows as dicts, with the dialect sniffed from the head
+    of the file.
+
+    For paths, `total` and `done` are the file size and the bytes read so
+    far, so progress can be computed without loading nor counting rows.
+    Compressed files are supported (see open_binary), progress is then
+    computed on compressed bytes."""
+
+    def __init__(self, path_or_file, encoding='utf-8'):
+        self.total = None
+        self._counter = None
+        if isinstance(path_or_file, (str, Path)):
+            path = Path(path_or_file)
+            if not path.exists():
+                abort('Path does not exist: {}'.format(path))
+            self.total = path.stat().st_size
+            stream, self._counter = open_binary(path)
+            path_or_file = io.TextIOWrapper(stream, encoding=encoding,
+                                            newline='')
+        self.file = path_or_file
+
+    @property
+    def done(self):
+        return self._counter.done if self._counter else None
+
+    def __iter__(self):
+        try:
+            extract = self.file.read(4096)
+            try:
+                dialect = csv.Sniffer().sniff(extract)
+            except csv.Error:
+                dialect = csv.unix_dialect()
+            # Do not rely on seek, complete the extract up to the end of line
+            # and chain it with the remaining lines.
+            lines = chain(io.StringIO(extract + self.file.readline(),
+                                      newline=''), self.file)
+            yield from csv.DictReader(lines, dialect=dialect)
+        finally:
+            self.file.close()
+            if self._counter:
+                self._counter.close()
+
+
 def load_csv(path_or_file, encoding='utf-8'):
-    if isinstance(path_or_file, (str, Path)):
-        path = Path(path_or_file)
-        if not path.exists():
-            abort('Path does not exist: {}'.format(path))
-        path_or_file = path.open(encoding=encoding)
-    extract = path_or_file.read(4096)
-    try:
-        dialect = csv.Sniffer().sniff(extract)
-    except csv.Error:
-        dialect = csv.unix_dialect()
-    path_or_file.seek(0)
-    content = path_or_file.read()
-    path_or_file.close()
-    return csv.DictReader(content.splitlines(), dialect=dialect)
+    return CSVReader(path_or_file, encoding=encoding)
+
+
+class LineReader:
+    """Lazily yield the formatted lines of `path` (maybe compressed, see
+    open_binary), optionally starting at byte offset `start` (the beginning of
+    a line, in uncompressed content), and stopping after `limit` lines.
+
+    `total` and `done` are the file size and the bytes read so far from disk,
+    `offset` the current position in uncompressed content, `rows` the number
+    of lines read (including the `rows` skipped by `start`), and `mark` the
+    (offset, rows) position of the beginning of the last yielded line."""
+
+    def __init__(self, path, formatter=lambda x: x, start=0, rows=0,
+                 encoding='utf-8', limit=0):
+        self.path = Path(path)
+        if not self.path.exists():
+            abort('Path does not exist: {}'.format(self.path))
+        self.formatter = formatter
+        self.encoding = encoding
+        self.total = self.path.stat().st_size
+        self.offset = start
+        self.rows = rows
+        self.mark = (start, rows)
+        self.limit = limit
+        self._counter = None
+
+    @property
+    def done(self):
+        return self._counter.done if self._counter else 0
+
+    def __iter__(self):
+        stream, self._counter = open_binary(self.path)
+        try:
+            stream.seek(self.offset)
+            for line in stream:
+                if self.limit and self.rows >= self.limit:
+                    break
+                self.mark = (self.offset, self.rows)
+                self.offset += len(line)
+                self.rows += 1
+                yield self.formatter(line.decode(self.encoding))
+        finally:
+            stream.close()
+            self._counter.close()
+
+
+class Checkpoint:
+    """Sidecar file recording how far the import of `path` went, so it can
+    be resumed.
+
+    The recorded offset is the beginning of the first row of the oldest chunk
+    not yet processed: resuming processes again the chunks that were in
+    flight, so row processing must be idempotent."""
+
+    def __init__(self, path, every=10):
+        self.path = Path('{}.checkpoint'.format(path))
+        self.every = timedelta(seconds=every)
+        self.last = None
+        self.state = {}
+        self.previous = {}
+
+    def load(self):
+        try:
+            with self.path.open() as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {}
+        # Reports of the resumed run(s), to add to the current ones.
+        self.previous = self.state.get('reports', {})
+        return self.state
+
+    def save(self, force=False, **state):
+        if context.get('dry_run'):
+            return
+        now = datetime.now()
+        if not force and self.last and now - self.last < self.every:
+            return
+        self.last = now
+        self.state.update(state)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w') as f:
+            json.dump(self.state, f)
+        # Atomic, a crash never leaves a half written checkpoint.
+        os.replace(str(tmp), str(self.path))
+
+    def track(self, reader, marks, reporter, force=False):
+        """Save the position of the first row not processed yet: the oldest
+        of the `marks` of pending chunks, or the `reader` position."""
+        offset, rows = min(marks) if marks else (reader.offset, reader.rows)
+        reports = {}
+        for totals in (self.previous, reporter.totals):
+            for label, msgs in totals.items():
+                for msg, count in msgs.items():
+                    reports.setdefault(label, {}).setdefault(msg, 0)
+                    reports[label][msg] += count
+        self.save(force=force, offset=offset, rows=rows, reports=reports)
+
+    def remove(self):
+        if context.get('dry_run'):
+            # Do not lose the checkpoint of a real run.
+            return
+        if self.path.exists():
+            self.path.unlink()
+
+
+def is_compressed(path):
+    with Path(path).open('rb') as f:
+        head = f.read(max(len(magic) for magic, _ in COMPRESSIONS))
+    return any(head.startswith(magic) for magic, _ in COMPRESSIONS)
+
+
+class ByteRange:
+    """Lines of `path` between byte offsets `start` and `end`, formatted with
+    `formatter`.
+
+    Lines are only read from the memory mapped file when iterated, so a
+    ByteRange can be sent to a process worker, which then does the reading
+    and parsing itself. Lines formatted as None are skipped (see
+    ban.commands.init.parse_kind)."""
+
+    def __init__(self, path, start, end, formatter=lambda x: x):
+        self.path = str(path)
+        self.start = start
+        self.end = end
+        self.formatter = formatter
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                data = m[self.start:self.end]
+        for line in data.splitlines():
+            if line.strip():
+                item = self.formatter(line.decode('utf-8'))
+                if item is not None:
+                    yield item
+
+
+def byte_ranges(path, size, formatter=lambda x: x):
+    """Split the (uncompressed) file `path` in ByteRanges of about `size`
+    bytes, aligned on line ends."""
+    with open(str(path), 'rb') as f:
+        total = os.fstat(f.fileno()).st_size
+        if not total:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = 0
+            while start < total:
+                end = -1
+                if start + size < total:
+                    end = m.find(b'\n', start + size - 1)
+                end = total if end == -1 else end + 1
+                yield ByteRange(path, start, end, formatter)
+                start = end
+
+
+def parse_json(line):
+    """json.loads, timed as the "parse" stage (see ban.core.metrics)."""
+    with metrics.stage('parse'):
+        return json.loads(line)
 
 
 def iter_file(path, formatter=lambda x: x):
     path = Path(path)
     if not path.exists():
         abort('Path does not exist: {}'.format(path))
-    with path.open() as f:
-        for l in f:
+    stream, counter = open_binary(path)
+    try:
+        for l in io.TextIOWrapper(stream, encoding='utf-8'):
             yield formatter(l)
+    finally:
+        stream.close()
+        counter.close()
 
 
 def abort(msg):
@@ -64,47 +329,347 @@ class Bar(ProgressBar):
                 '| ETA: {eta} | {elapsed}')
 
 
+def worker_reporters():
+    """Reporter and metrics of a worker, only used by its own thread, for
+    the whole batch (see init_worker)."""
+    # Only hold the reports of a chunk: keep all the data, for the main
+    # reporter to spill it.
+    return Reporter(config.get('VERBOSE'), sample=None), Metrics()
+
+
+def collect(func, *args, **kwargs):
+    """Run `func` with the reporter and metrics of the worker, return what
+    they collected (and forget it) to be merged in the main ones (see
+    merge)."""
+    # In thread mode, the main ones are not shared with subthreads, and in
+    # process mode, forked workers inherit a copy of their current content.
+    previous = context.get('reporter'), context.get('metrics')
+    reporters = getattr(_worker, 'reporters', None)
+    reporter, collected = reporters or worker_reporters()
+    context.set('reporter', reporter)
+    context.set('metrics', collected)
+    try:
+        func(*args, **kwargs)
+    finally:
+        context.set('reporter', previous[0])
+        context.set('metrics', previous[1])
+    # No lock nor copy: nobody else uses them, and they start over empty.
+    return reporter.flush(), collected.flush(), lookups.flush()
+
+
 def collect_report(func, *args, **kwargs):
-    # This is a process reporter instance.
+    return collect(func, *args, **kwargs)[0]
+
+
+def merge(collected):
+    """Merge the reports and metrics `collected` by a worker in the main
+    ones, once per chunk, and what it stored in its lookup cache (process
+    workers) in the main cache."""
+    reports, data, (stored, stats) = collected
     reporter = context.get('reporter')
-    if not reporter:
-        # In thread mode, reporter is not shared with subthreads.
-        reporter = Reporter(config.get('VERBOSE'))
-        context.set('reporter', reporter)
-    func(*args, **kwargs)
-    reports = reporter._reports.copy()
-    reporter.clear()
-    return reports
+    reporter.merge(reports)
+    cache = lookups.active()
+    if cache is not None:
+        cache.merge(stored, stats)
+    main = context.get('metrics')
+    if main is not None:
+        main.merge(data)
+        main.tick(reporter)
+
+
+# What workers need from the main process, set by get_pool (see init_worker).
+_worker_state = None
+_worker = threading.local()
+
+
+def worker_state():
+    session = context.get('session')
+    return {
+        'session': session.pk if session else None,
+        # Dry run sessions are not saved.
+        'user': session._data.get('user') if session else None,
+        'lookups': lookups.active(),
+        'pid': os.getpid(),
+        'dry_run': context.get('dry_run'),
+        'nodiff': context.get('nodiff'),
+    }
 
 
-def batch(func, iterable, chunksize=1000, total=None, progress=True):
+def init_worker(state):
+    """Prepare a batch worker (thread or process) before its first task: its
+    own database connection, reporter and metrics, the session of the main
+    process and its lookup tables (a process worker sends what it adds to
+    them back, see collect)."""
+    forked = os.getpid() != state['pid']
+    if forked:
+        # Whatever the main process did with its connection since get_pool,
+        # we must not use it.
+        Diff._meta.database.forget_connection()
+    Diff._meta.database.get_conn()
+    session = None
+    if state['session']:
+        session = Session.get(Session.pk == state['session'])
+    elif state['user']:
+        session = Session(user=state['user'])
+    context.set('session', session)
+    context.set('dry_run', state['dry_run'])
+    context.set('nodiff', state['nodiff'])
+    lookups.share(state['lookups'], forked)
+    _worker.reporters = worker_reporters()
+
+
+def run_in_worker(func, *args, **kwargs):
+    if not getattr(_worker, 'ready', False):
+        init_worker(_worker_state)
+        _worker.ready = True
+    return func(*args, **kwargs)
+
+
+class WorkerPool:
+    """Run init_worker in each worker before its first task.
+
+    Executors only accept an initializer from python 3.7. Process workers
+    are forked, so they inherit the worker state instead of receiving it
+    pickled, whatever the size of the lookup tables."""
+
+    def submit(self, func, *args, **kwargs):
+        return super().submit(run_in_worker, func, *args, **kwargs)
+
+
+class ThreadPool(WorkerPool, ThreadPoolExecutor):
+    pass
+
+
+class ProcessPool(WorkerPool, ProcessPoolExecutor):
+    pass
+
+
+def get_pool(executor=None):
+    """Executor class to use for batches, `executor` defaulting to the one
+    of the current command (see dry_run), then to the BATCH_EXECUTOR
+    config."""
+    global _worker_state
+    _worker_state = worker_state()
+    executor = (executor or context.get('batch_executor')
+                or config.get('BATCH_EXECUTOR'))
+    if executor == 'process':
+        # Forked workers open their own connection (see init_worker).
+        return ProcessPool
+    return ThreadPool
+
+
+def make_progress(progress, total):
+    """Return a callable to be called with the number of processed items.
+
+    progress    bool, or a reader exposing `done` and `total` bytes (see
+                CSVReader) to base progress on instead of items count
+
+    When a "progress" callable is set in context, it is given the number of
+    processed items instead of displaying a progress bar.
+    """
+    if not progress:
+        return lambda step: None
+    listener = context.get('progress')
+    if listener:
+        # Someone else (eg. a background job) tracks the processed items.
+        done = 0
+
+        def step(size):
+            nonlocal done
+            done += size
+            listener(done)
+        return step
+    if getattr(progress, 'total', None):
+        bar = Bar(total=progress.total, throttle=timedelta(seconds=1))
+        return lambda step: bar(step=0, done=progress.done)
+    bar = Bar(total=total, throttle=timedelta(seconds=1))
+    return lambda step: bar(step=step)
+
+
+def batch(func, iterable, chunksize=1000, total=None, progress=True,
+          checkpoint=None):
+    """Run `func` on each item of `iterable`, by chunks of `chunksize` items,
+    in a pool of workers.
+
+    Each chunk is processed in a single transaction (see process_chunk). At
+    most two chunks per worker are pending at a time, so the iterable is only
+    consumed as fast as workers process it. Reports and metrics are merged
+    once per chunk.
+
+    chunksize   overridden by the CHUNKSIZE config (--chunksize)
+    checkpoint  Checkpoint to track progress in, `iterable` must then be a
+                LineReader
+    """
     # This is the main reporter instance.
     reporter = context.get('reporter')
-    pool = (ProcessPoolExecutor if config.get('BATCH_EXECUTOR') == 'process'
-            else ThreadPoolExecutor)
-    bar = Bar(total=total, throttle=timedelta(seconds=1))
+    pool = get_pool()
+    bar = make_progress(progress, total)
     workers = int(config.get('WORKERS', os.cpu_count()))
-    chunk = []
-    count = 0
+    chunksize = int(config.get('CHUNKSIZE') or chunksize)
+    # {future: (chunk size, reader mark of its first item)}
+    pending = {}
 
-    def loop():
-        for reports in executor.map(collect_report, repeat(func), chunk):
-            reporter.merge(reports)
-            if progress:
-                bar()
+    def drain(futures):
+        for future in futures:
+            merge(future.result())
+            bar(pending.pop(future)[0])
+        if checkpoint:
+            marks = [mark for size, mark in pending.values()]
+            if chunk:
+                marks.append(first)
+            checkpoint.track(iterable, marks, reporter)
 
-    with pool(max_workers=workers) as executor:
+    def submit(chunk):
+        if len(pending) >= workers * 2:
+            drain(wait(pending, return_when=FIRST_COMPLETED).done)
+        future = executor.submit(collect, process_chunk, func, chunk)
+        pending[future] = (len(chunk), first)
 
+    with pool(max_workers=workers) as executor:
+        chunk = []
+        first = None
         for item in iterable:
             if not item:
                 continue
+            if checkpoint and not chunk:
+                first = iterable.mark
             chunk.append(item)
-            count += 1
-            if count % 10000 == 0:
-                loop()
+            if len(chunk) >= chunksize:
+                submit(chunk)
                 chunk = []
         if chunk:
-            loop()
+            submit(chunk)
+            chunk = []
+        drain(list(pending))
+
+
+def range_batch(func, path, formatter=parse_json, size=2 ** 20,
+                progress=True):
+    """Like batch, for a file of lines: run `func` on each formatted line of
+    `path`, in a pool of processes each one reading and parsing its own byte
+    range of about `size` bytes of the memory mapped file.
+
+    The main process only finds line ends, parsing scales with the workers
+    and progress is computed on bytes, with no need to count lines first.
+    Compressed files are not supported."""
+    pool = get_pool('process')
+    bar = make_progress(progress, Path(path).stat().st_size)
+    workers = int(config.get('WORKERS', os.cpu_count()))
+    pending = {}
+
+    def drain(futures):
+        for future in futures:
+            merge(future.result())
+            bar(pending.pop(future))
+
+    with pool(max_workers=workers) as executor:
+        for chunk in byte_ranges(path, size, formatter):
+            if len(pending) >= workers * 2:
+                drain(wait(pending, return_when=FIRST_COMPLETED).done)
+            future = executor.submit(collect, process_chunk, func, chunk)
+            pending[future] = len(chunk)
+        drain(list(pending))
+
+
+def process_chunk(func, chunk):
+    """Process `chunk` in a single transaction, with a savepoint per item so
+    a failing one does not abort the others."""
+    database = Diff._meta.database
+    dry_run = context.get('dry_run')
+    start = time.perf_counter()
+    rows = 0
+    with database.transaction() as transaction:
+        if dry_run:
+            # Make sure nothing is written, whatever func does.
+            database.execute_sql('SET TRANSACTION READ ONLY')
+        for item in chunk:
+            rows += 1
+            try:
+                with database.atomic():
+                    func(item)
+            except peewee.DatabaseError as e:
+                report('Database error', (str(e), item))
+        if dry_run:
+            transaction.rollback()
+        # The transaction is committed when leaving the block.
+        committing = time.perf_counter()
+    end = time.perf_counter()
+    metrics.record('commit', end - committing)
+    metrics.processed(rows, end - start)
+
+
+def bulk_create(model, instances, msg, detail=str):
+    """Create `instances` with model.bulk_create. If one of them breaks a
+    constraint, create them one by one, each in its own savepoint, so only the
+    failing ones are reported (`msg`, with the error and `detail` of the
+    instance) instead of rejecting them all.
+
+    Return the created instances."""
+    instances = list(instances)
+    try:
+        return model.bulk_create(instances)
+    except peewee.IntegrityError:
+        # bulk_create savepoint has been rolled back.
+        pass
+    created = []
+    for instance in instances:
+        try:
+            created.extend(model.bulk_create([instance]))
+        except peewee.IntegrityError as e:
+            report(msg, (str(e).strip(), detail(instance)))
+    return created
+
+
+def partitioned_batch(func, iterable, key, chunksize=100, total=None,
+                      progress=True, checkpoint=None):
+    """Like batch, but items sharing the same `key` value are processed in
+    order by a single worker at a time, so workers never contend on them."""
+    # This is the main reporter instance.
+    reporter = context.get('reporter')
+    pool = get_pool()
+    bar = make_progress(progress, total)
+    workers = int(config.get('WORKERS', os.cpu_count()))
+    chunksize = int(config.get('CHUNKSIZE') or chunksize)
+    # One pending chunk and at most one running task per partition.
+    chunks = [[] for i in range(workers)]
+    # Reader mark of the first item of each pending chunk.
+    firsts = [None] * workers
+    running = [None] * workers
+
+    def drain(index):
+        future, size, mark = running[index]
+        merge(future.result())
+        running[index] = None
+        bar(size)
+        if checkpoint:
+            marks = [r[2] for r in running if r]
+            marks.extend(m for c, m in zip(chunks, firsts) if c)
+            checkpoint.track(iterable, marks, reporter)
+
+    def submit(index):
+        if running[index]:
+            drain(index)
+        chunk = chunks[index]
+        future = executor.submit(collect, process_chunk, func, chunk)
+        running[index] = (future, len(chunk), firsts[index])
+        chunks[index] = []
+
+    with pool(max_workers=workers) as executor:
+        for item in iterable:
+            if not item:
+                continue
+            index = hash(key(item)) % workers
+            if checkpoint and not chunks[index]:
+                firsts[index] = iterable.mark
+            chunks[index].append(item)
+            if len(chunks[index]) >= chunksize:
+                submit(index)
+        for index in range(workers):
+            if chunks[index]:
+                submit(index)
+        for index in range(workers):
+            if running[index]:
+                drain(index)
 
 
 def prompt(text, default=None, confirmation=False, coerce=None, hidden=False):
@@ -184,19 +749,61 @@ def session(func, *args, **kwargs):
             user = qs.get()
         except User.DoesNotExist:
             abort('Admin user not found {}'.format(username or ''))
-        session = Session.create(user=user)
+        if context.get('dry_run'):
+            session = Session(user=user)
+        else:
+            session = Session.create(user=user)
         context.set('session', session)
     return func(*args, **kwargs)
 
 
 @decorator.decorator
 def nodiff(func, *args, **kwargs):
-    Diff.ACTIVE = False
-    res = func(*args, **kwargs)
-    Diff.ACTIVE = True
+    """Do not create diffs while running `func`, in the current thread only
+    (and its batch workers): other API jobs or requests still create
+    theirs."""
+    previous = context.get('nodiff')
+    context.set('nodiff', True)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        context.set('nodiff', previous)
+
+
+@decorator.decorator
+def lookup_cache(func, *args, **kwargs):
+    """Cache references lookups for the whole command, then print the cache
+    hit rates."""
+    if lookups.active():
+        return func(*args, **kwargs)
+    with lookups.activate() as cache:
+        res = func(*args, **kwargs)
+    if cache.stats:
+        print(cache)
     return res
 
 
+@decorator.decorator
+def dry_run(func, *args, **kwargs):
+    """Honour the `dry_run` argument of an import command: validate rows and
+    resolve their references at full parallelism (in a process pool), without
+    writing anything."""
+    call = inspect.signature(func).bind(*args, **kwargs)
+    if not call.arguments.get('dry_run'):
+        return func(*args, **kwargs)
+    print('Dry run: nothing will be written')
+    # Per thread, like the session: concurrent commands (eg. API jobs) are
+    # not affected.
+    previous = context.get('dry_run'), context.get('batch_executor')
+    context.set('dry_run', True)
+    context.set('batch_executor', 'process')
+    try:
+        return func(*args, **kwargs)
+    finally:
+        context.set('dry_run', previous[0])
+        context.set('batch_executor', previous[1])
+
+
 def file_len(f):
     l = sum(1 for line in f)
     f.seek(0)
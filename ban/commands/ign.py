@@ -8,15 +8,17 @@ __namespace__ = "import"
 
 
 @command
+@helpers.dry_run
 @helpers.nodiff
-def ign_group(paths=[], **kwargs):
+@helpers.lookup_cache
+def ign_group(paths=[], dry_run=False, **kwargs):
     """Import IGN street and locality CSV exports.
 
-    paths   Paths to street and locality CSV files."""
+    paths   Paths to street and locality CSV files.
+    dry_run Validate rows and resolve their references, without writing."""
     for path in paths:
         rows = helpers.load_csv(path)
-        rows = list(rows)
-        helpers.batch(process_group, rows, total=len(rows))
+        helpers.batch(process_group, rows, progress=rows)
 
 
 @helpers.session
@@ -39,14 +41,16 @@ def process_group(row):
 
 
 @command
+@helpers.dry_run
 @helpers.nodiff
-def ign_postcode(path, **kwargs):
+@helpers.lookup_cache
+def ign_postcode(path, dry_run=False, **kwargs):
     """Import from IGN postcode CSV exports.
 
-    path   Path to postcode CSV files."""
+    path   Path to postcode CSV files.
+    dry_run Validate rows and resolve their references, without writing."""
     rows = helpers.load_csv(path)
-    rows = list(rows)
-    helpers.batch(process_postcode, rows, total=len(rows))
+    helpers.batch(process_postcode, rows, progress=rows)
 
 
 @helpers.session
@@ -64,14 +68,16 @@ def process_postcode(row):
 
 
 @command
+@helpers.dry_run
 @helpers.nodiff
-def ign_housenumber(path, **kwargs):
+@helpers.lookup_cache
+def ign_housenumber(path, dry_run=False, **kwargs):
     """Import from IGN housenumbers CSV exports.
 
-    path   Path to housenumbers CSV files."""
+    path   Path to housenumbers CSV files.
+    dry_run Validate rows and resolve their references, without writing."""
     rows = helpers.load_csv(path)
-    rows = list(rows)
-    helpers.batch(process_housenumber, rows, total=len(rows))
+    helpers.batch(process_housenumber, rows, progress=rows)
 
 
 @helpers.session
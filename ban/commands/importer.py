@@ -1,5 +1,8 @@
+from functools import partial
+
 from ban.commands import command, reporter
-from ban.core import models
+from ban.core import context, models
+from ban.utils import utcnow
 
 from . import helpers
 
@@ -7,21 +10,30 @@ __namespace__ = 'import'
 
 
 @command
+@helpers.dry_run
 @helpers.nodiff
-def municipalities(path, update=False, departement=None, **kwargs):
+def municipalities(path, update=False, departement=None, upsert=False,
+                   dry_run=False, **kwargs):
     """Import municipalities from
     http://www.collectivites-locales.gouv.fr/files/files/epcicom2015.csv.
 
     update          allow to override already existing Municipality
     departement     only import this departement id
+    upsert          compare rows with the existing municipalities and only
+                    write new or changed ones, in bulk
+    dry_run         validate rows and resolve their references, without
+                    writing anything
     """
-    rows = helpers.load_csv(path, encoding='latin1')
+    reader = helpers.load_csv(path, encoding='latin1')
+    rows = reader
     if departement:
-        rows = [r for r in rows if r['dep_epci'] == str(departement)]
-    else:
-        # We can't read it twice (for counting the len), let's load it for now.
-        rows = list(rows)
-    helpers.batch(add_municipality, rows, total=len(rows))
+        rows = (r for r in reader if r['dep_epci'] == str(departement))
+    if upsert:
+        return helpers.batch(upsert_municipalities,
+                             municipality_changes(rows, update),
+                             chunksize=1, progress=reader)
+    helpers.batch(partial(add_municipality, update=update), rows,
+                  progress=reader)
 
 
 @helpers.session
@@ -44,3 +56,102 @@ def add_municipality(data, update=False):
         reporter.notice('Processed', instance)
     else:
         reporter.error('Error', validator.errors)
+
+
+def municipality_changes(rows, update=False, size=1000):
+    """Compare `rows` with a snapshot of the existing municipalities, and
+    yield chunks of (new, changed) ones, unchanged ones being skipped, as
+    changed ones unless `update`."""
+    Municipality = models.Municipality
+    query = Municipality.select(Municipality.insee, Municipality.pk,
+                                Municipality.version, Municipality.name,
+                                Municipality.siren).order_by().tuples()
+    # {insee: (pk, version, name, siren)}
+    snapshot = {insee: values for insee, *values in query}
+    seen = set()
+    new = []
+    changed = []
+    for row in rows:
+        insee = row.get('insee')
+        # Empty values are stored as NULL.
+        data = dict(insee=insee, name=row.get('nom_com'),
+                    siren=row.get('siren_com') or None)
+        if insee in seen:
+            reporter.error('Duplicate insee', insee)
+            continue
+        seen.add(insee)
+        current = snapshot.get(insee)
+        if not current:
+            new.append(data)
+        elif tuple(current[2:]) == (data['name'], data['siren']):
+            reporter.notice('Unchanged', insee)
+        elif not update:
+            reporter.warning('Existing', data['name'])
+        else:
+            changed.append((current[0], current[1], data))
+        if len(new) + len(changed) >= size:
+            yield new, changed
+            new, changed = [], []
+    if new or changed:
+        yield new, changed
+
+
+@helpers.session
+def upsert_municipalities(chunk):
+    """Create the new municipalities of `chunk` with a single INSERT, and
+    update the changed ones with a single UPDATE, versions included."""
+    new, changed = chunk
+    Municipality = models.Municipality
+    instances = []
+    for data in new:
+        validator = Municipality.validator(version=1, **data)
+        if validator.errors:
+            reporter.error('Error', validator.errors)
+        else:
+            instances.append(validator.dry_save())
+    for instance in helpers.bulk_create(Municipality, instances, 'Error',
+                                        lambda i: i.insee):
+        reporter.notice('Processed', instance)
+
+    # [(pk, version, name, siren)]
+    values = []
+    for pk, version, data in changed:
+        instance = Municipality(pk=pk, version=version, **data)
+        validator = Municipality.validator(instance=instance, update=True,
+                                           version=version + 1, **data)
+        if validator.errors:
+            reporter.error('Error', validator.errors)
+        elif context.get('dry_run'):
+            reporter.notice('Processed', instance)
+        else:
+            values.append((pk, version, validator.document['name'],
+                           validator.document.get('siren')))
+    if not values:
+        return
+    columns = {name: '"{}"'.format(Municipality._meta.fields[name].db_column)
+               for name in ('name', 'siren', 'version', 'modified_at',
+                            'modified_by')}
+    sql = ('UPDATE {table} AS m SET {name} = v.name, {siren} = v.siren, '
+           '{version} = m.{version} + 1, {modified_at} = %s, '
+           '{modified_by} = %s '
+           'FROM (VALUES {values}) AS v (pk, version, name, siren) '
+           # Someone else may have updated it since the snapshot.
+           'WHERE m.pk = v.pk AND m.{version} = v.version '
+           'RETURNING m.pk').format(
+               table='"{}"'.format(Municipality._meta.db_table),
+               values=', '.join(['(%s, %s, %s, %s)'] * len(values)),
+               **columns)
+    params = [utcnow(), context.get('session').pk]
+    for row in values:
+        params.extend(row)
+    cursor = Municipality._meta.database.execute_sql(sql, params)
+    updated = {pk for pk, in cursor.fetchall()}
+    for pk, *_ in values:
+        if pk not in updated:
+            reporter.error('Conflict', pk)
+    if updated:
+        instances = list(Municipality.select()
+                                     .where(Municipality.pk << list(updated)))
+        Municipality.store_versions(instances)
+        for instance in instances:
+            reporter.notice('Processed', instance)
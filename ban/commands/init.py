@@ -1,45 +1,154 @@
-import json
+from functools import partial
+import re
 
 import peewee
 
 from ban.commands import command, reporter
+from ban.core import lookups
 from ban.core.models import (Group, HouseNumber, Municipality, Position,
                              PostCode)
 from ban.utils import compute_cia
 
 from . import helpers
+from .staging import Staging
 
 __namespace__ = 'import'
 
 
 @command
+@helpers.dry_run
 @helpers.nodiff
-def init(*paths, limit=0, **kwargs):
+@helpers.lookup_cache
+def init(*paths, limit=0, engine='orm', resume=False, dry_run=False,
+         parallel=False, **kwargs):
     """Initial import for real™.
 
-    paths   Paths to json files."""
+    paths   Paths to json files.
+    engine  "orm" (row by row) or "copy" (set-based, only creates resources)
+    resume  Restart from the last checkpoints of a previous run (orm engine,
+            same paths and limit).
+    dry_run Validate rows and resolve their references, without writing
+            (always row by row).
+    parallel Let process workers read and parse their own byte range of
+            each kind of rows (orm engine, uncompressed files, without
+            resume nor limit).
+    """
+    if parallel and (resume or limit or engine == 'copy'
+                     or any(helpers.is_compressed(p) for p in paths)):
+        helpers.abort('--parallel only supports uncompressed files, with the '
+                      'orm engine, without --resume nor --limit')
+    if dry_run:
+        engine = 'orm'
+    if engine != 'copy':
+        preload_lookups(lookups.active())
+    checkpoints = []
     for path in paths:
         print('Processing', path)
-        rows = helpers.iter_file(path, formatter=json.loads)
+        if engine == 'copy':
+            copy_file(path, limit=limit)
+            continue
+        checkpoint = helpers.Checkpoint(path)
+        checkpoints.append(checkpoint)
+        state = checkpoint.load() if resume else {}
+        if state.get('complete'):
+            print('Already imported, skipping')
+            continue
         if limit:
             print('Running with limit', limit)
-            extract = []
-            for i, row in enumerate(rows):
-                if i >= limit:
-                    break
-                extract.append(row)
-            rows = extract
-            total = limit
-        else:
-            print('Computing file size')
-            total = sum(1 for line in helpers.iter_file(path))
-            print('Done computing file size')
-        helpers.batch(process_row, rows, chunksize=100, total=total)
+        # Make sure referenced resources exist before their dependencies,
+        # unknown kinds last for reporting: one pass over the file per kind,
+        # only parsing the lines of this kind.
+        for kind in KINDS + [None]:
+            if skip_kind(kind, state):
+                continue
+            start, done = 0, 0
+            if state.get('kind', '') == kind:
+                start, done = state['offset'], state['rows']
+                print('Resuming {} from row {}'.format(kind, done))
+            else:
+                checkpoint.save(force=True, kind=kind, offset=0, rows=0)
+            print('Processing', kind or 'unknown rows')
+            formatter = partial(parse_kind, kind)
+            if parallel:
+                # Rows of a same municipality are no more processed by a
+                # single worker.
+                helpers.range_batch(process_row, path, formatter=formatter)
+                continue
+            rows = helpers.LineReader(path, formatter=formatter, start=start,
+                                      rows=done, limit=limit)
+            helpers.partitioned_batch(process_row, rows, key=row_insee,
+                                      chunksize=100, progress=rows,
+                                      checkpoint=checkpoint)
+        checkpoint.save(force=True, complete=True)
+    # Keep them until all paths are imported.
+    for checkpoint in checkpoints:
+        checkpoint.remove()
+
+
+KINDS = ['municipality', 'postcode', 'group', 'housenumber', 'position']
+# Other kinds can't match, not even a GeoJSON "type": "Point".
+KIND_PATTERN = re.compile(r'"type"\s*:\s*"({})"'.format('|'.join(KINDS)))
+
+
+def skip_kind(kind, state):
+    """Whether a resumed import of a file (see `state`) already processed all
+    the rows of `kind`."""
+    if 'kind' not in state:
+        return False
+    order = KINDS + [None]
+    return order.index(kind) < order.index(state['kind'])
+
+
+def parse_kind(kind, line):
+    """Parse `line` if it is a row of `kind` (None for unknown kinds), return
+    None without parsing it otherwise."""
+    if not line.strip():
+        return None
+    match = KIND_PATTERN.search(line)
+    if (match.group(1) if match else None) != kind:
+        return None
+    return helpers.parse_json(line)
+
+
+def row_insee(row):
+    """Municipality INSEE code a row belongs to."""
+    insee = (row.get('insee') or row.get('municipality:insee')
+             or row.get('group:fantoir') or row.get('cia')
+             or row.get('housenumber:cia') or '')
+    return insee[:5]
+
+
+def preload_lookups(cache):
+    """Municipalities and postcodes are few, load them all at once."""
+    qs = Municipality.select(Municipality.insee, Municipality.pk).tuples()
+    cache.preload('Municipality.insee', qs)
+    qs = (PostCode.select(PostCode.code, Municipality.insee, PostCode.pk)
+                  .join(Municipality).tuples())
+    cache.preload('PostCode.code_insee',
+                  (((code, insee), pk) for code, insee, pk in qs))
+
+
+def get_postcode_pk(code, insee):
+    def load():
+        postcode = PostCode.select(PostCode.pk).join(Municipality).where(
+            PostCode.code == code, Municipality.insee == insee).first()
+        return postcode.pk if postcode else None
+    return lookups.lookup('PostCode.code_insee', (code, insee), load,
+                          PostCode._meta.database)
+
+
+def get_housenumber_pk(cia):
+    def load():
+        housenumber = HouseNumber.select(HouseNumber.pk).where(
+            HouseNumber.cia == cia).first()
+        return housenumber.pk if housenumber else None
+    return lookups.lookup('HouseNumber.cia', cia, load,
+                          HouseNumber._meta.database)
 
 
 @helpers.session
 def process_row(row):
-    kind = row.pop('type')
+    kind = row.pop('type', None)
     if kind == "municipality":
         return process_municipality(row)
     elif kind == "group":
@@ -59,7 +168,9 @@ def process_municipality(row):
     validator = Municipality.validator(**row)
     if validator.errors:
         return reporter.error('Municipality errors', validator.errors)
-    validator.save()
+    municipality = validator.save()
+    lookups.store('Municipality.insee', municipality.insee, municipality.pk,
+                  Municipality._meta.database)
     reporter.notice('Imported Municipality', row['insee'])
 
 
@@ -119,15 +230,15 @@ def process_postcode(row):
     code = row.get('postcode')
     data = dict(name=name, code=code, municipality=municipality,
                 version=1, attributes=attributes)
-    instance = PostCode.select().join(Municipality).where(
-        PostCode.code == code, Municipality.insee == insee).first()
-    if instance:
+    if get_postcode_pk(code, insee):
         return reporter.notice('PostCode already exists', code)
     validator = PostCode.validator(**data)
     if validator.errors:
         return reporter.error('PostCode errors', (validator.errors,
                                                   code, insee))
-    validator.save()
+    postcode = validator.save()
+    lookups.store('PostCode.code_insee', (code, insee), postcode.pk,
+                  PostCode._meta.database)
     reporter.notice('Imported PostCode', code)
 
 
@@ -155,21 +266,24 @@ def process_housenumber(row):
         data['laposte'] = row['poste:cea']
     if 'postcode' in row:
         code = row.get('postcode')
-        postcode = PostCode.select().join(Municipality).where(
-            PostCode.code == code,
-            Municipality.insee == insee).first()
+        postcode = get_postcode_pk(code, insee)
         if not postcode:
             reporter.error('HouseNumber postcode not found', (cia, code))
         else:
             data['postcode'] = postcode
-    instance = HouseNumber.first(HouseNumber.cia == cia)
+    pk = get_housenumber_pk(cia)
+    if lookups.is_placeholder(pk):
+        # Dry run: an earlier row would have created it.
+        reporter.warning('HouseNumber already exists', cia)
+        return
+    instance = HouseNumber.get(HouseNumber.pk == pk) if pk else None
     update = False
     if instance:
         if cia != computed_cia:
             # Means new values are changing one of the four values of the cia
             # (insee, fantoir, number, ordinal). Make sure we are not creating
             # a duplicate.
-            duplicate = HouseNumber.first(HouseNumber.cia == computed_cia)
+            duplicate = get_housenumber_pk(computed_cia)
             if duplicate:
                 msg = 'Duplicate CIA'
                 reporter.error(msg, (cia, computed_cia))
@@ -188,10 +302,13 @@ def process_housenumber(row):
         return
     with HouseNumber._meta.database.atomic():
         try:
-            validator.save()
+            housenumber = validator.save()
         except peewee.IntegrityError:
             reporter.warning('HouseNumber DB error', cia)
         else:
+            # Dry run instances are not saved, so their cia is not computed.
+            lookups.store('HouseNumber.cia', housenumber.cia or computed_cia,
+                          housenumber.pk, HouseNumber._meta.database)
             msg = 'HouseNumber Updated' if instance else 'HouseNumber created'
             reporter.notice(msg, (number, ordinal, parent))
 
@@ -205,7 +322,7 @@ def process_position(row):
         positioning = Position.OTHER
     source = row.get('source')
     cia = row.get('housenumber:cia').upper()
-    housenumber = HouseNumber.first(HouseNumber.cia == cia)
+    housenumber = get_housenumber_pk(cia)
     if not housenumber:
         reporter.error('Position housenumber does not exist', cia)
         return
@@ -232,3 +349,165 @@ def process_position(row):
         else:
             msg = 'Position updated' if instance else 'Position created'
             reporter.notice(msg, position.id)
+
+
+@helpers.session
+def copy_file(path, limit=0):
+    """Import a json stream file through staging tables, resolving references
+    set-wise, kinds being processed in dependency order."""
+    staging = Staging('import_init', Municipality._meta.database)
+    staging.create()
+    lines = helpers.iter_file(path)
+    if limit:
+        lines = (l for i, l in enumerate(lines) if i < limit)
+    print('Copied {} rows'.format(staging.copy(lines)))
+    try:
+        cursor = staging.execute(
+            "SELECT data FROM {} WHERE data->>'type' IS NULL "
+            "OR data->>'type' NOT IN ({}) ORDER BY line".format(
+                staging.table, ', '.join(['%s'] * len(KINDS))), KINDS)
+        for row, in cursor:
+            reporter.error('Missing "type" key', row)
+        for kind in KINDS:
+            print('Processing', kind)
+            stage = globals()['stage_{}'.format(kind)](staging)
+            stage.report()
+            stage.drop()
+    finally:
+        staging.drop()
+
+
+def stage_municipality(staging):
+    stage = staging.stage(Municipality, 'municipality', {
+        'insee': "s.data->>'insee'",
+        'name': "s.data->>'name'",
+        'attributes': "hstore('source', s.data->>'source')",
+    })
+    detail = "to_jsonb(s.insee)"
+    stage.exists('l.insee = s.insee', 'Municipality already exists', detail)
+    stage.validate('Municipality errors')
+    stage.check_unique_fields('Municipality errors')
+    stage.insert('Imported Municipality', 'insee')
+    return stage
+
+
+def stage_postcode(staging):
+    stage = staging.stage(PostCode, 'postcode', {
+        'code': "s.data->>'postcode'",
+        'name': "s.data->>'name'",
+        'insee': "s.data->>'municipality:insee'",
+        'municipality': 'm.pk',
+        'attributes': "hstore('source', s.data->>'source')",
+    }, joins="LEFT JOIN municipality AS m "
+             "ON m.insee = s.data->>'municipality:insee'")
+    detail = "json_build_object('code', s.code, 'insee', s.insee)::jsonb"
+    stage.fail('s.municipality IS NULL', 'PostCode errors', detail)
+    stage.fail("s.code !~ '^[0-9]{5}$'", 'PostCode errors', detail)
+    stage.exists('l.code = s.code AND l.municipality_id = s.municipality',
+                 'PostCode already exists', 'to_jsonb(s.code)',
+                 level=reporter.NOTICE)
+    stage.unique(['code', 'municipality'], 'PostCode already exists',
+                 'to_jsonb(s.code)', level=reporter.NOTICE)
+    stage.validate('PostCode errors')
+    stage.insert('Imported PostCode', 'code')
+    return stage
+
+
+def stage_group(staging):
+    addressing = ', '.join("'{}'".format(v) for v, _ in Group.ADDRESSING)
+    stage = staging.stage(Group, 'group', {
+        'fantoir': "left(s.data->>'group:fantoir', 9)",
+        'name': "s.data->>'name'",
+        'kind': "s.data->>'group'",
+        'municipality': 'm.pk',
+        'laposte': "s.data->>'poste:matricule'",
+        'addressing': "CASE WHEN s.data->>'addressing' IN ({}) "
+                      "THEN s.data->>'addressing' END".format(addressing),
+        'attributes': "COALESCE((SELECT hstore(array_agg(key), "
+                      "array_agg(value)) FROM jsonb_each_text("
+                      "s.data->'attributes')), ''::hstore) "
+                      "|| hstore('source', s.data->>'source')",
+    }, joins="LEFT JOIN municipality AS m "
+             "ON m.insee = s.data->>'municipality:insee'")
+    detail = 'to_jsonb(s.fantoir)'
+    stage.exists('l.fantoir = s.fantoir', 'Group already exist', detail)
+    stage.fail('s.municipality IS NULL', 'Invalid group data', detail)
+    stage.validate('Invalid group data')
+    stage.check_unique_fields('Invalid group data')
+    stage.insert('Group created', 'fantoir')
+    return stage
+
+
+def stage_housenumber(staging):
+    fantoir = ("COALESCE(s.data->>'group:fantoir', "
+               "left(s.data->>'cia', 5) || substr(s.data->>'cia', 7, 4))")
+    stage = staging.stage(HouseNumber, 'housenumber', {
+        'number': "s.data->>'numero'",
+        'ordinal': "NULLIF(s.data->>'ordinal', '')",
+        'group_fantoir': fantoir,
+        'parent': 'g.pk',
+        'ign': "s.data->>'ref:ign'",
+        'laposte': "s.data->>'poste:cea'",
+        'postcode_code': "s.data->>'postcode'",
+        'postcode': 'p.pk',
+        # See HouseNumber.compute_cia: parents are matched on their fantoir,
+        # so Group.get_fantoir never falls back to tmp_fantoir here.
+        'cia': "m.insee || '_' || substr(g.fantoir, 6) || '_' "
+               "|| upper(COALESCE(s.data->>'numero', '')) || '_' "
+               "|| upper(COALESCE(NULLIF(s.data->>'ordinal', ''), ''))",
+    }, joins='LEFT JOIN "group" AS g ON g.fantoir = {fantoir} '
+             'LEFT JOIN municipality AS m ON m.pk = g.municipality_id '
+             "LEFT JOIN postcode AS p ON p.code = s.data->>'postcode' "
+             'AND p.municipality_id = g.municipality_id'.format(
+                 fantoir=fantoir))
+    detail = ("json_build_object('number', s.number, 'ordinal', s.ordinal, "
+              "'parent', s.group_fantoir)::jsonb")
+    stage.fail('s.parent IS NULL', 'HouseNumber errors', detail)
+    stage.exists('l.cia = s.cia', 'HouseNumber already exists',
+                 'to_jsonb(s.cia)')
+    stage.validate('HouseNumber errors')
+    stage.unique(['parent', 'number', 'ordinal'], 'HouseNumber DB error',
+                 'to_jsonb(s.cia)', level=reporter.WARNING)
+    stage.check_unique_fields('HouseNumber errors')
+    # Housenumber is still created without postcode, as in process_row.
+    stage.warn('s.postcode_code IS NOT NULL AND s.postcode IS NULL',
+               'HouseNumber postcode not found',
+               "json_build_array(s.cia, s.postcode_code)::jsonb")
+    stage.insert('HouseNumber created', 'cia')
+    return stage
+
+
+def stage_position(staging):
+    kinds = ', '.join("'{}'".format(v) for v, _ in Position.KIND)
+    positionings = ', '.join("'{}'".format(v) for v, _ in Position.POSITIONING)
+    stage = staging.stage(Position, 'position', {
+        'cia': "upper(s.data->>'housenumber:cia')",
+        'housenumber': 'h.pk',
+        'kind': "CASE WHEN s.data->>'kind' IN ({}) THEN s.data->>'kind' "
+                "ELSE '{}' END".format(kinds, Position.UNKNOWN),
+        # Two "n" in the data.
+        'positioning': "CASE WHEN s.data->>'positionning' IN ({}) "
+                       "THEN s.data->>'positionning' ELSE '{}' END".format(
+                           positionings, Position.OTHER),
+        'source': "s.data->>'source'",
+        'ign': "s.data->>'ref:ign'",
+        'name': "s.data->>'name'",
+        'center': "ST_SetSRID(ST_GeomFromGeoJSON(s.data->>'geometry'), {})"
+                  .format(Position.center.srid),
+    }, joins="LEFT JOIN housenumber AS h "
+             "ON h.cia = upper(s.data->>'housenumber:cia')")
+    stage.fail('s.housenumber IS NULL', 'Position housenumber does not exist',
+               'to_jsonb(s.cia)')
+    stage.exists('l.housenumber_id = s.housenumber AND l.kind = s.kind '
+                 'AND l.source IS NOT DISTINCT FROM s.source',
+                 'Position already exists', 'to_jsonb(s.cia)')
+    # See Position.validate.
+    stage.validate('Position error', 's.name IS NULL AND s.center IS NULL',
+                   "json_build_object('cia', s.cia, 'center', "
+                   "'A position must have either a center or a name.')"
+                   "::jsonb")
+    stage.unique(['housenumber', 'source'], 'Integrity error',
+                 'to_jsonb(s.cia)')
+    stage.check_unique_fields('Position error')
+    stage.insert('Position created', 'id')
+    return stage
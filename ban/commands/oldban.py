@@ -3,23 +3,47 @@ import json
 import peewee
 
 from ban.commands import command, reporter
+from ban.core import context
 from ban.core.models import (HouseNumber, Group, Municipality, Position,
                              PostCode)
+from ban.utils import compute_cia, utcnow
 
-from .helpers import batch, iter_file, nodiff, session, load_csv
+from .helpers import (abort, batch, bulk_create, Checkpoint, dry_run,
+                      is_compressed, LineReader, nodiff, parse_json,
+                      range_batch, session, load_csv, lookup_cache)
+from .staging import Staging
 
 __namespace__ = 'import'
 
 
 @command
+@dry_run
 @nodiff
-def oldban(path, **kwargs):
+@lookup_cache
+def oldban(path, resume=False, dry_run=False, parallel=False, **kwargs):
     """Import from BAN json stream files from
-    http://bano.openstreetmap.fr/BAN_odbl/"""
-    total = sum(1 for line in iter_file(path))
-    print('Done computing file size')
-    rows = iter_file(path, formatter=json.loads)
-    batch(process_row, rows, chunksize=100, total=total)
+    http://bano.openstreetmap.fr/BAN_odbl/
+
+    resume      Restart from the last checkpoint of a previous run.
+    dry_run     Validate rows and resolve their references, without writing.
+    parallel    Let process workers read and parse their own byte range of
+                the file (uncompressed files only, without resume).
+    """
+    if parallel:
+        if resume or is_compressed(path):
+            abort('--parallel only supports uncompressed files, without '
+                  '--resume')
+        return range_batch(process_row, path)
+    checkpoint = Checkpoint(path)
+    state = checkpoint.load() if resume else {}
+    if state:
+        print('Resuming from row', state['rows'])
+        print('Previous reports', state['reports'])
+    rows = LineReader(path, formatter=parse_json,
+                      start=state.get('offset', 0), rows=state.get('rows', 0))
+    batch(process_row, rows, chunksize=100, progress=rows,
+          checkpoint=checkpoint)
+    checkpoint.remove()
 
 
 @session
@@ -68,60 +92,165 @@ def process_row(metadata):
         reporter.notice(kind, item)
         housenumbers = metadata.get('housenumbers')
         if housenumbers:
-            for id, metadata in housenumbers.items():
-                add_housenumber(item, id, metadata, postcode)
+            add_housenumbers(item, housenumbers, postcode,
+                             insee=municipality.insee)
     else:
         reporter.error('Street error', validator.errors)
 
 
-def add_housenumber(parent, id, metadata, postcode):
-    number, *ordinal = id.split(' ')
-    ordinal = ordinal[0] if ordinal else ''
-    center = [metadata['lon'], metadata['lat']]
-    ign = metadata.get('id')
-    data = dict(number=number, ordinal=ordinal, version=1, parent=parent.pk,
-                ign=ign)
-    if postcode:
-        data['postcode'] = postcode
+def add_housenumbers(parent, housenumbers, postcode, insee=None):
+    """Validate all the housenumbers of `parent`, then all their positions,
+    and create each kind with a single multi-row insert (versions included).
 
-    validator = HouseNumber.validator(**data)
+    insee       insee of the parent municipality, when already loaded.
+    """
+    # Same parent for all: compute their cia from it, instead of loading it
+    # and its municipality for each housenumber (see HouseNumber.pre_save).
+    insee = str(insee or parent.municipality.insee)
+    fantoir = parent.get_fantoir()
+    instances = []
+    # {id(housenumber): its center}, their pk (and hash) is not known yet.
+    centers = {}
+    seen = set()
+    for id, metadata in housenumbers.items():
+        number, *ordinal = id.split(' ')
+        ordinal = ordinal[0] if ordinal else ''
+        ign = metadata.get('id')
+        data = dict(number=number, ordinal=ordinal, version=1,
+                    parent=parent.pk, ign=ign)
+        if postcode:
+            data['postcode'] = postcode
+        validator = HouseNumber.validator(**data)
+        if validator.errors:
+            reporter.error('Housenumber error', validator.errors)
+            continue
+        # Validator only checks unicity against the database.
+        keys = {(number, ordinal), ign} - {None}
+        if keys & seen:
+            reporter.error('Duplicate housenumber', id)
+            continue
+        seen |= keys
+        instance = validator.dry_save()
+        instance.cia = compute_cia(insee, fantoir, number, ordinal)
+        instances.append(instance)
+        centers[id(instance)] = [metadata['lon'], metadata['lat']]
+    instances = bulk_create(HouseNumber, instances, 'Duplicate housenumber',
+                            lambda i: i.cia)
 
-    if not validator.errors:
-        housenumber = validator.save()
+    positions = []
+    for housenumber in instances:
+        center = centers[id(housenumber)]
         validator = Position.validator(center=center, version=1,
                                        kind=Position.ENTRANCE,
                                        positioning=Position.OTHER,
                                        housenumber=housenumber.pk)
         if not validator.errors:
-            validator.save()
-            reporter.notice('Position', validator.instance)
+            positions.append(validator.dry_save())
         else:
             reporter.error('Position error', validator.errors)
+    for position in bulk_create(Position, positions, 'Position error',
+                                lambda p: p.housenumber.cia):
+        reporter.notice('Position', position)
+    for housenumber in instances:
         reporter.notice('Housenumber created', housenumber)
-    else:
-        reporter.error('Housenumber error', validator.errors)
 
 
 @command
+@dry_run
 @nodiff
-def cea(path, **kwargs):
+def cea(path, dry_run=False, **kwargs):
     """Import CEA from IGN Adresse Premium
-    File: Lien_Adresse-Hexa_D0{xx}-ED141.csv."""
-    rows = list(load_csv(path))
-    batch(add_cea, rows, total=len(rows))
-
+    File: Lien_Adresse-Hexa_D0{xx}-ED141.csv.
 
-def add_cea(row):
-    ign = row.get('ID_ADR')
-    laposte = row.get('HEXACLE_1')
-    if laposte == 'NR':
-        return reporter.error('Missing CEA', ign)
-    query = HouseNumber.update(laposte=laposte).where(HouseNumber.ign == ign)
+    dry_run Check CEAs and IGN ids, without writing."""
+    database = HouseNumber._meta.database
+    if dry_run:
+        # Read only transactions can't even create temporary tables: only
+        # write to temporary ones, in a transaction rolled back at the end.
+        with database.transaction() as transaction:
+            staging = Staging('import_cea', database, temporary=True)
+            table, rows = load_cea(staging, path)
+            for line, ign in rows:
+                reporter.notice('Done', ign)
+            transaction.rollback()
+        return
+    staging = Staging('import_cea', database)
     try:
-        done = query.execute()
-    except peewee.IntegrityError:
-        reporter.error('Duplicate CEA', laposte)
-    else:
-        if not done:
-            return reporter.error('IGN id not found', ign)
+        table, rows = load_cea(staging, path)
+        bounds = [(table, rows[i][0],
+                   rows[min(i + CEA_CHUNKSIZE, len(rows)) - 1][0])
+                  for i in range(0, len(rows), CEA_CHUNKSIZE)]
+        batch(update_cea, bounds, chunksize=1, total=len(bounds))
+    finally:
+        staging.drop()
+
+
+def load_cea(staging, path):
+    """Stage the CEAs of `path`, return the stage table and the (line, ign)
+    of the rows to update."""
+    staging.create()
+    print('Copied {} rows'.format(staging.copy(cea_rows(load_csv(path)))))
+    stage = stage_cea(staging)
+    cursor = staging.execute('SELECT line, ign FROM {} WHERE msg IS NULL '
+                             'ORDER BY line'.format(stage.table))
+    return stage.table, cursor.fetchall()
+
+
+# Rows updated by a single UPDATE statement.
+CEA_CHUNKSIZE = 1000
+
+
+def cea_rows(rows):
+    for row in rows:
+        ign = row.get('ID_ADR')
+        laposte = row.get('HEXACLE_1')
+        if laposte == 'NR':
+            reporter.error('Missing CEA', ign)
+            continue
+        yield json.dumps({'type': 'cea', 'ign': ign, 'laposte': laposte})
+
+
+def stage_cea(staging):
+    stage = staging.stage(HouseNumber, 'cea', {
+        'ign': "s.data->>'ign'",
+        'laposte': "s.data->>'laposte'",
+        'housenumber': 'h.pk',
+        'current': 'h.laposte',
+    }, joins="LEFT JOIN housenumber AS h ON h.ign = s.data->>'ign'")
+    detail = 'to_jsonb(s.ign)'
+    stage.fail('s.housenumber IS NULL', 'IGN id not found', detail)
+    # Last one wins, as when updating row by row.
+    stage.fail('EXISTS (SELECT 1 FROM {} AS o WHERE o.housenumber = '
+               's.housenumber AND o.line > s.line)'.format(stage.table),
+               'Overridden CEA', detail, level=reporter.WARNING)
+    stage.fail('s.laposte = s.current', 'Done', detail, level=reporter.NOTICE)
+    stage.validate('CEA error')
+    stage.unique(['laposte'], 'Duplicate CEA', 'to_jsonb(s.laposte)')
+    stage.report()
+    return stage
+
+
+@session
+def update_cea(bounds):
+    """Set the CEA of staged rows between `bounds` lines with a single
+    UPDATE, then store the new versions in bulk."""
+    table, first, last = bounds
+    fields = HouseNumber._meta.fields
+    sql = ('UPDATE housenumber AS h SET {laposte} = s.laposte, '
+           '{version} = h.{version} + 1, {modified_at} = %s, '
+           '{modified_by} = %s FROM {table} AS s '
+           'WHERE h.pk = s.housenumber AND s.msg IS NULL '
+           'AND s.line BETWEEN %s AND %s RETURNING h.pk, s.ign').format(
+               table=table, **{name: '"{}"'.format(fields[name].db_column)
+                               for name in ('laposte', 'version',
+                                            'modified_at', 'modified_by')})
+    database = HouseNumber._meta.database
+    cursor = database.execute_sql(sql, (utcnow(), context.get('session').pk,
+                                        first, last))
+    updated = dict(cursor.fetchall())
+    if not updated:
+        return
+    instances = HouseNumber.select().where(HouseNumber.pk << list(updated))
+    HouseNumber.store_versions(list(instances))
+    for ign in updated.values():
         reporter.notice('Done', ign)
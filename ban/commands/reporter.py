@@ -8,7 +8,12 @@ Reporter must be:
 - able to output in various format (string for stdout, json for API)
 - able to output only on demand (when command is finished, not on the fly)
 - able to group reports by level and message
+- bounded in memory: counts are exact, but only a sample of the reported
+  data is kept, the full detail can be spilled to a NDJSON file.
 """
+import json
+import random
+
 from ban.core import context
 
 
@@ -17,17 +22,85 @@ WARNING = 2
 NOTICE = 3
 
 
+class Sample(list):
+    """Reservoir sample of at most `size` of the data reported for a message
+    (all of them if `size` is None), `total` being the exact number of
+    reports."""
+
+    def __init__(self, size=None, items=()):
+        super().__init__(items)
+        self.size = size
+        self.total = len(self)
+
+    @property
+    def complete(self):
+        return len(self) == self.total
+
+    def add(self, item):
+        self.total += 1
+        if self.size is None or len(self) < self.size:
+            self.append(item)
+        else:
+            # Each of the reported items ends up in the sample with the same
+            # probability.
+            index = random.randrange(self.total)
+            if index < self.size:
+                self[index] = item
+
+    def merge(self, other):
+        if other.complete:
+            for item in other:
+                self.add(item)
+            return
+        # Draw from the union of the reports both samples stand for: each
+        # slot goes to a sample in proportion of its reports not drawn yet.
+        mine, theirs = list(self), list(other)
+        random.shuffle(mine)
+        random.shuffle(theirs)
+        left = [self.total, other.total]
+        size = len(mine) + len(theirs)
+        if self.size is not None:
+            size = min(size, self.size)
+        merged = []
+        while len(merged) < size:
+            if theirs and (not mine or
+                           random.randrange(sum(left)) >= left[0]):
+                merged.append(theirs.pop())
+                left[1] -= 1
+            else:
+                merged.append(mine.pop())
+                left[0] -= 1
+        self[:] = merged
+        self.total += other.total
+
+
+def count(data):
+    """Number of reports of a message, whatever the verbosity."""
+    if isinstance(data, int):
+        return data
+    return getattr(data, 'total', len(data))
+
+
 class Reporter:
-    """Store reports and render them on demand."""
+    """Store reports and render them on demand.
+
+    sample  number of reported data kept in memory by message, None for all
+            of them
+    spill   path of a NDJSON file where to write all the reported data
+    """
 
     LEVEL_LABEL = {
         ERROR: 'error',
         WARNING: 'warning',
         NOTICE: 'notice',
     }
+    SAMPLE_SIZE = 100
 
-    def __init__(self, verbosity):
+    def __init__(self, verbosity, sample=SAMPLE_SIZE, spill=None):
         self.verbosity = verbosity or 0
+        self.sample = sample
+        self.spill = spill
+        self._spill = None
         self.clear()
 
     def __str__(self):
@@ -39,12 +112,16 @@ class Reporter:
                 if reports:
                     lines.append(self.LEVEL_LABEL[level].title())
                 for msg, data in reports.items():
-                    total = len(data) if self.verbosity >= level else data
+                    total = count(data)
                     lines.append('\t- {} ({})'.format(msg, total))
                     if self.verbosity >= level:
                         for item in data:
-                            if self.verbosity >= level:
-                                lines.append('\t\t. {}'.format(item))
+                            lines.append('\t\t. {}'.format(item))
+                        if len(data) < total:
+                            lines.append('\t\t. (sample of {})'.format(
+                                len(data)))
+            if self.spill and self._spill:
+                lines.append('Full reports in {}'.format(self.spill))
         return '\n'.join(lines)
 
     def __json__(self):
@@ -54,34 +131,73 @@ class Reporter:
             if reports:
                 out[self.LEVEL_LABEL[level]] = []
                 for msg, data in reports.items():
-                    total = len(data) if self.verbosity else data
                     current = {
-                        'total': total,
+                        'total': count(data),
                         'msg': msg
                     }
                     if self.verbosity and self.verbosity >= level:
-                        current['data'] = data
+                        current['data'] = list(data)
+                        if len(data) < current['total']:
+                            current['sample'] = True
                     out[self.LEVEL_LABEL[level]].append(current)
         return out
 
     def __call__(self, msg, data, level):
         if self.verbosity >= level:
-            self._reports[level].setdefault(msg, [])
-            self._reports[level][msg].append(data)
+            reports = self._reports[level]
+            if msg not in reports:
+                reports[msg] = Sample(self.sample)
+            reports[msg].add(data)
+            self.write(level, msg, data)
         else:
             # Do not consume memory and only track counts.
             self._reports[level].setdefault(msg, 0)
             self._reports[level][msg] += 1
 
     def merge(self, reports):
+        """Merge the reports of another reporter (eg. a batch worker one),
+        spilling their data."""
         for level, msgs in reports.items():
             for msg, data in msgs.items():
                 if self.verbosity >= level:
-                    self._reports[level].setdefault(msg, [])
-                    self._reports[level][msg].extend(data)
+                    if msg not in self._reports[level]:
+                        self._reports[level][msg] = Sample(self.sample)
+                    sample = self._reports[level][msg]
+                    if isinstance(data, int):
+                        # Only counted by a less verbose reporter.
+                        sample.total += data
+                        continue
+                    for item in data:
+                        self.write(level, msg, item)
+                    if not isinstance(data, Sample):
+                        data = Sample(None, data)
+                    sample.merge(data)
                 else:
                     self._reports[level].setdefault(msg, 0)
-                    self._reports[level][msg] += data
+                    self._reports[level][msg] += count(data)
+
+    def write(self, level, msg, data):
+        """Write `data` reported for `msg` to the spill file, if any."""
+        if not self.spill:
+            return
+        if self._spill is None:
+            # Circular import.
+            from ban.core.encoder import dumps
+            self._dumps = dumps
+            self._spill = open(self.spill, 'w', encoding='utf-8')
+        self._spill.write(self._dumps({'level': self.LEVEL_LABEL[level],
+                                       'msg': msg, 'data': data}) + '\n')
+
+    def close(self):
+        if self._spill:
+            self._spill.close()
+
+    def flush(self):
+        """Return the reports so far and start over, without copying them
+        (see ban.commands.helpers.collect)."""
+        reports = self._reports
+        self.clear()
+        return reports
 
     def clear(self):
         self._reports = {
@@ -90,6 +206,15 @@ class Reporter:
             NOTICE: {}
         }
 
+    @property
+    def totals(self):
+        """Number of reports by level label and message."""
+        out = {}
+        for level, reports in self._reports.items():
+            for msg, data in reports.items():
+                out.setdefault(self.LEVEL_LABEL[level], {})[msg] = count(data)
+        return out
+
     @property
     def has_report(self):
         return any(self._reports.values())
@@ -2,14 +2,28 @@ from wsgiref.simple_server import make_server
 
 from ban.commands import command
 from ban.http import application
+from ban.http.commands import POLL_DELAY, poll, start_polling
 
 
 @command
 def run(port=5959, host='0.0.0.0', **kwargs):
     """Run BAN server (for demo and dev only)."""
+    start_polling()
     httpd = make_server(host, port, application)
     print("Serving HTTP on {}:{}...".format(host, port))
     try:
         httpd.serve_forever()
     except (KeyboardInterrupt, EOFError):
         print('Bye!')
+
+
+@command
+def worker(delay=POLL_DELAY, **kwargs):
+    """Run the API background jobs, eg. alongside a WSGI server.
+
+    delay   Seconds between two looks for pending jobs."""
+    print("Polling jobs every {} seconds...".format(delay))
+    try:
+        poll(delay)
+    except (KeyboardInterrupt, EOFError):
+        print('Bye!')
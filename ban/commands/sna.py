@@ -1,51 +1,177 @@
-from pathlib import Path
+"""
+IGN/Laposte SNA import.
 
-import peewee
+Hexa files are sliced with precompiled fixed-width layouts into columnar
+batches, joined in memory (hsw4 gives the CEA of the groups, hsv7 their
+municipality), then resources are validated and created in bulk, one
+municipality at a time, municipalities being spread across the workers.
+"""
+from contextlib import contextmanager
+import io
+from itertools import islice
+from operator import itemgetter
+from pathlib import Path
 
 from ban.commands import command, reporter
-from ban.core.models import PostCode, Group, HouseNumber
-from .helpers import session, batch, nodiff, file_len, Bar
+from ban.core.models import PostCode, Group, HouseNumber, Municipality
+from ban.utils import compute_cia
+from .helpers import (session, batch, bulk_create, dry_run, nodiff,
+                      file_len, Bar, lookup_cache, open_binary)
 
 __namespace__ = 'import'
 
 
-MATRICULE_TO_CEA = {}
+class Layout:
+    """Fixed-width record layout, {column: (start, end)}."""
+
+    def __init__(self, **columns):
+        self.columns = columns
+        self.names = tuple(columns)
+        # One call slices all the columns of a line.
+        self.slice = itemgetter(*(slice(*columns[n]) for n in self.names))
+
+    def read(self, f, size=10000):
+        """Yield lines of `f` by batches of `size`, as {column: values}."""
+        while True:
+            rows = [self.slice(line) for line in islice(f, size)]
+            if not rows:
+                break
+            yield dict(zip(self.names, zip(*rows)))
+
+
+# p7 => code postaux
+HSP7 = Layout(insee=(6, 11), cedex=(50, 51), code=(89, 94), name=(90, None))
+# v7 => voies
+HSV7 = Layout(kind=(0, 1), insee=(7, 12), matricule=(12, 20),
+              name=(60, 92), group_kind=(92, 96))
+# w4 => cea des voies et des numéros, et les numéros
+HSW4 = Layout(matricule=(0, 8), number=(8, 12), ordinal=(13, 23),
+              laposte=(23, 33))
 
 
 @command
+@dry_run
 @nodiff
-def sna(path, group=False, postcode=False, housenumber=False, **kwargs):
+@lookup_cache
+def sna(path, group=False, postcode=False, housenumber=False, dry_run=False,
+        **kwargs):
     """Import postcodes from IGN/Laposte BDUNI
 
     path        directory location of "hexa" files (hsp7aaaa.ai, hsv7aaaa.ai
                 and hsw4aaaa.ai)
     group       Whether to run group import or not.
     postcode    Whether to run postcode import or not.
-    group       Whether to run postcode import or not.
+    housenumber Whether to run housenumber import or not.
+    dry_run     Validate rows and resolve their references, without writing.
     """
-    # p7 => code postaux
-    # v7 => voies
-    # w4 => cea des voies et des numéros, et les numéros
-    load_cea(path)
+    path = Path(path)
+    if group or housenumber:
+        # {group matricule: group CEA}, {group matricule: insee}, and the
+        # housenumbers rows.
+        ceas, numbers = load_hsw4(path / 'hsw4aaaa.ai')
+        groups = load_hsv7(path / 'hsv7aaaa.ai')
     if group:
-        with Path(path, 'hsv7aaaa.ai').open(encoding='latin1') as f:
-            batch(process_group, f, total=file_len(f))
+        run(process_groups, join_groups(groups, ceas))
     if postcode:
-        with Path(path).joinpath('hsp7aaaa.ai').open(encoding='latin1') as f:
-            batch(process_postcode, f, total=file_len(f))
+        run(process_postcodes, load_hsp7(path / 'hsp7aaaa.ai'))
     if housenumber:
-        with Path(path).joinpath('hsw4aaaa.ai').open(encoding='latin1') as f:
-            batch(process_housenumber, f, total=file_len(f))
+        insees = {matricule: insee for insee, rows in groups.items()
+                  for matricule, *_ in rows}
+        run(process_housenumbers, join_housenumbers(numbers, ceas, insees))
+
+
+def run(func, partitions):
+    """Run `func` on each (insee, rows) of `partitions`."""
+    items = sorted(partitions.items(), key=lambda item: item[0] or '')
+    # One municipality per savepoint, a few of them per transaction.
+    batch(func, items, chunksize=10, total=len(items))
+
+
+@contextmanager
+def open_hexa(path):
+    """Open hexa file `path` as text, maybe compressed (see open_binary)."""
+    stream, counter = open_binary(path)
+    try:
+        yield io.TextIOWrapper(stream, encoding='latin1')
+    finally:
+        stream.close()
+        counter.close()
+
+
+def load_hsw4(path):
+    ceas = {}
+    numbers = []
+    with open_hexa(path) as f:
+        for columns in HSW4.read(f):
+            for matricule, number, ordinal, laposte in zip(
+                    columns['matricule'], map(str.strip, columns['number']),
+                    map(str.strip, columns['ordinal']), columns['laposte']):
+                if not number:
+                    ceas[matricule] = laposte
+                # Group lines too, to be reported as such (see
+                # join_housenumbers).
+                numbers.append((matricule, number, ordinal, laposte))
+    return ceas, numbers
+
+
+def load_hsv7(path):
+    """Return street rows, grouped by insee."""
+    groups = {}
+    with open_hexa(path) as f:
+        for columns in HSV7.read(f):
+            for kind, insee, matricule, name, group_kind in zip(
+                    columns['kind'], columns['insee'], columns['matricule'],
+                    columns['name'], map(str.strip, columns['group_kind'])):
+                if kind != 'V':
+                    reporter.warning('Not a street', matricule)
+                    continue
+                groups.setdefault(insee, []).append(
+                    (matricule, name, group_kind))
+    return groups
 
 
-def load_cea(path):
-    with Path(path, 'hsw4aaaa.ai').open(encoding='latin1') as f:
-        for line in f:
-            matricule = line[:8]
-            numero = line[8:12].strip()
-            cea = line[23:33]
-            if not numero:
-                MATRICULE_TO_CEA[matricule] = cea
+def load_hsp7(path):
+    """Return postcodes rows, grouped by insee."""
+    postcodes = {}
+    with open_hexa(path) as f:
+        for columns in HSP7.read(f):
+            for insee, cedex, code, name in zip(
+                    columns['insee'], columns['cedex'], columns['code'],
+                    columns['name']):
+                if cedex != 'M':
+                    reporter.warning('Cedex postcode', code)
+                    continue
+                postcodes.setdefault(insee, []).append((code, name))
+    return postcodes
+
+
+def join_groups(groups, ceas):
+    partitions = {}
+    for insee, rows in groups.items():
+        for matricule, name, group_kind in rows:
+            laposte = ceas.get(matricule)
+            if not laposte:
+                reporter.error('Missing CEA', matricule)
+                continue
+            partitions.setdefault(insee, []).append(
+                (name, laposte, guess_kind(name, group_kind)))
+    return partitions
+
+
+def join_housenumbers(numbers, ceas, insees):
+    partitions = {}
+    for matricule, number, ordinal, laposte in numbers:
+        group_laposte = ceas.get(matricule)
+        if not group_laposte:
+            reporter.error('Missing group CEA', matricule)
+            continue
+        if not number:
+            reporter.notice('Not a housenumber', laposte)
+            continue
+        # Groups unknown from hsv7 all go in the same partition.
+        partitions.setdefault(insees.get(matricule), []).append(
+            (number, ordinal, laposte, group_laposte))
+    return partitions
 
 
 AREA_VALUES = ['LD', 'LOT', 'RES', 'ZA']
@@ -61,78 +187,119 @@ def guess_kind(name, group_kind):
         return Group.WAY
 
 
+def validate(model, msg, rows):
+    """Validate each of `rows` data, return the valid instances, unsaved."""
+    instances = []
+    for data in rows:
+        validator = model.validator(**data)
+        if validator.errors:
+            reporter.error(msg, validator.errors)
+        else:
+            instances.append(validator.dry_save())
+    return instances
+
+
+def unique(rows, key, msg):
+    """Filter out `rows` duplicating the `key` of a previous one."""
+    seen = set()
+    for row in rows:
+        value = row[key]
+        if value in seen:
+            reporter.error(msg, value)
+            continue
+        seen.add(value)
+        yield row
+
+
 @session
-def process_group(line):
-    if not line[0] == 'V':
-        return reporter.warning('Not a street', line)
-    name = line[60:92]
-    matricule = line[12:20]
-    laposte = MATRICULE_TO_CEA.get(matricule)
-    if not laposte:
-        return reporter.error('Missing CEA', matricule)
-    municipality = 'insee:{}'.format(line[7:12])
-    kind = guess_kind(name, line[92:96].strip())
-
-    validator = Group.validator(name=name, laposte=laposte,
-                                municipality=municipality, kind=kind)
-    if validator.errors:
-        reporter.error('Error', validator.errors)
-    else:
-        validator.save()
-        reporter.notice('Success', name)
+def process_groups(item):
+    insee, rows = item
+    municipality = 'insee:{}'.format(insee)
+    rows = ({'name': name, 'laposte': laposte, 'municipality': municipality,
+             'kind': kind} for name, laposte, kind in rows)
+    instances = validate(Group, 'Error',
+                         unique(rows, 'laposte', 'Duplicate CEA'))
+    for instance in bulk_create(Group, instances, 'Error',
+                                lambda i: i.laposte):
+        reporter.notice('Success', instance.name)
 
 
 @session
-def process_postcode(line):
-    if line[50] != 'M':
-        return reporter.warning('Cedex postcode', line)
-    municipality = 'insee:{}'.format(line[6:11])
-    code = line[89:94]
-    name = line[90:]
-    validator = PostCode.validator(code=code, name=name,
-                                   municipality=municipality)
-    if validator.errors:
-        return reporter.error('PostCode Error', validator.errors)
-    else:
-        with PostCode._meta.database.atomic():
-            try:
-                validator.save()
-            except peewee.IntegrityError:
-                reporter.warning('Already created', (code, municipality))
-            else:
-                reporter.notice('PostCode created', code)
+def process_postcodes(item):
+    insee, rows = item
+    municipality = 'insee:{}'.format(insee)
+    existing = set()
+    data = []
+    for code, name in rows:
+        if code in existing:
+            reporter.warning('Already created', (code, municipality))
+            continue
+        existing.add(code)
+        data.append({'code': code, 'name': name,
+                     'municipality': municipality})
+    instances = validate(PostCode, 'PostCode Error', data)
+    if instances:
+        # Same municipality for all.
+        existing = set(PostCode.select(PostCode.code).where(
+            PostCode.municipality == instances[0].municipality).tuples())
+        existing = {code for code, in existing}
+    new = []
+    for instance in instances:
+        if instance.code in existing:
+            reporter.warning('Already created', (instance.code, municipality))
+        else:
+            new.append(instance)
+    for instance in bulk_create(PostCode, new, 'PostCode Error',
+                                lambda i: (i.code, municipality)):
+        reporter.notice('PostCode created', instance.code)
+
+
+def load_parents(lapostes):
+    """Return {CEA: (pk, insee, fantoir without insee)} of the groups of
+    `lapostes`, with a single query."""
+    qs = (Group.select(Group.pk, Group.laposte, Group.fantoir, Group.name,
+                       Municipality.insee)
+               .join(Municipality)
+               .where(Group.laposte << list(lapostes))
+               .order_by()
+               .naive())
+    return {g.laposte: (g.pk, g.insee, g.get_fantoir()) for g in qs}
 
 
 @session
-def process_housenumber(line):
-    matricule = line[:8]
-    number = line[8:12].strip()
-    ordinal = line[13:23].strip()
-    laposte = line[23:33]
-    group_laposte = MATRICULE_TO_CEA.get(matricule)
-    group = 'laposte:{}'.format(group_laposte)
-    if not group_laposte:
-        return reporter.error('Missing group CEA', matricule)
-    if not number:
-        return reporter.notice('Not a housenumber', laposte)
-    validator = HouseNumber.validator(number=number, ordinal=ordinal,
-                                      laposte=laposte, parent=group)
-    if validator.errors:
-        reporter.error('Housenumber error', validator.errors)
-    else:
-        validator.save()
-        reporter.notice('Housenumber created', laposte)
+def process_housenumbers(item):
+    insee, rows = item
+    parents = load_parents({group for *_, group in rows})
+    data = []
+    for number, ordinal, laposte, group in rows:
+        # Unknown groups are left to the validator, to be reported as such.
+        parent = (parents[group][0] if group in parents
+                  else 'laposte:{}'.format(group))
+        data.append({'number': number, 'ordinal': ordinal,
+                     'laposte': laposte, 'parent': parent})
+    instances = validate(HouseNumber, 'Housenumber error',
+                         unique(data, 'laposte', 'Duplicate CEA'))
+    # Parents are known, so is the cia: no need to load them for each
+    # housenumber (see HouseNumber.pre_save).
+    keys = {pk: (insee, fantoir) for pk, insee, fantoir in parents.values()}
+    for instance in instances:
+        parent = keys.get(instance._data['parent'])
+        if parent:
+            instance.cia = compute_cia(*parent, number=instance.number,
+                                       ordinal=instance.ordinal)
+    for instance in bulk_create(HouseNumber, instances, 'Housenumber error',
+                                lambda i: i.laposte):
+        reporter.notice('Housenumber created', instance.laposte)
 
 
 @command
 def filter_hsw4(hsv7, hsw4, output, **kwargs):
     """Filter hswa according to a hsv7 one. For dev only."""
-    wanted = []
-    with Path(hsv7).open(encoding='latin1') as f:
-        for line in f:
-            wanted.append(line[12:20])
+    with open_hexa(hsv7) as f:
+        wanted = {matricule for columns in HSV7.read(f)
+                  for matricule in columns['matricule']}
     with Path(output).open('w', encoding='latin1') as f1:
-        with Path(hsw4).open(encoding='latin1') as f2:
+        with open_hexa(hsw4) as f2:
             total = file_len(f2)
             bar = Bar(total=total, throttle=1000)
             for line in f2:
@@ -0,0 +1,341 @@
+"""
+Set-based import helpers.
+
+Raw rows are COPYed into an unlogged staging table, then each kind of
+resource is resolved into its own staging table, checked, reported and
+inserted (with its first version) with a handful of statements, instead of a
+few queries and a transaction per row.
+"""
+import os
+
+import peewee
+
+from ban import db
+from ban.core import context
+from ban.core.models import Model
+from ban.core.versioning import Version
+
+from . import reporter
+
+# Schema rules Stage.validate runs in SQL, or that staging tables columns
+# (sql expressions, joins) and Stage.check_unique_fields already honour.
+SQL_RULES = {'type', 'coerce', 'required', 'nullable', 'empty', 'maxlength',
+             'allowed', 'unique', 'readonly'}
+# Fields whose coercion is mirrored by Stage.validate, or by the staging
+# columns expressions (foreign keys are resolved by joins).
+SQL_FIELDS = (db.CharField, db.TextField, db.IntegerField, db.HStoreField,
+              db.PointField, db.ForeignKeyField)
+
+
+def quote(name):
+    return '"{}"'.format(name)
+
+
+def copy_escape(value):
+    # See "Text Format" in https://www.postgresql.org/docs/current/static/sql-copy.html  # noqa
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                 .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class CopyBuffer:
+    """Minimal file-like wrapper around an iterable of lines, for
+    cursor.copy_expert."""
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ''
+
+    def readline(self, size=-1):
+        try:
+            return copy_escape(next(self.lines).rstrip('\n')) + '\n'
+        except StopIteration:
+            return ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = self.readline()
+            if not line:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class Staging:
+    """Unlogged table of raw json rows, in file order.
+
+    Its name is suffixed with the process id, so concurrent runs do not share
+    their tables. `temporary` ones (and their stages) are only visible to the
+    current session and only last until the end of the transaction they are
+    created in: nothing is left in the database (see ban.commands.oldban.cea
+    dry run)."""
+
+    def __init__(self, name, database, temporary=False):
+        self.name = '{}_{}'.format(name, os.getpid())
+        self.temporary = temporary
+        # Only ever look for temporary tables in the temporary schema.
+        self.schema = 'pg_temp.' if temporary else ''
+        self.table = self.schema + quote(self.name)
+        self.database = database
+        self.stages = []
+
+    @property
+    def create_table(self):
+        if self.temporary:
+            return 'CREATE TEMPORARY TABLE'
+        return 'CREATE UNLOGGED TABLE'
+
+    def execute(self, sql, params=None):
+        return self.database.execute_sql(sql, params)
+
+    def create(self):
+        self.drop()
+        self.execute('{} {} (line serial PRIMARY KEY, data jsonb NOT NULL)'
+                     .format(self.create_table, self.table))
+
+    def drop(self):
+        """Drop the table, and the tables of its stages."""
+        for stage in self.stages:
+            stage.drop()
+        self.execute('DROP TABLE IF EXISTS {}'.format(self.table))
+
+    def copy(self, lines):
+        with self.database.atomic():
+            cursor = self.database.get_cursor()
+            cursor.copy_expert('COPY {} (data) FROM STDIN'.format(self.table),
+                               CopyBuffer(lines))
+        return cursor.rowcount
+
+    def stage(self, model, kind, columns, joins=''):
+        stage = Stage(self, model, kind, columns, joins)
+        self.stages.append(stage)
+        return stage
+
+
+class Stage:
+    """Staging table for one kind of resource.
+
+    columns     {name: sql expression} computed from the raw row "s.data",
+                names matching a model field are the ones inserted
+    joins       sql joins to resolve references from raw rows
+    """
+
+    def __init__(self, staging, model, kind, columns, joins=''):
+        self.staging = staging
+        self.model = model
+        self.name = '{}_{}'.format(staging.name, kind)
+        self.table = staging.schema + quote(self.name)
+        self.columns = columns
+        self.fields = [n for n in columns if n in model._meta.fields]
+        self.execute = staging.execute
+        staging.execute('DROP TABLE IF EXISTS {}'.format(self.table))
+        select = ', '.join('{} AS {}'.format(expr, quote(name))
+                           for name, expr in columns.items())
+        self.execute(
+            '{create} {table} AS SELECT s.line, {select}, '
+            'NULL::int AS level, NULL::text AS msg, NULL::jsonb AS detail '
+            'FROM {raw} AS s {joins} WHERE s.data->>\'type\' = %s'.format(
+                create=staging.create_table, table=self.table, select=select,
+                raw=staging.table, joins=joins), (kind, ))
+
+    def drop(self):
+        self.execute('DROP TABLE IF EXISTS {}'.format(self.table))
+
+    def fail(self, condition, msg, detail, level=reporter.ERROR, params=None):
+        """Mark rows matching `condition` as not to be inserted. Only the
+        first failure of a row is kept."""
+        self.execute(
+            'UPDATE {table} AS s SET level = %s, msg = %s, detail = {detail} '
+            'WHERE s.msg IS NULL AND ({condition})'.format(
+                table=self.table, detail=detail, condition=condition),
+            [level, msg] + list(params or []))
+
+    def warn(self, condition, msg, detail, level=reporter.ERROR):
+        """Report rows matching `condition` without skipping them."""
+        cursor = self.execute(
+            'SELECT {detail} FROM {table} AS s WHERE s.msg IS NULL '
+            'AND ({condition}) ORDER BY s.line'.format(
+                table=self.table, detail=detail, condition=condition))
+        for detail, in cursor:
+            reporter.report(msg, detail, level=level)
+
+    def validate(self, msg, condition=None, detail=None):
+        """Run the model schema rules, mirroring the Python coercion of their
+        fields (see ban.db.fields), and `condition` (reported with `detail`),
+        mirroring the model own `validate`, if any.
+
+        Raise ValueError if some of them can't be run in SQL: such a model
+        must be imported by the orm engine."""
+        model = self.model
+        own = model.validate.__func__ is not Model.validate.__func__
+        if own and condition is None:
+            raise ValueError('{}.validate is not mirrored in SQL'.format(
+                model.__name__))
+        schema = model.resource_schema
+        for name in self.fields:
+            rules = schema.get(name, {})
+            field = model._meta.fields[name]
+            unknown = set(rules) - SQL_RULES
+            if unknown or not isinstance(field, SQL_FIELDS):
+                raise ValueError('{}.{} rules are not mirrored in SQL: {}'
+                                 .format(model.__name__, name,
+                                         unknown or type(field).__name__))
+            column = 's.{}'.format(quote(name))
+            if isinstance(field, db.FantoirField):
+                self.execute('UPDATE {table} AS s SET {name} = left({col}, 9) '
+                             'WHERE length({col}) = 10'.format(
+                                 table=self.table, name=quote(name),
+                                 col=column))
+            elif (isinstance(field, (db.CharField, db.TextField))
+                    and field.null):
+                # Empty values are stored as NULL.
+                self.execute("UPDATE {table} AS s SET {name} = NULL "
+                             "WHERE {col} = ''".format(
+                                 table=self.table, name=quote(name),
+                                 col=column))
+            conditions = []
+            if rules.get('required'):
+                conditions.append('{} IS NULL'.format(column))
+            if rules.get('empty') is False:
+                conditions.append("{}::text = ''".format(column))
+            if rules.get('maxlength'):
+                conditions.append('length({}) > {:d}'.format(
+                    column, rules['maxlength']))
+            if rules.get('allowed'):
+                conditions.append('{} NOT IN ({})'.format(
+                    column, ', '.join(['%s'] * len(rules['allowed']))))
+            if isinstance(field, db.PostCodeField):
+                conditions.append("{} !~ '^[0-9]{{5}}$'".format(column))
+            elif isinstance(field, db.FantoirField):
+                conditions.append('length({}) <> 9'.format(column))
+            if not conditions:
+                continue
+            self.fail(' OR '.join(conditions), msg,
+                      "json_build_object('line', s.line, 'field', %s)::jsonb",
+                      params=[name] + list(rules.get('allowed', [])))
+        if own:
+            # On coerced values.
+            self.fail(condition, msg, detail)
+
+    def exists(self, condition, msg, detail, level=reporter.WARNING):
+        """Skip rows matching an already existing resource."""
+        self.fail('EXISTS (SELECT 1 FROM {live} AS l WHERE {condition})'
+                  .format(live=quote(self.model._meta.db_table),
+                          condition=condition), msg, detail, level=level)
+
+    def unique(self, keys, msg, detail, level=reporter.ERROR):
+        """Skip rows duplicating, in the file or in the live table, the value
+        of `keys`, only the first one of the file is kept."""
+        not_null = ' AND '.join('s.{} IS NOT NULL'.format(quote(k))
+                                for k in keys)
+        same = ' AND '.join('o.{0} = s.{0}'.format(quote(k)) for k in keys)
+        self.fail('{not_null} AND EXISTS (SELECT 1 FROM {table} AS o '
+                  'WHERE {same} AND o.line < s.line '
+                  'AND o.msg IS NULL)'.format(
+                      not_null=not_null, table=self.table, same=same),
+                  msg, detail, level=level)
+        live = ' AND '.join('l.{} = s.{}'.format(
+            quote(self.model._meta.fields[k].db_column), quote(k))
+            for k in keys)
+        self.exists('{} AND {}'.format(not_null, live), msg, detail,
+                    level=level)
+
+    def check_unique_fields(self, msg):
+        for name in self.fields:
+            if self.model.resource_schema.get(name, {}).get('unique'):
+                detail = ("json_build_object('line', s.line, 'field', '{}', "
+                          "'value', s.{})::jsonb").format(name, quote(name))
+                self.unique([name], msg, detail)
+
+    def report(self):
+        cursor = self.execute(
+            'SELECT level, msg, detail FROM {} WHERE msg IS NOT NULL '
+            'ORDER BY line'.format(self.table))
+        for level, msg, detail in cursor:
+            reporter.report(msg, detail, level=level)
+
+    def insert(self, msg, key, expressions=None):
+        """Insert valid rows and their first version, report `msg` with `key`
+        column for each of them.
+
+        expressions     {field name: sql expression} overriding the plain
+                        staging column for this field"""
+        expressions = expressions or {}
+        model = self.model
+        session = context.get('session')
+        session = session.pk if session else None
+        fields = [model._meta.fields[n] for n in self.fields]
+        columns = ['id', 'version', 'created_at', 'created_by', 'modified_at',
+                   'modified_by']
+        columns = [quote(model._meta.fields[c].db_column) for c in columns]
+        columns += [quote(f.db_column) for f in fields]
+        values = ["%s || md5(random()::text || clock_timestamp()::text)", '1',
+                  'now()', '%s', 'now()', '%s']
+        values += [expressions.get(f.name, 's.{}'.format(quote(f.name)))
+                   for f in fields]
+        sql = ('WITH created AS ('
+               'INSERT INTO {live} ({columns}) SELECT {values} '
+               'FROM {table} AS s WHERE s.msg IS NULL ORDER BY s.line '
+               'RETURNING *'
+               '), versions AS ('
+               'INSERT INTO {version} ("model_name", "model_pk", '
+               '"sequential", "raw", "period") '
+               "SELECT %s, t.pk, 1, to_jsonb({raw}), "
+               "tstzrange(t.created_at, NULL, '[)') FROM created AS t"
+               ') SELECT t.{key} FROM created AS t').format(
+                   live=quote(model._meta.db_table),
+                   columns=', '.join(columns), values=', '.join(values),
+                   table=self.table,
+                   version=quote(Version._meta.db_table),
+                   raw=version_json(model), key=quote(key))
+        prefix = 'ban-{}-'.format(model.__name__.lower())
+        params = [prefix, session, session, model.__name__]
+        with self.staging.database.atomic():
+            cursor = self.execute(sql, params)
+            for value, in cursor.fetchall():
+                reporter.notice(msg, value)
+
+
+def version_json(model, alias='t'):
+    """SQL text expression of the first version of a row of `model` table,
+    the same as `dumps(instance.as_version)` (see ban.core.encoder.dumps):
+    keys in versioned fields order, values formatted the same way."""
+    pairs = []
+    for name in model.versioned_fields:
+        field = model._meta.fields.get(name)
+        if field is None or isinstance(field, db.ManyToManyField):
+            # Reverse relations and m2m: empty at creation.
+            expr = "'[]'::jsonb"
+        else:
+            column = '{}.{}'.format(alias, quote(field.db_column))
+            if isinstance(field, peewee.ForeignKeyField):
+                related = field.rel_model
+                if 'id' in related._meta.fields:
+                    expr = '(SELECT "id" FROM {} WHERE "pk" = {})'.format(
+                        quote(related._meta.db_table), column)
+                else:
+                    # Session pretends to be a resource with id == pk.
+                    expr = column
+            elif isinstance(field, db.HStoreField):
+                expr = 'hstore_to_jsonb({})'.format(column)
+            elif isinstance(field, db.PointField):
+                expr = 'ST_AsGeoJSON({}, 15)::jsonb'.format(column)
+            elif isinstance(field, peewee.DateTimeField):
+                expr = isoformat(column)
+            else:
+                expr = column
+        # jsonb text has the same separators as json.dumps.
+        pairs.append("'\"{}\": ' || COALESCE(to_jsonb({})::text, 'null')"
+                     .format(name, expr))
+    return "'{{' || {} || '}}'".format(" || ', ' || ".join(pairs))
+
+
+def isoformat(column):
+    """SQL expression of a timestamp `column` as datetime.isoformat() of its
+    UTC value."""
+    utc = "{} AT TIME ZONE 'UTC'".format(column)
+    return ("to_char({utc}, 'YYYY-MM-DD\"T\"HH24:MI:SS') || CASE WHEN "
+            "to_char({utc}, 'US') = '000000' THEN '' "
+            "ELSE to_char({utc}, '.US') END || '+00:00'").format(utc=utc)
@@ -2,6 +2,7 @@ import json
 from datetime import datetime
 from postgis import Geometry
 from ban.commands.reporter import Reporter
+from ban.core.metrics import Metrics
 
 
 class ResourceEncoder(json.JSONEncoder):
@@ -10,7 +11,7 @@ class ResourceEncoder(json.JSONEncoder):
             return o.isoformat()
         elif isinstance(o, Geometry):
             return o.geojson
-        elif isinstance(o, Reporter):
+        elif isinstance(o, (Reporter, Metrics)):
             return o.__json__()
         try:
             return super().default(o)
@@ -18,5 +19,5 @@ class ResourceEncoder(json.JSONEncoder):
             return str(o)
 
 
-def dumps(data):
-    return json.dumps(data, cls=ResourceEncoder)
+def dumps(data, **kwargs):
+    return json.dumps(data, cls=ResourceEncoder, **kwargs)
@@ -0,0 +1,100 @@
+"""
+Background jobs.
+
+Long running commands requested through the API (eg. a BAL import) are stored
+in the job table and run by a pool of background workers, so the request
+returns right away. Their progress and final report are stored along.
+
+Any process can run the pending jobs, as they are claimed from the table: jobs
+requested before a restart are not lost, and those left running by a killed
+process are put back in the queue once stale.
+"""
+import uuid
+from datetime import timedelta
+
+from ban import db
+from ban.auth.models import Session
+from ban.utils import utcnow
+
+
+class Job(db.Model):
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    # Do not write progress more often than that.
+    PROGRESS_DELAY = timedelta(seconds=1)
+    # Running jobs not updated since then are considered dead.
+    STALE_DELAY = timedelta(minutes=10)
+
+    id = db.UUIDField(unique=True, default=uuid.uuid4)
+    command = db.CharField(max_length=100)
+    session = db.ForeignKeyField(Session, null=True)
+    payload = db.TextField()
+    status = db.CharField(max_length=20, default=PENDING, index=True)
+    done = db.IntegerField(default=0)
+    total = db.IntegerField(null=True)
+    report = db.BinaryJSONField(null=True)
+    error = db.TextField(null=True)
+    created_at = db.DateTimeField(default=utcnow)
+    modified_at = db.DateTimeField(default=utcnow)
+
+    @property
+    def as_resource(self):
+        return {
+            'id': str(self.id),
+            'command': self.command,
+            'status': self.status,
+            'progress': {'done': self.done, 'total': self.total},
+            'report': self.report,
+            'error': self.error,
+            'created_at': self.created_at,
+            'modified_at': self.modified_at,
+        }
+
+    def _update(self, *where, **data):
+        data['modified_at'] = utcnow()
+        query = Job.update(**data).where(Job.pk == self.pk, *where)
+        done = query.execute()
+        if done:
+            for key, value in data.items():
+                setattr(self, key, value)
+        return done
+
+    def claim(self):
+        """Mark the job as running, unless another worker did it first."""
+        return bool(self._update(Job.status == self.PENDING,
+                                 status=self.RUNNING))
+
+    @classmethod
+    def claim_next(cls):
+        """Claim the oldest pending job, return None if there is none."""
+        with cls._meta.database.atomic():
+            # Concurrent workers wait for the row lock, then skip the job.
+            job = (cls.select().where(cls.status == cls.PENDING)
+                      .order_by(cls.created_at).limit(1).for_update()
+                      .first())
+            if job and job.claim():
+                return job
+
+    @classmethod
+    def requeue_stale(cls):
+        """Set back to pending the running jobs not updated for too long, eg.
+        because their process was killed. Return how many there were."""
+        now = utcnow()
+        return (cls.update(status=cls.PENDING, modified_at=now)
+                   .where(cls.status == cls.RUNNING,
+                          cls.modified_at < now - cls.STALE_DELAY)
+                   .execute())
+
+    def set_progress(self, done):
+        if utcnow() - self.modified_at >= self.PROGRESS_DELAY:
+            self._update(done=done)
+
+    def finish(self, report):
+        self._update(status=self.DONE, done=self.total or self.done,
+                     report=report)
+
+    def fail(self, error):
+        self._update(status=self.FAILED, error=error)
@@ -0,0 +1,211 @@
+"""
+Import scoped lookup caches.
+
+Importers resolve the same references (municipality by insee, group by
+fantoir…) over and over. While a cache is active, those lookups (including
+foreign keys coercion) only hit the database once per key.
+
+Entries read or written within a transaction are dropped if it (or the
+savepoint they were set in) is rolled back, so the cache never points to
+rows that do not exist.
+
+In dry run, resources that would have been created get a placeholder pk
+(see reserve), so the rows referencing them resolve as in a real run.
+
+Forked batch workers have their own copy of the cache: what they store and
+their stats are sent back to the main process (see flush).
+"""
+from contextlib import contextmanager
+from functools import partial
+import itertools
+import os
+import threading
+
+from . import metrics
+
+_active = None
+# Whether the active cache is the copy of a forked worker (see share).
+_forked = False
+# Values stored by a forked worker since the last flush, [(kind, key, pk)].
+_stored = []
+# (pid, counter): placeholders are unique across process workers.
+_placeholders = (None, None)
+
+
+class LookupCache:
+    """Map `kind` (eg. "Group.fantoir") and key to a value (usually a pk).
+
+    Only found values are cached, unless the kind has been preloaded: then the
+    cache is authoritative and a miss means there is no such resource."""
+
+    def __init__(self):
+        self._data = {}
+        self._complete = set()
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        lines = ['# Lookups']
+        for kind, (hits, misses) in sorted(self._stats.items()):
+            total = hits + misses
+            lines.append('\t- {}: {:.1%} hits ({}/{})'.format(
+                kind, hits / total, hits, total))
+        return '\n'.join(lines)
+
+    @property
+    def stats(self):
+        return dict(self._stats)
+
+    def _count(self, kind, hit):
+        with self._lock:
+            stats = self._stats.setdefault(kind, [0, 0])
+            stats[0 if hit else 1] += 1
+
+    def get(self, kind, key, loader=None, database=None):
+        """Return cached value, or call `loader` to get it (from `database`,
+        see set)."""
+        data = self._data.setdefault(kind, {})
+        try:
+            value = data[key]
+        except KeyError:
+            if kind in self._complete or loader is None:
+                self._count(kind, kind in self._complete)
+                return None
+            self._count(kind, False)
+            with metrics.stage('lookup'):
+                value = loader()
+            if value is not None:
+                self.set(kind, key, value, database)
+            return value
+        self._count(kind, True)
+        return value
+
+    def set(self, kind, key, value, database=None):
+        """Cache `value`, until the current transaction of `database`, if
+        any, is rolled back."""
+        self._data.setdefault(kind, {})[key] = value
+        if database is not None:
+            database.on_rollback(partial(self.discard, kind, key))
+
+    def discard(self, kind, key):
+        self._data.get(kind, {}).pop(key, None)
+
+    def peek(self, kind, key):
+        """Return the cached value, if any, without counting a hit."""
+        return self._data.get(kind, {}).get(key)
+
+    def flush_stats(self):
+        """Return the stats and start over."""
+        with self._lock:
+            stats, self._stats = self._stats, {}
+        return stats
+
+    def merge(self, stored, stats):
+        """Merge what a forked worker `stored` and its `stats` (see
+        flush)."""
+        for kind, key, value in stored:
+            self.set(kind, key, value)
+        with self._lock:
+            for kind, (hits, misses) in stats.items():
+                current = self._stats.setdefault(kind, [0, 0])
+                current[0] += hits
+                current[1] += misses
+
+    def preload(self, kind, items):
+        """Fill `kind` with all the (key, value) `items` and make it
+        authoritative."""
+        self._data.setdefault(kind, {}).update(items)
+        self._complete.add(kind)
+
+
+def active():
+    return _active
+
+
+@contextmanager
+def activate(cache=None):
+    global _active
+    previous = _active
+    _active = cache or LookupCache()
+    try:
+        yield _active
+    finally:
+        _active = previous
+
+
+def share(cache, forked=False):
+    """Make `cache` the active one of a batch worker, see
+    ban.commands.helpers.init_worker.
+
+    The cache of a `forked` worker is its own copy: its stats start over, to
+    be sent back along with what it stores (see flush)."""
+    global _active, _forked
+    if forked and cache is not None:
+        # The lock may have been held by another thread when forking.
+        cache._lock = threading.Lock()
+        cache._stats = {}
+    _active = cache
+    _forked = forked
+
+
+def lookup(kind, key, loader, database=None):
+    """Lookup through the active cache, if any."""
+    if _active is None:
+        with metrics.stage('lookup'):
+            return loader()
+    return _active.get(kind, key, loader, database)
+
+
+def store(kind, key, value, database=None):
+    """Cache a `value` just written to `database`, or a placeholder (see
+    reserve)."""
+    if _active is None:
+        return
+    if is_placeholder(value):
+        # Nothing has been written, so nothing to roll back.
+        database = None
+    if _forked:
+        # The main process must know about it (see flush).
+        _stored.append((kind, key, value))
+    _active.set(kind, key, value, database)
+
+
+def is_placeholder(pk):
+    return isinstance(pk, int) and pk < 0
+
+
+def placeholder():
+    """Return a new placeholder pk: negative, never used by a row."""
+    global _placeholders
+    pid, counter = _placeholders
+    if pid != os.getpid():
+        # Forked workers start with a copy of the parent counter.
+        pid, counter = os.getpid(), itertools.count(1)
+        _placeholders = pid, counter
+    return -(pid * 10 ** 9 + next(counter))
+
+
+def reserve(keys):
+    """Return a placeholder pk for a resource a dry run would create, and
+    make the lookups of its `keys` ([(kind, key)]) resolve to it."""
+    pk = placeholder()
+    for kind, key in keys:
+        store(kind, key, pk)
+    return pk
+
+
+def flush():
+    """Return what this forked worker stored since the last call (minus what
+    has been rolled back since) and its stats, to be merged in the main
+    process cache (see LookupCache.merge and ban.commands.helpers.merge):
+    the next batches workers start from it.
+
+    Other workers share the main process cache: there is nothing to send."""
+    global _stored
+    if not _forked or _active is None:
+        return [], {}
+    stored, _stored = _stored, []
+    # Rolled back entries have been discarded from the cache meanwhile.
+    stored = [(kind, key, value) for kind, key, value in stored
+              if _active.peek(kind, key) == value]
+    return stored, _active.flush_stats()
@@ -0,0 +1,266 @@
+"""
+Import stages metrics.
+
+Reports count messages, metrics tell where the time goes: while a Metrics is
+set in context, the time spent in each stage of an import (parsing rows,
+validating them, looking up their references, saving them, storing their
+versions, committing) is recorded in a histogram, and batch workers record
+the rows they process. Like reports, workers collect metrics of their own,
+merged in the main ones once per chunk (see ban.commands.helpers.collect).
+
+Stages may nest (references are looked up while validating): their times
+overlap and are not meant to be summed.
+"""
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+import decorator
+
+from . import config, context
+
+STAGES = ['parse', 'validate', 'lookup', 'save', 'version', 'commit']
+
+
+def bucket(duration):
+    """Histogram bucket of `duration` seconds: n for durations below 2 ** n
+    microseconds."""
+    return int(duration * 1e6).bit_length()
+
+
+def bound(key):
+    """Upper bound, in seconds, of the durations of bucket `key`."""
+    return 2 ** key / 1e6
+
+
+def worker_name():
+    return '{}/{}'.format(os.getpid(), threading.current_thread().name)
+
+
+class Metrics:
+    """Store stages timings and rows processed by worker, render them on
+    demand.
+
+    progress    path of a file where to stream JSON lines of the progress,
+                see tick
+    """
+
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(self, progress=None):
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.progress = progress
+        self._progress = None
+        self.clear()
+
+    def __str__(self):
+        summary = self.__json__()
+        lines = ['# Metrics', '{rows} rows in {elapsed:.1f}s '
+                 '({rows_per_second:.0f} rows/s)'.format(**summary)]
+        if summary['stages']:
+            lines.append('Stages')
+        for name, stats in sorted(summary['stages'].items(), key=stage_order):
+            durations = [format_duration(stats[key])
+                         for key in ['mean', 'p50', 'p90', 'p99', 'max']]
+            lines.append('\t- {}: {} calls in {:.1f}s, mean {}, p50 {}, '
+                         'p90 {}, p99 {}, max {}'.format(
+                             name, stats['count'], stats['time'], *durations))
+        if summary['workers']:
+            lines.append('Workers')
+        for name, stats in sorted(summary['workers'].items()):
+            lines.append('\t- {}: {} rows in {:.1f}s ({:.0f} rows/s)'.format(
+                name, stats['rows'], stats['time'], stats['rows_per_second']))
+        return '\n'.join(lines)
+
+    def __json__(self):
+        elapsed = time.perf_counter() - self.start
+        rows = self.total_rows
+        out = {
+            'elapsed': elapsed,
+            'rows': rows,
+            'rows_per_second': rows / elapsed if elapsed else 0,
+            'stages': {},
+            'workers': {},
+        }
+        for name, stats in self._stages.items():
+            buckets = sorted(stats['buckets'].items())
+            current = {
+                'count': stats['count'],
+                'time': stats['time'],
+                'mean': stats['time'] / stats['count'],
+                'max': stats['max'],
+                # [[upper bound in seconds, count]]
+                'histogram': [[bound(key), count] for key, count in buckets],
+            }
+            for percent in self.PERCENTILES:
+                current['p{}'.format(percent)] = percentile(
+                    buckets, stats['count'], percent)
+            out['stages'][name] = current
+        for name, stats in self._workers.items():
+            current = dict(stats)
+            current['rows_per_second'] = (stats['rows'] / stats['time']
+                                          if stats['time'] else 0)
+            out['workers'][name] = current
+        return out
+
+    def clear(self):
+        # {stage: {'count': x, 'time': x, 'max': x, 'buckets': {key: count}}}
+        self._stages = {}
+        # {worker: {'rows': x, 'chunks': x, 'time': x}}
+        self._workers = {}
+
+    @property
+    def data(self):
+        """Raw metrics, to be merged in other ones (eg. from a process
+        worker)."""
+        return {'stages': self._stages, 'workers': self._workers}
+
+    def flush(self):
+        """Return the raw metrics so far and start over, without copying
+        them."""
+        data = self.data
+        self.clear()
+        return data
+
+    @property
+    def total_rows(self):
+        return sum(stats['rows'] for stats in self._workers.values())
+
+    @property
+    def has_metrics(self):
+        return bool(self._workers)
+
+    def time(self, stage, duration):
+        stats = self._stages.get(stage)
+        if stats is None:
+            stats = self._stages[stage] = {'count': 0, 'time': 0, 'max': 0,
+                                           'buckets': {}}
+        stats['count'] += 1
+        stats['time'] += duration
+        if duration > stats['max']:
+            stats['max'] = duration
+        key = bucket(duration)
+        stats['buckets'][key] = stats['buckets'].get(key, 0) + 1
+
+    def rows(self, count, duration, worker=None):
+        stats = self._workers.setdefault(worker or worker_name(),
+                                         {'rows': 0, 'chunks': 0, 'time': 0})
+        stats['rows'] += count
+        stats['chunks'] += 1
+        stats['time'] += duration
+
+    def merge(self, data):
+        for name, other in data['stages'].items():
+            stats = self._stages.setdefault(name, {'count': 0, 'time': 0,
+                                                   'max': 0, 'buckets': {}})
+            stats['count'] += other['count']
+            stats['time'] += other['time']
+            stats['max'] = max(stats['max'], other['max'])
+            for key, count in other['buckets'].items():
+                stats['buckets'][key] = stats['buckets'].get(key, 0) + count
+        for name, other in data['workers'].items():
+            stats = self._workers.setdefault(name, {'rows': 0, 'chunks': 0,
+                                                    'time': 0})
+            for key in stats:
+                stats[key] += other[key]
+
+    def tick(self, reporter=None):
+        """Write a JSON line of the current totals (and of the `reporter`
+        ones), called once per merged chunk.
+
+        Lines go to the progress file, if any, else to stderr. They are
+        written at most every METRICS_EVERY seconds, if set, else at each
+        call for a progress file and never for stderr."""
+        every = config.get('METRICS_EVERY')
+        if not every and not self.progress:
+            return
+        now = time.perf_counter()
+        if every and now - self.last < float(every):
+            return
+        self.last = now
+        elapsed = now - self.start
+        rows = self.total_rows
+        line = {'elapsed': round(elapsed, 3), 'rows': rows,
+                'rows_per_second': round(rows / elapsed, 1),
+                'stages': {name: round(stats['time'], 3)
+                           for name, stats in self._stages.items()}}
+        if reporter is not None:
+            line['reports'] = reporter.totals
+        out = sys.stderr
+        if self.progress:
+            if self._progress is None:
+                self._progress = open(self.progress, 'w', encoding='utf-8')
+            out = self._progress
+        out.write(json.dumps(line, sort_keys=True) + '\n')
+        # Let followers (eg. tail -f) see it right away.
+        out.flush()
+
+    def close(self):
+        if self._progress:
+            self._progress.close()
+
+
+def percentile(buckets, count, percent):
+    """Upper bound of the bucket holding the `percent` percentile of the
+    `count` durations of the sorted (key, count) `buckets`."""
+    rank = count * percent / 100
+    seen = 0
+    for key, size in buckets:
+        seen += size
+        if seen >= rank:
+            return bound(key)
+    return bound(buckets[-1][0]) if buckets else 0
+
+
+def stage_order(item):
+    name = item[0]
+    return (STAGES.index(name) if name in STAGES else len(STAGES), name)
+
+
+def format_duration(seconds):
+    if seconds < 1e-3:
+        return '{:.0f}µs'.format(seconds * 1e6)
+    if seconds < 1:
+        return '{:.1f}ms'.format(seconds * 1e3)
+    return '{:.2f}s'.format(seconds)
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as stage `name`, if metrics are collected."""
+    metrics = context.get('metrics')
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.time(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Time each call of the decorated function as stage `name`."""
+    @decorator.decorator
+    def wrapper(func, *args, **kwargs):
+        with stage(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def record(name, duration):
+    """Record a `duration` measured by the caller as stage `name`."""
+    metrics = context.get('metrics')
+    if metrics is not None:
+        metrics.time(name, duration)
+
+
+def processed(rows, duration):
+    """Record that the current worker processed `rows` in `duration`."""
+    metrics = context.get('metrics')
+    if metrics is not None:
+        metrics.rows(rows, duration)
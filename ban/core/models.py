@@ -1,11 +1,16 @@
+from functools import partial
+import json
 import re
 
 import peewee
 from unidecode import unidecode
 
 from ban import db
-from ban.utils import compute_cia
-from .versioning import Versioned, BaseVersioned
+from ban.utils import compute_cia, make_diff
+from . import context, metrics
+from .encoder import dumps
+from .versioning import (BaseVersioned, Diff, IdentifierRedirect, Version,
+                         Versioned)
 from .resource import ResourceModel, BaseResource
 from .validators import VersionedResourceValidator
 
@@ -46,6 +51,113 @@ class Model(ResourceModel, Versioned, metaclass=BaseModel):
             errors['version'] = validator.ERROR_REQUIRED_FIELD
         return errors
 
+    @classmethod
+    def bulk_create(cls, instances):
+        """Insert new (and valid) `instances` with one multi-row statement,
+        and their first versions (and diffs) with another one, instead of a
+        few queries per instance.
+
+        m2m values are not saved, reverse relations and m2m are empty in the
+        first version."""
+        instances = list(instances)
+        if not instances or context.get('dry_run'):
+            return instances
+        fields = [f for f in cls._meta.sorted_fields
+                  if not f.primary_key
+                  and not isinstance(f, db.ManyToManyField)]
+        with cls._meta.database.atomic():
+            for instance in instances:
+                instance.check_version()
+                instance.update_meta()
+                instance.pre_save()
+            rows = [{f.name: i._data.get(f.name) for f in fields}
+                    for i in instances]
+            with metrics.stage('save'):
+                pks = cls.insert_many(rows).return_id_list().execute()
+            for instance, pk in zip(instances, pks):
+                instance.pk = pk
+            cls.store_versions(instances, created=True)
+        for instance in instances:
+            instance.lock_version()
+        return instances
+
+    @classmethod
+    @metrics.timed('version')
+    def store_versions(cls, instances, created=False):
+        """Store the current version of each of `instances` (and its diff),
+        with a few multi-row statements.
+
+        created     `instances` have just been inserted: their reverse
+                    relations and m2m are known to be empty, and there is no
+                    previous version to close"""
+        # Resolve related resources ids with one query per field.
+        ids = {}
+        for name in cls.versioned_fields:
+            field = cls._meta.fields.get(name)
+            if (not isinstance(field, peewee.ForeignKeyField)
+                    or 'id' not in field.rel_model._meta.fields):
+                continue
+            related = field.rel_model
+            pks = list({i._data.get(name) for i in instances} - {None})
+            ids[name] = {}
+            if pks:
+                qs = (related.select(related.pk, related.id)
+                             .where(related.pk << pks).order_by().tuples())
+                ids[name] = dict(qs)
+        rows = []
+        for instance in instances:
+            data = {}
+            for name in cls.versioned_fields:
+                field = cls._meta.fields.get(name)
+                if created and (field is None
+                                or isinstance(field, db.ManyToManyField)):
+                    # Reverse relations and m2m: empty at creation.
+                    data[name] = []
+                elif name in ids:
+                    data[name] = ids[name].get(instance._data.get(name))
+                elif isinstance(field, peewee.ForeignKeyField):
+                    # Session pretends to be a resource with id == pk.
+                    data[name] = instance._data.get(name)
+                else:
+                    data[name] = instance.compact_field(name)
+            rows.append({'model_name': cls.__name__, 'model_pk': instance.pk,
+                         'sequential': instance.version,
+                         'raw': dumps(data, ensure_ascii=False),
+                         'period': [instance.modified_at, None]})
+        pks = [i.pk for i in instances]
+        old = {}
+        if not created:
+            previous = (Version.select()
+                               .where(Version.model_name == cls.__name__,
+                                      Version.model_pk << pks,
+                                      peewee.fn.upper_inf(Version.period))
+                               .order_by())
+            old = {v.model_pk: v for v in previous}
+            if old:
+                # All the instances have been modified at the same time.
+                bound = instances[0].modified_at
+                (Version.update(period=peewee.fn.tstzrange(
+                    peewee.fn.lower(Version.period), bound, '[)'))
+                        .where(Version.pk << [v.pk for v in old.values()])
+                        .execute())
+        new = list(Version.insert_many(rows).return_id_list().execute())
+        cls._meta.database.on_commit(partial(Version.cache.update, rows))
+        if not Diff.active():
+            return
+        diffs = []
+        for pk, row in zip(new, rows):
+            previous = old.get(row['model_pk'])
+            diffs.append(Diff(
+                old=previous, new=Version(pk=pk, **row),
+                diff=make_diff(previous.data if previous else {},
+                               json.loads(row['raw'])),
+                created_at=row['period'][0]))
+        Diff.insert_many([{'old': d._data.get('old'), 'new': d._data['new'],
+                           'diff': d.diff, 'created_at': d.created_at}
+                          for d in diffs]).execute()
+        if not created:
+            IdentifierRedirect.from_diffs(diffs)
+
 
 class NamedModel(Model):
     name = db.CharField(max_length=200)
@@ -159,8 +271,14 @@ class HouseNumber(Model):
     def __str__(self):
         return ' '.join([self.number or '', self.ordinal or ''])
 
+    def pre_save(self):
+        # Bulk importers set the cia of new housenumbers from the parents
+        # they resolved at once, instead of loading them one by one.
+        if self.pk or not self.cia:
+            self.cia = self.compute_cia()
+        super().pre_save()
+
     def save(self, *args, **kwargs):
-        self.cia = self.compute_cia()
         super().save(*args, **kwargs)
         self._clean_called = False
 
@@ -4,6 +4,7 @@ import peewee
 
 from ban import db
 
+from . import lookups, metrics
 from .validators import ResourceValidator
 
 
@@ -94,9 +95,13 @@ class ResourceModel(db.Model, metaclass=BaseResource):
     def make_id(cls):
         return 'ban-{}-{}'.format(cls.__name__.lower(), uuid.uuid4().hex)
 
-    def save(self, *args, **kwargs):
+    def pre_save(self):
+        """Compute values derived from others, before writing."""
         if not self.id:
             self.id = self.make_id()
+
+    def save(self, *args, **kwargs):
+        self.pre_save()
         return super().save(*args, **kwargs)
 
     @classmethod
@@ -135,8 +140,9 @@ class ResourceModel(db.Model, metaclass=BaseResource):
 
     @classmethod
     def validator(cls, instance=None, update=False, **data):
-        validator = cls._meta.validator(cls)
-        validator(data, update=update, instance=instance)
+        with metrics.stage('validate'):
+            validator = cls._meta.validator(cls)
+            validator(data, update=update, instance=instance)
         return validator
 
     @property
@@ -166,6 +172,22 @@ class ResourceModel(db.Model, metaclass=BaseResource):
         value = getattr(self, '{}_compact'.format(name), getattr(self, name))
         return getattr(value, 'id', value)
 
+    @classmethod
+    def coerce_pk(cls, id):
+        """Same as coerce, but only return the pk, through the active lookup
+        cache, if any."""
+        if not isinstance(id, str):
+            return cls.coerce(id).pk
+        *extra, value = id.split(':')
+        kind = '{}.{}'.format(cls.__name__, extra[0] if extra else 'id')
+        pk = lookups.lookup(kind, value, lambda: cls.coerce(id).pk,
+                            cls._meta.database)
+        if pk is None:
+            # Authoritative miss from a preloaded cache, but the identifier
+            # may be an old one.
+            pk = cls.coerce(id).pk
+        return pk
+
     @classmethod
     def coerce(cls, id, identifier=None):
         if not identifier:
@@ -3,18 +3,119 @@ import peewee
 from postgis import Point
 
 from ban import db
+from ban.core import context, lookups
 from ban.utils import make_diff
 
+# Missing definition rule, as opposed to a rule set to None.
+NOTHING = object()
+
+
+class CompiledSchema:
+    """Rules of a resource schema, checked and resolved once per model.
+
+    Cerberus checks the schema each time a validator is instantiated, then
+    looks up the rules of each field, and their validation method, each time
+    the field is validated. Here each field definition is turned into a
+    (nullable, coerce, readonly, type, rules) record, whose rules are the
+    validation functions and their constraint, in the order Cerberus applies
+    them. Definitions using rules with children validators (schema,
+    dependencies) are left to Cerberus (their record is None)."""
+
+    NESTED_RULES = ('schema', 'dependencies')
+
+    def __init__(self, validator, schema):
+        validator.validate_schema(schema)
+        self.schema = schema
+        cls = type(validator)
+        self.fields = {field: self.compile(cls, definition)
+                       for field, definition in schema.items()}
+        self.required = {field for field, definition in schema.items()
+                         if definition.get('required') is True}
+        self.readonly = {field for field, definition in schema.items()
+                         if definition.get('readonly')}
+
+    def compile(self, cls, definition):
+        if any(rule in definition for rule in self.NESTED_RULES):
+            return None
+        nullable = definition.get('nullable', False) is True
+        coerce = definition.get('coerce', NOTHING)
+        readonly = definition.get('readonly', NOTHING)
+        type_ = definition.get('type')
+        if type_ is None:
+            check = None
+        elif isinstance(type_, str):
+            check = getattr(cls, '_validate_type_' + type_)
+        else:
+            def check(validator, field, value):
+                validator._validate_type(type_, field, value)
+        rules = []
+        for rule, constraint in definition.items():
+            if rule in cls.special_rules:
+                continue
+            func = getattr(cls, '_validate_' + rule.replace(' ', '_'), None)
+            if func:
+                rules.append((func, constraint))
+        return nullable, coerce, readonly, check, rules
+
 
 class ResourceValidator(Validator):
 
     ValidationError = ValidationError
     ERROR_REQUIRED_FIELD = errors.ERROR_REQUIRED_FIELD
 
+    # {(validator class, model): CompiledSchema}
+    _compiled = {}
+
     def __init__(self, model, *args, **kwargs):
         self.model = model
         kwargs['purge_unknown'] = True
-        super().__init__(model.resource_schema, *args, **kwargs)
+        # Do not let Cerberus check the schema again for each document.
+        super().__init__(None, *args, **kwargs)
+        self.schema = model.resource_schema
+        self.compiled = self.compile(model)
+
+    def compile(self, model):
+        """Return the CompiledSchema of `model`, built on first use."""
+        key = (type(self), model)
+        compiled = self._compiled.get(key)
+        # Recompile if the schema has been replaced since.
+        if compiled is None or compiled.schema is not model.resource_schema:
+            compiled = CompiledSchema(self, model.resource_schema)
+            self._compiled[key] = compiled
+        return compiled
+
+    def _validate_definition(self, definition, field, value):
+        # Same steps and errors as Cerberus, without resolving the rules.
+        record = None
+        if self.schema is self.compiled.schema:
+            record = self.compiled.fields[field]
+        if record is None:
+            return super()._validate_definition(definition, field, value)
+        nullable, coerce, readonly, check, rules = record
+        if value is None:
+            if nullable:
+                return
+            self._error(field, errors.ERROR_NOT_NULLABLE)
+        if coerce is not NOTHING:
+            value = self._validate_coerce(coerce, field, value)
+            self.document[field] = value
+        if readonly is not NOTHING:
+            self._validate_readonly(readonly, field, value)
+            if self._errors.get(field):
+                return
+        if check is not None:
+            check(self, field, value)
+            if self._errors.get(field):
+                return
+        for func, constraint in rules:
+            func(self, constraint, field, value)
+
+    def _validate_required_fields(self, document):
+        if (self.ignore_none_values
+                or self.schema is not self.compiled.schema):
+            return super()._validate_required_fields(document)
+        for field in self.compiled.required - set(document):
+            self._error(field, errors.ERROR_REQUIRED_FIELD)
 
     def _validate_type_point(self, field, value):
         if not isinstance(value, (str, list, tuple, Point)):
@@ -53,9 +154,8 @@ class ResourceValidator(Validator):
 
     def _purge_readonly(self, data):
         # cf https://github.com/nicolaiarocci/cerberus/issues/240.
-        for key in tuple(data):
-            if self.schema.get(key, {}).get('readonly'):
-                del data[key]
+        for key in self.compiled.readonly.intersection(data):
+            del data[key]
 
     def validate(self, data, instance=None, **kwargs):
         self.instance = instance
@@ -73,6 +173,8 @@ class ResourceValidator(Validator):
     def save(self):
         if self.errors:
             raise ValidationError('Invalid document')
+        if context.get('dry_run'):
+            return self.dry_save()
         database = self.model._meta.database
         if self.instance:
             with database.atomic():
@@ -94,6 +196,23 @@ class ResourceValidator(Validator):
                     setattr(self.instance, key, value)
         return self.instance
 
+    def dry_save(self):
+        """Build the instance as save would, without writing anything."""
+        if self.instance:
+            self.patch()
+        else:
+            data = {k: v for k, v in self.document.items()
+                    if not isinstance(getattr(self.model, k),
+                                      db.ManyToManyField)}
+            self.instance = self.model(**data)
+            if context.get('dry_run'):
+                # Let the rows referencing it resolve, as after a real save.
+                keys = [('{}.{}'.format(self.model.__name__, name), value)
+                        for name, value in data.items()
+                        if name in self.model.identifiers + ['id'] and value]
+                self.instance.pk = lookups.reserve(keys)
+        return self.instance
+
 
 class VersionedResourceValidator(ResourceValidator):
 
@@ -103,13 +222,13 @@ class VersionedResourceValidator(ResourceValidator):
         claimed_version = max(1, self.document.get('version', 1))
         current_version = self.instance.version if self.instance else 0
         if self.instance and claimed_version <= current_version > 1:
-            base = self.instance.load_version(claimed_version - 1)
-            current = self.instance.load_version(current_version)
-            diff = make_diff(base.data, current.data)
+            base = self.instance.load_version_data(claimed_version - 1)
+            current = self.instance.load_version_data(current_version)
+            diff = make_diff(base, current)
             # Those are keys changed between that last know version of the
             # client and the current version we have.
             protected = diff.keys()
-            diff = make_diff(base.data, self.document,
+            diff = make_diff(base, self.document,
                              update=self.update)
             conflict = any(k in protected for k in diff.keys())
             if not conflict:
@@ -1,5 +1,9 @@
+from collections import OrderedDict
 from datetime import datetime
+from functools import partial
 import json
+import threading
+import time
 
 import decorator
 import peewee
@@ -9,7 +13,7 @@ from ban.auth.models import Client, Session
 from ban.core.encoder import dumps
 from ban.utils import make_diff, utcnow
 
-from . import context
+from . import context, metrics
 
 
 @decorator.decorator
@@ -33,6 +37,52 @@ class ForcedVersionError(Exception):
     pass
 
 
+class VersionCache:
+    """Bounded LRU of recently written versions raw data.
+
+    Keys are (model_name, model_pk, sequential). Versions are only cached
+    once their transaction is committed (see Versioned.cache_version): a
+    committed version never changes its data (only its period gets closed),
+    so entries never need to be invalidated, only evicted."""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def set(self, model_name, model_pk, sequential, raw):
+        key = (model_name, model_pk, sequential)
+        with self._lock:
+            self._data[key] = raw
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def update(self, rows):
+        """Set each of `rows`, as inserted in the Version table."""
+        for row in rows:
+            self.set(row['model_name'], row['model_pk'], row['sequential'],
+                     row['raw'])
+
+    def get(self, model_name, model_pk, sequential):
+        key = (model_name, model_pk, sequential)
+        with self._lock:
+            try:
+                raw = self._data[key]
+            except KeyError:
+                return None
+            self._data.move_to_end(key)
+        # Always return a fresh dict, so callers can't alter the cache.
+        return json.loads(raw)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
 class BaseVersioned(peewee.BaseModel):
 
     registry = {}
@@ -65,18 +115,22 @@ class Versioned(db.Model, metaclass=BaseVersioned):
         super().__init__(*args, **kwargs)
         self.prepared()
 
+    @metrics.timed('version')
     def store_version(self):
+        # Same text as the copy engine (see staging.version_json).
+        raw = dumps(self.as_version, ensure_ascii=False)
         new = Version.create(
             model_name=self.__class__.__name__,
             model_pk=self.pk,
             sequential=self.version,
-            raw=dumps(self.as_version)
+            raw=raw
         )
+        self.cache_version(new.sequential, raw)
         old = None
         if self.version > 1:
             old = self.load_version(self.version - 1)
             old.close_period(new.period.lower)
-        if Diff.ACTIVE:
+        if Diff.active():
             Diff.create(old=old, new=new, created_at=self.modified_at)
 
     @property
@@ -95,6 +149,27 @@ class Versioned(db.Model, metaclass=BaseVersioned):
             qs = qs.where(Version.sequential == ref)
         return qs.first()
 
+    def load_version_data(self, sequential):
+        """Return data of version `sequential`, hitting the db only if this
+        version is not in the cache."""
+        name = self.__class__.__name__
+        data = Version.cache.get(name, self.pk, sequential)
+        if data is None:
+            version = self.load_version(sequential)
+            if not version:
+                return None
+            self.cache_version(sequential, version.raw)
+            data = version.data
+        return data
+
+    def cache_version(self, sequential, raw):
+        """Cache version `sequential` data once the current transaction is
+        committed: a rolled back one must not be used for later diffs and
+        conflicts resolution."""
+        self._meta.database.on_commit(partial(
+            Version.cache.set, self.__class__.__name__, self.pk, sequential,
+            raw))
+
     @property
     def locked_version(self):
         return getattr(self, '_locked_version', None)
@@ -136,7 +211,8 @@ class Versioned(db.Model, metaclass=BaseVersioned):
         with self._meta.database.atomic():
             self.check_version()
             self.update_meta()
-            super().save(*args, **kwargs)
+            with metrics.stage('save'):
+                super().save(*args, **kwargs)
             self.store_version()
             self.lock_version()
 
@@ -156,6 +232,10 @@ class SelectQuery(db.SelectQuery):
 
 
 class Version(db.Model):
+
+    # Shared by all threads of the process.
+    cache = VersionCache()
+
     model_name = db.CharField(max_length=64)
     model_pk = db.IntegerField()
     sequential = db.IntegerField()
@@ -178,11 +258,31 @@ class Version(db.Model):
 
     @property
     def as_resource(self):
+        flags = getattr(self, '_prefetched_flags', None)
+        if flags is None:
+            flags = list(self.flags.as_resource())
+        else:
+            flags = [flag.as_resource for flag in flags]
         return {
             'data': self.data,
-            'flags': list(self.flags.as_resource())
+            'flags': flags
         }
 
+    @classmethod
+    def prefetch_flags(cls, versions):
+        """Attach flags, with their client, to each version in one query."""
+        versions = list(versions)
+        by_pk = {}
+        for version in versions:
+            version._prefetched_flags = []
+            by_pk[version.pk] = version
+        if by_pk:
+            qs = (Flag.select(Flag, Client).join(Client)
+                      .where(Flag.version << list(by_pk)).order_by(Flag.pk))
+            for flag in qs:
+                by_pk[flag._data['version']]._prefetched_flags.append(flag)
+        return versions
+
     @property
     def model(self):
         return BaseVersioned.registry[self.model_name]
@@ -236,6 +336,12 @@ class Diff(db.Model):
         manager = SelectQuery
         order_by = ('pk', )
 
+    @classmethod
+    def active(cls):
+        """Whether to create diffs, not in a nodiff command run by the current
+        thread (see ban.commands.helpers.nodiff)."""
+        return cls.ACTIVE and not context.get('nodiff')
+
     def save(self, *args, **kwargs):
         if not self.diff:
             old = self.old.data if self.old else {}
@@ -258,41 +364,195 @@ class Diff(db.Model):
         }
 
 
+class RedirectCache:
+    """Bounded LRU of resolved redirects, including misses.
+
+    Keys are (model_name, identifier, old), values are the new identifier
+    value, or None when there is no redirect. Entries are dropped as soon as
+    a diff touches them in this process, and expire after `ttl` seconds.
+
+    The cache is per process and nothing invalidates it across processes:
+    when another process (API worker or command) writes redirects, this one
+    may keep answering from its cache for up to `ttl` seconds. A lookup by
+    an old identifier may then still fail (cached miss), or resolve to an
+    intermediate target of a chain that has been refreshed since."""
+
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # (model_name, identifier, new) => keys pointing to it.
+        self._targets = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return cached value or raise KeyError."""
+        with self._lock:
+            value, expires = self._data[key]
+            if expires < time.monotonic():
+                self._remove(key)
+                raise KeyError(key)
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            if value is not None:
+                target = key[:2] + (value, )
+                self._targets.setdefault(target, set()).add(key)
+            while len(self._data) > self.size:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, model_name, identifier, values):
+        """Forget redirects from or to any of `values`."""
+        with self._lock:
+            for value in values:
+                self._remove((model_name, identifier, value))
+                target = (model_name, identifier, value)
+                for key in list(self._targets.get(target, [])):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._targets.clear()
+
+    def _remove(self, key):
+        try:
+            value, _ = self._data.pop(key)
+        except KeyError:
+            return
+        if value is not None:
+            target = key[:2] + (value, )
+            keys = self._targets.get(target)
+            keys.discard(key)
+            if not keys:
+                del self._targets[target]
+
+
 class IdentifierRedirect(db.Model):
     model_name = peewee.CharField(max_length=64)
     identifier = peewee.CharField(max_length=64)
     old = peewee.CharField(max_length=255)
     new = peewee.CharField(max_length=255)
 
+    # Shared by all threads of the process.
+    cache = RedirectCache()
+
+    class Meta:
+        indexes = (
+            (('model_name', 'identifier', 'old'), False),
+            (('model_name', 'identifier', 'new'), False),
+        )
+
     @classmethod
     def from_diff(cls, diff):
-        if not diff.new or not diff.old:
-            # Only update makes sense for us, no creation nor deletion.
-            return
-        model = diff.new.model
-        identifiers = [i for i in model.identifiers if i in diff.diff]
-        for identifier in identifiers:
-            old = diff.diff[identifier]['old']
-            new = diff.diff[identifier]['new']
-            if not old or not new:
+        cls.from_diffs([diff])
+
+    @classmethod
+    def from_diffs(cls, diffs):
+        """Create and refresh redirects for a batch of diffs, with a couple of
+        queries per (model, identifier) instead of a few per change."""
+        changes = {}
+        for diff in diffs:
+            if not diff.new or not diff.old:
+                # Only update makes sense for us, no creation nor deletion.
                 continue
-            cls.get_or_create(model_name=diff.new.model_name,
-                              identifier=identifier, old=old, new=new)
-            cls.refresh(model, identifier, old, new)
+            model = diff.new.model
+            for identifier in model.identifiers:
+                if identifier not in diff.diff:
+                    continue
+                old = diff.diff[identifier]['old']
+                new = diff.diff[identifier]['new']
+                if not old or not new:
+                    continue
+                key = (diff.new.model_name, identifier)
+                changes.setdefault(key, []).append((old, new))
+        for (model_name, identifier), pairs in changes.items():
+            targets = cls.resolve_chains(pairs)
+            with cls._meta.database.atomic():
+                cls.bulk_refresh(model_name, identifier, targets)
+                cls.bulk_create(model_name, identifier, targets)
+            cls.cache.invalidate(model_name, identifier, targets.keys())
+
+    @staticmethod
+    def resolve_chains(pairs):
+        """Apply (old, new) changes in order, so that every old value points
+        to its final target, as successive refresh calls would do."""
+        targets = {}
+        # Reverse mapping: target => sources pointing to it.
+        sources = {}
+        for old, new in pairs:
+            if old in targets:
+                sources.get(targets[old], set()).discard(old)
+            moved = sources.pop(old, set())
+            moved.add(old)
+            for source in moved:
+                targets[source] = new
+            sources.setdefault(new, set()).update(moved)
+        return targets
+
+    @classmethod
+    def _values(cls, targets):
+        values = ', '.join(['(%s, %s)'] * len(targets))
+        params = [v for pair in targets.items() for v in pair]
+        return values, params
+
+    @classmethod
+    def bulk_refresh(cls, model_name, identifier, targets):
+        """Targets that become themselves sources now point to the final
+        target."""
+        values, params = cls._values(targets)
+        sql = ('UPDATE "{table}" SET "new" = targets.new '
+               'FROM (VALUES {values}) AS targets (old, new) '
+               'WHERE "{table}"."model_name" = %s '
+               'AND "{table}"."identifier" = %s '
+               'AND "{table}"."new" = targets.old').format(
+                   table=cls._meta.db_table, values=values)
+        cls._meta.database.execute_sql(sql, params + [model_name, identifier])
+
+    @classmethod
+    def bulk_create(cls, model_name, identifier, targets):
+        values, params = cls._values(targets)
+        sql = ('INSERT INTO "{table}" ("model_name", "identifier", "old", '
+               '"new") SELECT %s, %s, targets.old, targets.new '
+               'FROM (VALUES {values}) AS targets (old, new) '
+               'WHERE NOT EXISTS (SELECT 1 FROM "{table}" '
+               'WHERE "{table}"."model_name" = %s '
+               'AND "{table}"."identifier" = %s '
+               'AND "{table}"."old" = targets.old '
+               'AND "{table}"."new" = targets.new)').format(
+                   table=cls._meta.db_table, values=values)
+        params = [model_name, identifier] + params + [model_name, identifier]
+        cls._meta.database.execute_sql(sql, params)
 
     @classmethod
     def follow(cls, model, identifier, old):
+        """Return the new value of `old`, or None. May be stale for up to
+        `cache.ttl` seconds after another process wrote redirects (see
+        RedirectCache)."""
+        key = (model.__name__, identifier, old)
+        try:
+            return cls.cache.get(key)
+        except KeyError:
+            pass
         row = cls.select().where(cls.model_name == model.__name__,
                                  cls.identifier == identifier,
                                  cls.old == old).first()
-        return row.new if row else None
+        new = row.new if row else None
+        cls.cache.set(key, new)
+        return new
 
     @classmethod
     def refresh(cls, model, identifier, old, new):
         """An identifier was a target and it becomes itself a target."""
-        cls.update(new=new).where(cls.new == old,
-                                  cls.model_name == model.__name__,
-                                  cls.identifier == identifier).execute()
+        cls.bulk_refresh(model.__name__, identifier, {old: new})
+        cls.cache.invalidate(model.__name__, identifier, [old])
 
 
 class Flag(db.Model):
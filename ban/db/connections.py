@@ -1,15 +1,47 @@
+import threading
+
+import peewee
 from playhouse.postgres_ext import PostgresqlExtDatabase
 from ban.core import config
 import postgis
 
 
+class savepoint(peewee.savepoint):
+    """Savepoint scoping the transaction callbacks registered within it: the
+    rollback ones are run if it is rolled back, the others are handed to the
+    enclosing block once it is released."""
+
+    def __enter__(self):
+        super().__enter__()
+        self.db.callbacks.append([])
+        return self
+
+    def rollback(self):
+        super().rollback()
+        frame = self.db.callbacks[-1]
+        self.db.run_callbacks(frame, committed=False)
+        del frame[:]
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            return super().__exit__(exc_type, exc_val, exc_tb)
+        finally:
+            callbacks = self.db.callbacks
+            # A commit in the meantime has already run them all.
+            if len(callbacks) > 1:
+                callbacks[-2].extend(callbacks.pop())
+
+
 class DB(PostgresqlExtDatabase):
 
     prefix = ''
     postgis_registered = False
+    # Connections of the parent process, see forget_connection.
+    _inherited = []
 
     def __init__(self):
         super().__init__(self.prefix + config.DB_NAME, autorollback=True)
+        self._callbacks = threading.local()
 
     def connect(self):
         # Deal with connection kwargs at connect time only, because we want
@@ -25,6 +57,63 @@ class DB(PostgresqlExtDatabase):
         )
         super().connect()
 
+    @property
+    def callbacks(self):
+        """(on commit, on rollback) callbacks of the current thread, one list
+        per open savepoint on top of the transaction one."""
+        if not hasattr(self._callbacks, 'stack'):
+            self._callbacks.stack = [[]]
+        return self._callbacks.stack
+
+    def on_commit(self, callback):
+        """Call `callback` once the current transaction is committed (right
+        away outside of a transaction), never if it is rolled back."""
+        if not self.transaction_depth():
+            callback()
+        else:
+            self.callbacks[-1].append((callback, None))
+
+    def on_rollback(self, callback):
+        """Call `callback` if what has been written so far in the current
+        transaction or savepoint is rolled back."""
+        if self.transaction_depth():
+            self.callbacks[-1].append((None, callback))
+
+    @staticmethod
+    def run_callbacks(frame, committed):
+        # Undo in reverse order.
+        pairs = frame if committed else reversed(frame)
+        for callback in (pair[0 if committed else 1] for pair in pairs):
+            if callback:
+                callback()
+
+    def _end(self, committed):
+        frame = [pair for frame in self.callbacks for pair in frame]
+        self._callbacks.stack = [[]]
+        self.run_callbacks(frame, committed)
+
+    def commit(self):
+        super().commit()
+        self._end(committed=True)
+
+    def rollback(self):
+        super().rollback()
+        self._end(committed=False)
+
+    def savepoint(self, sid=None):
+        return savepoint(self, sid)
+
+    def forget_connection(self):
+        """Drop the connection state inherited by a forked process, so that
+        it opens its own connection on next query.
+
+        The inherited connection is not closed, nor garbage collected (which
+        would close it too): its socket is still the parent process one."""
+        self._inherited.append(self._local.conn)
+        self._local = peewee._ConnectionLocal()
+        self._conn_lock = threading.Lock()
+        self._callbacks = threading.local()
+
     def initialize_connection(self, conn):
         if not self.postgis_registered:
             postgis.register(conn.cursor())
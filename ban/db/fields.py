@@ -107,8 +107,8 @@ class ForeignKeyField(peewee.ForeignKeyField):
         elif isinstance(value, dict):
             # We have a resource dict.
             value = value['id']
-        if isinstance(value, str) and hasattr(self.rel_model, 'coerce'):
-            value = self.rel_model.coerce(value).pk
+        if isinstance(value, str) and hasattr(self.rel_model, 'coerce_pk'):
+            value = self.rel_model.coerce_pk(value)
         return super().coerce(value)
 
     def _get_related_name(self):
@@ -1,21 +1,135 @@
 """Expose some commands as API endpoints"""
+import json
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from io import StringIO
+
+import falcon
+
 from ban.commands.bal import bal
-from ban.core import context
+from ban.core import config, context, jobs
+from ban.core.encoder import dumps
 
 from .wsgi import app
 from .auth import auth
 
+# Commands that can be run as jobs, fed with the job payload.
+COMMANDS = {
+    'bal': bal,
+}
+executor = None
+# Seconds between two looks for pending jobs.
+POLL_DELAY = 5
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=workers())
+    return executor
+
+
+def workers():
+    return int(config.get('JOB_WORKERS', 2))
+
+
+def enqueue(job):
+    """Run `job` in the background workers pool."""
+    return get_executor().submit(run_job, job.pk)
+
+
+def run_job(pk):
+    job = jobs.Job.get(jobs.Job.pk == pk)
+    if job.claim():
+        run(job)
+    else:
+        jobs.Job._meta.database.close()
+
+
+def run(job):
+    context.set('session', job.session)
+    context.set('progress', job.set_progress)
+    try:
+        COMMANDS[job.command](StringIO(job.payload))
+    except Exception:
+        job.fail(traceback.format_exc())
+    else:
+        # Commands set their own reporter.
+        job.finish(json.loads(dumps(context.get('reporter'))))
+    finally:
+        context.set('session', None)
+        context.set('progress', None)
+        # Do not leak one connection per worker thread.
+        jobs.Job._meta.database.close()
+
+
+def drain():
+    """Claim and run pending jobs, until there is none left."""
+    while True:
+        job = jobs.Job.claim_next()
+        if job is None:
+            jobs.Job._meta.database.close()
+            return
+        run(job)
+
+
+def run_pending():
+    """Requeue the stale jobs, then have each worker run the pending ones.
+
+    Return the workers futures."""
+    jobs.Job.requeue_stale()
+    return [get_executor().submit(drain) for _ in range(workers())]
+
+
+def poll(delay=POLL_DELAY):
+    """Run the jobs left pending (eg. by a restart), forever."""
+    while True:
+        wait(run_pending())
+        time.sleep(delay)
+
+
+def start_polling(delay=POLL_DELAY):
+    """Poll for pending jobs in a background thread."""
+    thread = threading.Thread(target=poll, args=(delay,), daemon=True)
+    thread.start()
+    return thread
+
 
 class Import:
 
     @auth.protect
     @app.endpoint(path='/bal')
     def on_post_bal(self, req, resp, *args, **kwargs):
-        """Import file at BAL format."""
+        """Import file at BAL format, in the background.
+
+        Return the created job, see /job/{id} for its progress and report."""
         data = req.get_param('data', required=True)
-        bal(StringIO(data.value.decode('utf-8-sig')))
-        reporter = context.get('reporter')
-        resp.json(report=reporter)
+        payload = data.value.decode('utf-8-sig')
+        # Minus the header.
+        total = sum(1 for line in payload.splitlines() if line.strip()) - 1
+        job = jobs.Job.create(command='bal', payload=payload,
+                              session=context.get('session'),
+                              total=max(total, 0))
+        enqueue(job)
+        resp.status = falcon.HTTP_ACCEPTED
+        resp.json(**job.as_resource)
+
+
+class Job:
+
+    @auth.protect
+    @app.endpoint(path='/{identifier}')
+    def on_get_resource(self, req, resp, identifier, **kwargs):
+        """Get job with 'identifier': status, progress and report."""
+        try:
+            job = jobs.Job.get(jobs.Job.id == uuid.UUID(identifier))
+        except (ValueError, jobs.Job.DoesNotExist):
+            raise falcon.HTTPNotFound()
+        resp.json(**job.as_resource)
+
 
 app.register_resource(Import())
+app.register_resource(Job())
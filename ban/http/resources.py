@@ -6,7 +6,7 @@ import falcon
 import peewee
 from dateutil.parser import parse as date_parse
 
-from ban.core import models
+from ban.core import models, versioning
 from ban.auth import models as amodels
 
 from .wsgi import app
@@ -30,13 +30,15 @@ class BaseCollection:
         except (ValueError, TypeError):
             return 0
 
-    def collection(self, req, resp, queryset):
+    def collection(self, req, resp, queryset, serializer=list):
+        """serializer   callable receiving the page items and returning the
+                     list to be rendered."""
         limit = self.get_limit(req)
         offset = self.get_offset(req)
         end = offset + limit
         count = len(queryset)
         kwargs = {
-            'collection': list(queryset[offset:end]),
+            'collection': serializer(queryset[offset:end]),
             'total': count,
         }
         url = '{}://{}{}'.format(req.protocol, req.host, req.path)
@@ -194,7 +196,15 @@ class VersionnedResource(BaseCRUD):
     def on_get_versions(self, req, resp, *args, **kwargs):
         """Get resource versions."""
         instance = self.get_object(**kwargs)
-        self.collection(req, resp, instance.versions.as_resource())
+        self.collection(req, resp, instance.versions,
+                        serializer=self.serialize_versions)
+
+    @staticmethod
+    def serialize_versions(versions):
+        # Avoid one query per version for the flags, and one per flag for the
+        # client.
+        versions = versioning.Version.prefetch_flags(versions)
+        return [version.as_resource for version in versions]
 
     @auth.protect
     @app.endpoint('/{identifier}/versions/{ref}')
@@ -1,15 +1,38 @@
+import bz2
+import gzip
 import json
 from pathlib import Path
+import threading
+
+import pytest
 
 from ban.auth import models as amodels
 from ban.commands.auth import createuser, listusers, createclient, listclients
-from ban.commands.db import truncate
+from ban.commands.bench import generate, reset_database
+from ban.commands import db as db_commands
+from ban.commands.db import rebuild_diffs, truncate
 from ban.commands.export import resources
-from ban.commands.importer import municipalities
-from ban.core import models
+from ban.commands import helpers, reporter as reporter_
+from ban.commands.helpers import (batch, byte_ranges, Checkpoint, LineReader,
+                                  load_csv)
+from ban.commands.importer import add_municipality, municipalities
+from ban.commands.init import init
+from ban.commands.oldban import add_housenumbers, cea
+from ban.commands.sna import open_hexa, sna, HSV7, HSW4
+from ban.core import context, lookups, metrics, models
 from ban.core.encoder import dumps
-from ban.core.versioning import Diff
+from ban.core.versioning import Diff, IdentifierRedirect, Version
 from ban.tests import factories
+from ban.utils import compute_cia
+
+
+def test_create_adds_missing_indexes_to_existing_tables(session):
+    database = IdentifierRedirect._meta.database
+    index = 'identifierredirect_model_name_identifier_new'
+    database.execute_sql('DROP INDEX "{}"'.format(index))
+    db_commands.create(fail_silently=True)
+    indexes = database.get_indexes(IdentifierRedirect._meta.db_table)
+    assert index in [i.name for i in indexes]
 
 
 def test_import_municipalities(staff, config):
@@ -26,6 +49,249 @@ def test_import_municipalities_can_be_filtered_by_departement(staff, config):
     assert not len(Diff.select())
 
 
+def test_import_municipalities_dry_run_writes_nothing(staff, config):
+    path = Path(__file__).parent / 'data/municipalities.csv'
+    municipalities(path, dry_run=True)
+    assert not len(models.Municipality.select())
+    assert not context.get('dry_run')
+
+
+def test_import_municipalities_upsert_only_writes_changes(staff, config):
+    path = Path(__file__).parent / 'data/municipalities.csv'
+    changed = factories.MunicipalityFactory(insee='33236', name='Lège',
+                                            siren='213302367')
+    unchanged = factories.MunicipalityFactory(insee='01056',
+                                              name='Boyeux-Saint-Jérôme',
+                                              siren='210100566')
+    municipalities(path, upsert=True, update=True)
+    assert len(models.Municipality.select()) == 4
+    changed = models.Municipality.get(pk=changed.pk)
+    assert changed.name == 'Lège-Cap-Ferret'
+    assert changed.version == 2
+    assert changed.load_version().data == json.loads(
+        dumps(changed.as_version))
+    assert models.Municipality.get(pk=unchanged.pk).version == 1
+    assert context.get('reporter').totals['notice'] == {'Processed': 3,
+                                                        'Unchanged': 1}
+    municipalities(path, upsert=True, update=True)
+    assert context.get('reporter').totals['notice'] == {'Unchanged': 4}
+
+
+def test_import_municipalities_upsert_keeps_existing_without_update(staff,
+                                                                    config):
+    path = Path(__file__).parent / 'data/municipalities.csv'
+    existing = factories.MunicipalityFactory(insee='33236', name='Lège',
+                                             siren='213302367')
+    municipalities(path, upsert=True)
+    assert len(models.Municipality.select()) == 4
+    existing = models.Municipality.get(pk=existing.pk)
+    assert existing.name == 'Lège'
+    assert existing.version == 1
+    totals = context.get('reporter').totals
+    assert totals['notice'] == {'Processed': 3}
+    assert totals['warning'] == {'Existing': 1}
+
+
+def test_dry_run_reports_like_a_real_run(staff, config):
+    config.VERBOSE = 3
+    context.set('dry_run', True)
+    rows = [{'insee': '33001', 'nom_com': 'Abzac', 'siren_com': '213300015'},
+            {'insee': '33002', 'nom_com': '', 'siren_com': '213300023'}]
+    try:
+        reports = helpers.collect_report(helpers.process_chunk,
+                                         add_municipality, rows)
+    finally:
+        context.set('dry_run', None)
+    assert len(reports[3]['Processed']) == 1
+    assert len(reports[1]['Error']) == 1
+    assert not len(models.Municipality.select())
+
+
+def test_import_sna_postcodes_in_bulk(staff, config):
+    for insee in ['32468', '33001', '61403']:
+        factories.MunicipalityFactory(insee=insee)
+    sna(Path(__file__).parent / 'data/ignsna', postcode=True)
+    postcodes = models.PostCode.select()
+    assert sorted(p.code for p in postcodes) == ['32140', '33230', '33440']
+    for postcode in postcodes:
+        assert postcode.load_version().data == json.loads(
+            dumps(postcode.as_version))
+    totals = context.get('reporter').totals
+    assert totals['warning']['Already created'] == 1
+    assert totals['error']['PostCode Error'] == 3
+
+
+def hexa(layout, rows):
+    """Fixed-width lines of `rows` ({column: value}) in `layout`."""
+    lines = []
+    for row in rows:
+        line = [' '] * 100
+        for name, value in row.items():
+            start = layout.columns[name][0]
+            line[start:start + len(value)] = value
+        lines.append(''.join(line))
+    return '\n'.join(lines) + '\n'
+
+
+def test_open_hexa_reads_compressed_files(tmpdir):
+    path = tmpdir.join('hsv7aaaa.ai')
+    path.write_binary(gzip.compress(hexa(HSV7, [
+        {'kind': 'V', 'insee': '33001', 'matricule': '00000001',
+         'name': "RUE DE L'ÉGLISE"},
+    ]).encode('latin1')))
+    with open_hexa(str(path)) as f:
+        columns = next(HSV7.read(f))
+    assert columns['name'][0].strip() == "RUE DE L'ÉGLISE"
+
+
+def test_import_sna_groups_and_housenumbers_in_bulk(staff, config, tmpdir):
+    municipality = factories.MunicipalityFactory(insee='33001')
+    tmpdir.join('hsv7aaaa.ai').write_text(hexa(HSV7, [
+        {'kind': 'V', 'insee': '33001', 'matricule': '00000001',
+         'name': 'RUE DES LILAS'},
+        {'kind': 'V', 'insee': '33001', 'matricule': '00000002',
+         'name': 'LES HAUTS', 'group_kind': 'LD'},
+    ]), encoding='latin1')
+    tmpdir.join('hsw4aaaa.ai').write_text(hexa(HSW4, [
+        {'matricule': '00000001', 'laposte': '33001A0001'},
+        {'matricule': '00000002', 'laposte': '33001A0002'},
+        {'matricule': '00000001', 'number': '1', 'laposte': '33001A0011'},
+        {'matricule': '00000001', 'number': '1', 'ordinal': 'bis',
+         'laposte': '33001A0012'},
+        {'matricule': '00000002', 'number': '3', 'laposte': '33001A0013'},
+        {'matricule': '00000002', 'number': '4', 'laposte': '33001A0013'},
+    ]), encoding='latin1')
+    sna(str(tmpdir), group=True)
+    street = models.Group.get(models.Group.laposte == '33001A0001')
+    area = models.Group.get(models.Group.laposte == '33001A0002')
+    assert street.kind == models.Group.WAY
+    assert area.kind == models.Group.AREA
+    assert street.municipality == municipality
+    sna(str(tmpdir), housenumber=True)
+    housenumbers = models.HouseNumber.select().order_by(
+        models.HouseNumber.laposte)
+    assert [(h.laposte, h.parent.pk) for h in housenumbers] == [
+        ('33001A0011', street.pk), ('33001A0012', street.pk),
+        ('33001A0013', area.pk)]
+    for housenumber in housenumbers:
+        assert housenumber.cia == compute_cia(
+            '33001', housenumber.parent.get_fantoir(), housenumber.number,
+            housenumber.ordinal)
+        assert housenumber.load_version().data == json.loads(
+            dumps(housenumber.as_version))
+    totals = context.get('reporter').totals
+    assert totals['error']['Duplicate CEA'] == 1
+    assert totals['notice']['Not a housenumber'] == 2
+
+
+def test_import_sna_only_rejects_housenumbers_breaking_a_constraint(
+        staff, config, tmpdir):
+    config.VERBOSE = 3
+    factories.MunicipalityFactory(insee='33001')
+    tmpdir.join('hsv7aaaa.ai').write_text(hexa(HSV7, [
+        {'kind': 'V', 'insee': '33001', 'matricule': '00000001',
+         'name': 'RUE DES LILAS'},
+    ]), encoding='latin1')
+    tmpdir.join('hsw4aaaa.ai').write_text(hexa(HSW4, [
+        {'matricule': '00000001', 'laposte': '33001A0001'},
+        {'matricule': '00000001', 'number': '1', 'laposte': '33001A0011'},
+        # Same parent, number and ordinal: only the database knows.
+        {'matricule': '00000001', 'number': '1', 'laposte': '33001A0012'},
+        {'matricule': '00000001', 'number': '2', 'laposte': '33001A0013'},
+    ]), encoding='latin1')
+    sna(str(tmpdir), group=True, housenumber=True)
+    assert [h.laposte for h in models.HouseNumber.select().order_by(
+        models.HouseNumber.laposte)] == ['33001A0011', '33001A0013']
+    reports = context.get('reporter')._reports
+    errors = reports[reporter_.ERROR]['Housenumber error']
+    assert [detail for error, detail in errors] == ['33001A0012']
+
+
+def test_bench_generate_is_reproducible_and_importable(tmpdir, staff):
+    generate(str(tmpdir / 'one'), size=100, seed=3)
+    generate(str(tmpdir / 'two'), size=100, seed=3, formats=['init'])
+    first, second = tmpdir / 'one/init.json', tmpdir / 'two/init.json'
+    assert first.read() == second.read()
+    manifest = json.loads((tmpdir / 'one/manifest.json').read())
+    assert manifest['rows']['ign_housenumber'] == 100
+    assert manifest['rows']['bal'] == 100 + manifest['rows']['oldban']
+    init(str(tmpdir / 'one/init.json'))
+    assert models.Municipality.select().count() == manifest['municipalities']
+    assert models.HouseNumber.select().count() == 100
+    assert models.Position.select().count() == 100
+
+
+def test_bench_reset_database_creates_session_and_municipalities(tmpdir):
+    generate(str(tmpdir), size=10, seed=3, formats=['init'])
+    manifest = json.loads((tmpdir / 'manifest.json').read())
+    factories.MunicipalityFactory()
+    session = reset_database(manifest, with_municipalities=True)
+    assert session.user.is_staff
+    municipalities = models.Municipality.select()
+    assert len(municipalities) == manifest['municipalities']
+    for municipality in municipalities:
+        assert municipality.created_by == session
+        assert municipality.load_version().data == json.loads(
+            dumps(municipality.as_version))
+
+
+def test_oldban_creates_housenumbers_of_a_group_in_bulk(session, reporter):
+    group = factories.GroupFactory()
+    add_housenumbers(group, {
+        '1': {'lon': 1, 'lat': 2, 'id': 'ADRNIVX_1'},
+        '1 bis': {'lon': 1.1, 'lat': 2.1, 'id': 'ADRNIVX_2'},
+        '2': {'lon': 1.2, 'lat': 2.2, 'id': 'ADRNIVX_1'},
+    }, None)
+    housenumbers = models.HouseNumber.select().order_by(models.HouseNumber.pk)
+    assert [(h.number, h.ordinal) for h in housenumbers] == [('1', ''),
+                                                           ('1', 'bis')]
+    for housenumber in housenumbers:
+        assert housenumber.cia == housenumber.compute_cia()
+        position = housenumber.positions.get()
+        assert position.load_version().data == json.loads(
+            dumps(position.as_version))
+    assert reporter.totals['error']['Duplicate housenumber'] == 1
+
+
+def test_import_cea_updates_housenumbers_and_their_versions(staff, config,
+                                                            tmpdir):
+    housenumber = factories.HouseNumberFactory(ign='ADRNIVX_1')
+    factories.HouseNumberFactory(ign='ADRNIVX_2', laposte='33001223T2')
+    factories.HouseNumberFactory(ign='ADRNIVX_3')
+    path = tmpdir.join('cea.csv')
+    path.write('ID_ADR;HEXACLE_1\n'
+               'ADRNIVX_1;33001223T1\n'
+               'ADRNIVX_3;33001223T2\n'
+               'ADRNIVX_4;33001223T4\n'
+               'ADRNIVX_5;NR\n')
+    cea(str(path))
+    housenumber = models.HouseNumber.get(pk=housenumber.pk)
+    assert housenumber.laposte == '33001223T1'
+    assert housenumber.version == 2
+    assert housenumber.load_version().data == json.loads(
+        dumps(housenumber.as_version))
+    assert housenumber.load_version(1).period.upper
+    totals = context.get('reporter').totals
+    assert totals['error'] == {'Duplicate CEA': 1, 'IGN id not found': 1,
+                               'Missing CEA': 1}
+
+
+def test_import_cea_dry_run_leaves_nothing_in_database(staff, config,
+                                                       tmpdir):
+    housenumber = factories.HouseNumberFactory(ign='ADRNIVX_1')
+    path = tmpdir.join('cea.csv')
+    path.write('ID_ADR;HEXACLE_1\n'
+               'ADRNIVX_1;33001223T1\n')
+    database = models.HouseNumber._meta.database
+    tables = database.get_tables()
+    cea(str(path), dry_run=True)
+    housenumber = models.HouseNumber.get(pk=housenumber.pk)
+    assert housenumber.laposte != '33001223T1'
+    assert housenumber.version == 1
+    assert database.get_tables() == tables
+    assert context.get('reporter').totals['notice'] == {'Done': 1}
+
+
 def test_create_user_is_not_staff_by_default(monkeypatch):
     monkeypatch.setattr('ban.commands.helpers.prompt', lambda *x, **wk: 'pwd')
     assert not amodels.User.select().count()
@@ -127,3 +393,286 @@ def test_export_resources():
         # Plus, JSON transform internals tuples to lists.
         assert json.loads(lines[2]) == json.loads(dumps(hn.as_relation))
     path.unlink()
+
+
+def test_nodiff_only_applies_to_current_thread_and_is_restored():
+    seen = []
+
+    @helpers.nodiff
+    def command():
+        seen.append(Diff.active())
+        other = threading.Thread(target=lambda: seen.append(Diff.active()))
+        other.start()
+        other.join()
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        command()
+    assert seen == [False, True]
+    assert Diff.active()
+
+
+def test_rebuild_diffs():
+    Diff.ACTIVE = False
+    try:
+        municipality = factories.MunicipalityFactory(name='Moret-sur-Loing')
+        factories.GroupFactory(municipality=municipality)
+        municipality.name = 'Orvanne'
+        municipality.increment_version()
+        municipality.save()
+    finally:
+        Diff.ACTIVE = True
+    assert not Diff.select().count()
+    rebuild_diffs(force=True)
+    assert Diff.select().count() == Version.select().count() == 3
+    diffs = list(Diff.select())
+    # Increments follow versions creation order.
+    assert [d.new.period.lower for d in diffs] == sorted(
+        v.period.lower for v in Version.select())
+    creation = diffs[0]
+    assert creation.old is None
+    assert creation.diff['name'] == {'old': None, 'new': 'Moret-sur-Loing'}
+    update = diffs[-1]
+    assert update.old == municipality.load_version(1)
+    assert update.diff == {'name': {'old': 'Moret-sur-Loing',
+                                    'new': 'Orvanne'}}
+
+
+def test_rebuild_diffs_keeps_diffs_written_meanwhile(monkeypatch):
+    Diff.ACTIVE = False
+    try:
+        municipality = factories.MunicipalityFactory(name='Moret-sur-Loing')
+    finally:
+        Diff.ACTIVE = True
+    notice = reporter_.notice
+
+    def write_meanwhile(*args, **kwargs):
+        # Once diffs are rebuilt, before they replace the current ones.
+        if municipality.version == 1:
+            municipality.name = 'Orvanne'
+            municipality.increment_version()
+            municipality.save()
+        return notice(*args, **kwargs)
+
+    monkeypatch.setattr(reporter_, 'notice', write_meanwhile)
+    rebuild_diffs(force=True)
+    creation, update = Diff.select()
+    assert creation.old is None
+    assert creation.new == municipality.load_version(1)
+    assert update.pk > creation.pk
+    assert update.old == municipality.load_version(1)
+    assert update.diff == {'name': {'old': 'Moret-sur-Loing',
+                                    'new': 'Orvanne'}}
+
+
+def test_rebuild_diffs_keeps_current_diffs_if_it_fails(monkeypatch):
+    factories.MunicipalityFactory()
+    diffs = list(Diff.select().tuples())
+    assert diffs
+
+    def fail(database, rows):
+        raise ValueError('Rebuild failed')
+
+    monkeypatch.setattr(db_commands, 'insert_rebuilt', fail)
+    with pytest.raises(ValueError):
+        rebuild_diffs(force=True)
+    assert list(Diff.select().tuples()) == diffs
+    tables = Diff._meta.database.get_tables()
+    assert db_commands.REBUILD_TABLE not in tables
+    assert db_commands.REBUILT_TABLE not in tables
+
+
+def test_load_csv_streams_rows_and_tracks_bytes(tmpdir):
+    path = tmpdir.join('data.csv')
+    path.write('insee;name\n33001;Abzac\n33002;"Aillas; la belle"\n')
+    reader = load_csv(str(path))
+    assert reader.total == path.size()
+    assert reader.done == 0
+    rows = iter(reader)
+    assert next(rows) == {'insee': '33001', 'name': 'Abzac'}
+    assert next(rows) == {'insee': '33002', 'name': 'Aillas; la belle'}
+    assert reader.done == reader.total
+
+
+def report_item(item):
+    reporter_.notice('Processed', item)
+
+
+def test_batch_runs_one_task_per_chunk(config, reporter, monkeypatch):
+    config.VERBOSE = 3
+    reporter.verbosity = 3
+    config.WORKERS = 2
+    sizes = []
+    original = helpers.process_chunk
+
+    def process_chunk(func, chunk):
+        sizes.append(len(chunk))
+        original(func, chunk)
+
+    monkeypatch.setattr(helpers, 'process_chunk', process_chunk)
+    batch(report_item, range(1, 12), chunksize=3, progress=False)
+    assert sorted(sizes) == [2, 3, 3, 3]
+    assert sorted(reporter._reports[3]['Processed']) == list(range(1, 12))
+
+
+def test_batch_checkpoint_records_position_of_processed_rows(config, reporter,
+                                                             tmpdir):
+    config.VERBOSE = 3
+    reporter.verbosity = 3
+    path = tmpdir.join('data.json')
+    path.write(''.join('{}\n'.format(i) for i in range(1, 12)))
+    reader = LineReader(str(path), formatter=json.loads)
+    checkpoint = Checkpoint(str(path), every=0)
+    batch(report_item, reader, chunksize=3, progress=False,
+          checkpoint=checkpoint)
+    state = json.loads(tmpdir.join('data.json.checkpoint').read())
+    assert state['offset'] == path.size()
+    assert state['rows'] == 11
+    assert state['reports'] == {'notice': {'Processed': 11}}
+    # Resuming from a checkpoint reads the remaining lines only.
+    reader = LineReader(str(path), formatter=json.loads, start=16, rows=8)
+    assert list(reader) == [9, 10, 11]
+    assert reader.rows == 11
+
+
+def report_worker_state(item):
+    cache = lookups.active()
+    reporter_.notice('State', (context.get('session').pk,
+                               cache.get('Municipality.insee', '33001')))
+
+
+def test_batch_workers_get_main_session_and_lookups(session, config,
+                                                    reporter):
+    config.VERBOSE = 3
+    reporter.verbosity = 3
+    with lookups.activate() as cache:
+        cache.preload('Municipality.insee', {'33001': 12})
+        batch(report_worker_state, range(4), chunksize=1, progress=False)
+    assert reporter._reports[3]['State'] == [(session.pk, 12)] * 4
+    assert amodels.Session.select().count() == 1
+
+
+def test_batch_merges_workers_metrics_once_per_chunk(config, reporter):
+    config.WORKERS = 2
+    main = metrics.Metrics()
+    context.set('metrics', main)
+    try:
+        batch(report_item, range(1, 12), chunksize=3, progress=False)
+    finally:
+        context.set('metrics', None)
+    summary = main.__json__()
+    assert summary['rows'] == 11
+    assert sum(w['chunks'] for w in summary['workers'].values()) == 4
+    assert summary['stages']['commit']['count'] == 4
+
+
+def report_reporter(item):
+    reporter_.notice('Reporter', id(context.get('reporter')))
+
+
+def test_batch_workers_keep_their_reporter_for_the_whole_batch(config,
+                                                              reporter):
+    config.VERBOSE = 3
+    reporter.verbosity = 3
+    config.WORKERS = 2
+    batch(report_reporter, range(8), chunksize=1, progress=False)
+    # One reporter per worker thread, each chunk report merged only once.
+    assert len(set(reporter._reports[3]['Reporter'])) <= 2
+    assert reporter.totals['notice']['Reporter'] == 8
+
+
+def test_batch_streams_progress_once_per_chunk(config, reporter, tmpdir):
+    config.WORKERS = 2
+    path = tmpdir / 'progress.jsonl'
+    main = metrics.Metrics(progress=str(path))
+    context.set('metrics', main)
+    try:
+        batch(report_item, range(1, 12), chunksize=3, progress=False)
+    finally:
+        context.set('metrics', None)
+        main.close()
+    lines = [json.loads(l) for l in path.readlines()]
+    assert len(lines) == 4
+    assert [l['rows'] for l in lines] == sorted(l['rows'] for l in lines)
+    assert lines[-1]['rows'] == 11
+    assert lines[-1]['reports'] == {'notice': {'Processed': 11}}
+
+
+def test_reporter_keeps_exact_counts_and_a_bounded_sample(tmpdir):
+    path = str(tmpdir / 'reports.ndjson')
+    reporter = reporter_.Reporter(3, sample=10, spill=path)
+    for i in range(1000):
+        reporter('Processed', i, reporter_.NOTICE)
+    reporter('Error', 'one', reporter_.ERROR)
+    assert reporter.totals == {'notice': {'Processed': 1000},
+                               'error': {'Error': 1}}
+    sample = reporter._reports[3]['Processed']
+    assert len(sample) == 10
+    assert set(sample) <= set(range(1000))
+    reporter.close()
+    lines = [json.loads(l) for l in (tmpdir / 'reports.ndjson').readlines()]
+    assert len(lines) == 1001
+    assert lines[0] == {'level': 'notice', 'msg': 'Processed', 'data': 0}
+    notice = reporter.__json__()['notice'][0]
+    assert notice['total'] == 1000
+    assert notice['sample'] is True
+    assert len(notice['data']) == 10
+    assert '(sample of 10)' in str(reporter)
+
+
+def test_reporter_spills_merged_worker_reports(tmpdir):
+    path = str(tmpdir / 'reports.ndjson')
+    reporter = reporter_.Reporter(3, sample=5, spill=path)
+    worker = reporter_.Reporter(3, sample=None)
+    for i in range(20):
+        worker('Processed', i, reporter_.NOTICE)
+    reporter.merge(worker._reports)
+    reporter.merge(worker._reports)
+    assert reporter.totals == {'notice': {'Processed': 40}}
+    assert len(reporter._reports[3]['Processed']) == 5
+    reporter.close()
+    assert len((tmpdir / 'reports.ndjson').readlines()) == 40
+
+
+def create_municipality(insee):
+    factories.MunicipalityFactory(insee=insee)
+
+
+def test_process_chunk_isolates_failing_rows(reporter):
+    helpers.process_chunk(create_municipality, ['33001', '33001', '33002'])
+    assert models.Municipality.select().count() == 2
+    assert len(reporter._reports[1]['Database error']) == 1
+
+
+def test_batch_chunksize_can_be_set_from_config(config, reporter,
+                                                monkeypatch):
+    config.CHUNKSIZE = 5
+    sizes = []
+    monkeypatch.setattr(helpers, 'process_chunk',
+                        lambda func, chunk: sizes.append(len(chunk)))
+    batch(report_item, range(1, 12), chunksize=3, progress=False)
+    assert sorted(sizes) == [1, 5, 5]
+
+
+def test_compressed_files_are_detected_by_content(tmpdir):
+    path = tmpdir.join('data.csv')
+    path.write_binary(gzip.compress(b'insee;name\n33001;Abzac\n'))
+    reader = load_csv(str(path))
+    assert list(reader) == [{'insee': '33001', 'name': 'Abzac'}]
+    # Progress is computed on compressed bytes.
+    assert reader.done == reader.total == path.size()
+    path = tmpdir.join('data.json')
+    path.write_binary(bz2.compress(b'1\n2\n3\n'))
+    reader = LineReader(str(path), formatter=json.loads, start=2, rows=1)
+    assert list(reader) == [2, 3]
+    assert reader.offset == 6
+
+
+def test_byte_ranges_are_aligned_on_line_ends(tmpdir):
+    path = tmpdir.join('data.json')
+    path.write(''.join('{}\n'.format(i) for i in range(1, 12)))
+    ranges = list(byte_ranges(str(path), 5, json.loads))
+    assert [(r.start, r.end) for r in ranges] == [
+        (0, 6), (6, 12), (12, 18), (18, 24)]
+    assert [list(r) for r in ranges] == [
+        [1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11]]
@@ -1,5 +1,14 @@
-from ban.commands.init import process_row
-from ban.core import models
+import gzip
+import json
+from datetime import timezone
+
+import pytest
+
+from ban.commands import reporter as reporter_
+from ban.commands.init import (copy_file, init, parse_kind, process_row,
+                               row_insee)
+from ban.core import context, models
+from ban.core.encoder import dumps
 from ban.tests import factories
 
 
@@ -299,3 +308,254 @@ def test_import_group_from_bano_dgfip(session):
     assert group.name == 'Lotissement Bellevue'
     assert group.addressing == 'classical'
     assert group.version == 2
+
+
+def test_copy_engine_imports_all_kinds(session, tmpdir):
+    rows = [
+        {"type": "municipality", "source": "INSEE/COG (2015)",
+         "insee": "90008", "name": "Belfort"},
+        {"type": "postcode", "source": "La Poste (2015)",
+         "postcode": "90000", "name": "BELFORT",
+         "municipality:insee": "90008"},
+        {"type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+         "group": "way", "municipality:insee": "90008",
+         "group:fantoir": "900080203", "name": "GRANDE RUE F. MITTERRAND",
+         "attributes": {"somekey": "somevalue"}},
+        {"type": "housenumber", "source": "BAN (2016-06-05)",
+         "group:fantoir": "900080203", "numero": "1", "ordinal": "bis",
+         "postcode": "90000"},
+        {"type": "position", "kind": "entrance", "positionning": "gps",
+         "source": "BAN (2016-06-05)", "housenumber:cia": "90008_0203_1_BIS",
+         "geometry": {"type": "Point", "coordinates": [6.8630, 47.6389]}},
+    ]
+    path = tmpdir.join('init.json')
+    # Resources are created in dependency order, whatever the file order.
+    path.write('\n'.join(json.dumps(r) for r in reversed(rows)))
+    init(str(path), engine='copy')
+    municipality = models.Municipality.first()
+    assert municipality.insee == '90008'
+    assert municipality.attributes == {'source': 'INSEE/COG (2015)'}
+    postcode = models.PostCode.first()
+    assert postcode.municipality == municipality
+    group = models.Group.first()
+    assert group.municipality == municipality
+    assert group.attributes['somekey'] == 'somevalue'
+    housenumber = models.HouseNumber.first()
+    assert housenumber.parent == group
+    assert housenumber.postcode == postcode
+    assert housenumber.cia == '90008_0203_1_BIS'
+    position = models.Position.first()
+    assert position.housenumber == housenumber
+    assert position.positioning == models.Position.GPS
+    assert position.center.geojson['coordinates'] == (6.8630, 47.6389)
+    # First version has been created along with the resource.
+    version = housenumber.load_version(1)
+    assert version.data['cia'] == '90008_0203_1_BIS'
+    assert version.data['parent'] == group.id
+    assert version.load().number == '1'
+
+
+def test_copy_engine_stores_the_versions_the_orm_engine_would(session,
+                                                              tmpdir):
+    rows = [
+        {"type": "municipality", "source": "INSEE/COG (2015)",
+         "insee": "22059", "name": "Le Fœil"},
+        {"type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+         "group": "way", "municipality:insee": "22059",
+         "group:fantoir": "2205902030", "name": "Rue de l'Église"},
+        {"type": "housenumber", "source": "BAN (2016-06-05)",
+         "group:fantoir": "220590203", "numero": "1", "ordinal": "bis",
+         "ref:ign": ""},
+        {"type": "position", "kind": "entrance", "positionning": "gps",
+         "source": "BAN (2016-06-05)", "housenumber:cia": "22059_0203_1_BIS",
+         "geometry": {"type": "Point", "coordinates": [6.863, 47.6389]}},
+    ]
+    path = tmpdir.join('init.json')
+    path.write('\n'.join(json.dumps(r) for r in rows))
+    init(str(path), engine='copy')
+    # Coerced as by the model fields.
+    assert models.Group.first().fantoir == '220590203'
+    assert models.HouseNumber.first().ign is None
+    for model in (models.Municipality, models.Group, models.HouseNumber,
+                  models.Position):
+        instance = model.first()
+        # As stored at save time by the orm engine.
+        instance.created_at = instance.created_at.astimezone(timezone.utc)
+        instance.modified_at = instance.modified_at.astimezone(timezone.utc)
+        version = instance.load_version(1)
+        assert version.raw == dumps(instance.as_version, ensure_ascii=False)
+
+
+def test_copy_engine_rejects_models_it_can_not_validate(session, tmpdir,
+                                                        monkeypatch):
+    monkeypatch.setattr(models.Municipality, 'validate',
+                        classmethod(lambda cls, *args: None))
+    path = tmpdir.join('init.json')
+    path.write(json.dumps({"type": "municipality", "insee": "22059",
+                           "source": "INSEE/COG (2015)", "name": "Le Fœil"}))
+    with pytest.raises(ValueError):
+        copy_file(str(path))
+    assert not models.Municipality.select().count()
+
+
+def test_copy_engine_reports_unresolved_references(session, tmpdir,
+                                                   reporter):
+    rows = [
+        {"type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+         "group": "way", "municipality:insee": "90008",
+         "group:fantoir": "900080203", "name": "GRANDE RUE F. MITTERRAND"},
+        {"type": "position", "kind": "entrance", "source": "BAN",
+         "housenumber:cia": "90008_0203_1_BIS",
+         "geometry": {"type": "Point", "coordinates": [6.8630, 47.6389]}},
+    ]
+    path = tmpdir.join('init.json')
+    path.write('\n'.join(json.dumps(r) for r in rows))
+    copy_file(str(path))
+    assert not models.Group.select().count()
+    assert not models.Position.select().count()
+    assert len(reporter._reports[1]['Invalid group data']) == 1
+    assert len(reporter._reports[1]['Position housenumber does not exist']) == 1  # noqa
+
+
+def test_copy_engine_computes_cia_as_the_model_does(session, tmpdir):
+    # Merged municipality: the fantoir keeps the former insee.
+    municipality = factories.MunicipalityFactory(insee='90008')
+    group = factories.GroupFactory(municipality=municipality,
+                                   fantoir='900010203')
+    path = tmpdir.join('init.json')
+    path.write(json.dumps({"type": "housenumber", "source": "BAN",
+                           "group:fantoir": "900010203", "numero": "1",
+                           "ordinal": "bis"}))
+    copy_file(str(path))
+    housenumber = models.HouseNumber.first()
+    assert housenumber.parent == group
+    assert housenumber.cia == housenumber.compute_cia() == '90008_0203_1_BIS'
+    # Staging tables are dropped.
+    tables = models.HouseNumber._meta.database.get_tables()
+    assert not [t for t in tables if t.startswith('import_init')]
+
+
+def test_orm_engine_processes_kinds_in_dependency_order(staff, tmpdir):
+    rows = [
+        {"type": "position", "kind": "entrance", "positionning": "gps",
+         "source": "BAN (2016-06-05)", "housenumber:cia": "90008_0203_1_BIS",
+         "geometry": {"type": "Point", "coordinates": [6.8630, 47.6389]}},
+        {"type": "housenumber", "source": "BAN (2016-06-05)",
+         "group:fantoir": "900080203", "numero": "1", "ordinal": "bis"},
+        {"type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+         "group": "way", "municipality:insee": "90008",
+         "group:fantoir": "900080203", "name": "GRANDE RUE F. MITTERRAND"},
+        {"type": "municipality", "source": "INSEE/COG (2015)",
+         "insee": "90008", "name": "Belfort"},
+    ]
+    path = tmpdir.join('init.json')
+    path.write('\n'.join(json.dumps(r) for r in rows))
+    init(str(path))
+    assert models.Municipality.select().count() == 1
+    assert models.Group.select().count() == 1
+    assert models.HouseNumber.select().count() == 1
+    position = models.Position.first()
+    assert position.housenumber.cia == '90008_0203_1_BIS'
+
+
+def test_dry_run_resolves_resources_the_run_would_create(staff, tmpdir):
+    rows = [
+        {"type": "municipality", "source": "INSEE/COG (2015)",
+         "insee": "90008", "name": "Belfort"},
+        {"type": "postcode", "source": "La Poste (2015)",
+         "postcode": "90000", "name": "BELFORT",
+         "municipality:insee": "90008"},
+        {"type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+         "group": "way", "municipality:insee": "90008",
+         "group:fantoir": "900080203", "name": "GRANDE RUE F. MITTERRAND"},
+        {"type": "housenumber", "source": "BAN (2016-06-05)",
+         "group:fantoir": "900080203", "numero": "1", "ordinal": "bis",
+         "postcode": "90000"},
+        {"type": "position", "kind": "entrance", "positionning": "gps",
+         "source": "BAN (2016-06-05)", "housenumber:cia": "90008_0203_1_BIS",
+         "geometry": {"type": "Point", "coordinates": [6.8630, 47.6389]}},
+    ]
+    path = tmpdir.join('init.json')
+    path.write('\n'.join(json.dumps(r) for r in rows))
+    init(str(path), dry_run=True)
+    for model in [models.Municipality, models.PostCode, models.Group,
+                  models.HouseNumber, models.Position]:
+        assert not model.select().count()
+    reports = context.get('reporter')._reports
+    assert not reports[reporter_.ERROR]
+    assert 'Position created' in reports[reporter_.NOTICE]
+
+
+def test_init_resume_skips_what_checkpoint_says_is_done(staff, tmpdir):
+    rows = [
+        {"type": "municipality", "source": "INSEE/COG (2015)",
+         "insee": "90008", "name": "Belfort"},
+        {"type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+         "group": "way", "municipality:insee": "90008",
+         "group:fantoir": "900080203", "name": "GRANDE RUE F. MITTERRAND"},
+        {"type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+         "group": "way", "municipality:insee": "90008",
+         "group:fantoir": "900080204", "name": "PETITE RUE"},
+    ]
+    path = tmpdir.join('init.json')
+    path.write('\n'.join(json.dumps(r) for r in rows))
+    models.Municipality.create(insee='90008', name='Belfort')
+    # First group line has been processed, the second one has not.
+    offset = sum(len(json.dumps(row)) + 1 for row in rows[:2])
+    checkpoint = tmpdir.join('init.json.checkpoint')
+    checkpoint.write(json.dumps({'kind': 'group', 'offset': offset,
+                                 'rows': 2, 'reports': {}}))
+    init(str(path), resume=True)
+    assert models.Municipality.select().count() == 1
+    group = models.Group.get()
+    assert group.fantoir == '900080204'
+    # Checkpoints are removed once all paths are imported.
+    assert not checkpoint.exists()
+
+
+def test_init_reads_compressed_files_up_to_limit(staff, tmpdir):
+    rows = [
+        {"type": "municipality", "source": "INSEE/COG (2015)",
+         "insee": "90008", "name": "Belfort"},
+        {"type": "municipality", "source": "INSEE/COG (2015)",
+         "insee": "33001", "name": "Abzac"},
+    ]
+    path = tmpdir.join('init.json.gz')
+    path.write_binary(gzip.compress(
+        '\n'.join(json.dumps(r) for r in rows).encode()))
+    init(str(path), limit=1)
+    assert [m.insee for m in models.Municipality.select()] == ['90008']
+    # No temporary copy of the file is left behind.
+    assert tmpdir.listdir() == [path]
+
+
+def test_parallel_init_rejects_what_it_does_not_support(staff, tmpdir):
+    path = tmpdir.join('init.json')
+    path.write(json.dumps({"type": "municipality", "insee": "90008",
+                           "source": "INSEE/COG (2015)", "name": "Belfort"}))
+    compressed = tmpdir.join('init.json.gz')
+    compressed.write_binary(gzip.compress(path.read_binary()))
+    for args, kwargs in [((str(compressed), ), {}),
+                         ((str(path), ), {'resume': True}),
+                         ((str(path), ), {'limit': 1})]:
+        with pytest.raises(SystemExit):
+            init(*args, parallel=True, **kwargs)
+    assert not models.Municipality.select().count()
+
+
+def test_parse_kind_only_parses_rows_of_kind():
+    line = json.dumps({'type': 'position', 'geometry': {'type': 'Point'}})
+    assert parse_kind('position', line) == json.loads(line)
+    assert parse_kind('group', line) is None
+    assert parse_kind(None, line) is None
+    assert parse_kind(None, '{"name": "foo"}') == {'name': 'foo'}
+    assert parse_kind(None, ' \n') is None
+
+
+def test_row_insee():
+    assert row_insee({'type': 'municipality', 'insee': '90008'}) == '90008'
+    assert row_insee({'type': 'group', 'municipality:insee': '90008',
+                      'group:fantoir': '900080203'}) == '90008'
+    assert row_insee({'type': 'housenumber', 'cia': '90008_0203_1_'}) == '90008'  # noqa
+    assert row_insee({'type': 'position',
+                      'housenumber:cia': '90008_0203_1_'}) == '90008'
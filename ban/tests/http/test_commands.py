@@ -1,27 +1,86 @@
 import falcon
 
 from ban.core import models
+from ban.core.jobs import Job
+from ban.http import commands
 from ban.tests import factories
+from ban.utils import utcnow
 
 from .utils import authorize
 
 
 @authorize
-def test_bal_import_from_data_file(staff, client):
+def test_bal_import_from_data_file(staff, client, monkeypatch):
+    futures = []
+    enqueue = commands.enqueue
+    monkeypatch.setattr(commands, 'enqueue',
+                        lambda job: futures.append(enqueue(job)))
     factories.MunicipalityFactory(name="Acigné", insee="35001")
     content = """cle_interop,uid_adresse,voie_nom,numero,suffixe,commune_nom,position,x,y,long,lat,source,date_der_maj\n
 35001_0005_99999,,Mail Anita Conti,99999,,Acigné,,,,,,Rennes Métropole,2016-02-22
 """
     resp = client.post('/import/bal', files={'data': (content, 'test.csv')})
-    assert resp.status == falcon.HTTP_OK
+    assert resp.status == falcon.HTTP_ACCEPTED
+    assert resp.json['status'] == Job.PENDING
+    assert resp.json['progress'] == {'done': 0, 'total': 1}
+    # Wait for the background worker.
+    futures[0].result()
     assert models.Group.select().count() == 1
     group = models.Group.select().first()
     assert group.name == "Mail Anita Conti"
     assert group.fantoir == "350010005"
-    assert 'report' in resp.json
+    resp = client.get('/job/{}'.format(resp.json['id']))
+    assert resp.status == falcon.HTTP_OK
+    assert resp.json['status'] == Job.DONE
+    assert resp.json['progress'] == {'done': 1, 'total': 1}
     assert 'notice' in resp.json['report']
 
 
+@authorize
+def test_job_reports_failure(staff, client, session, monkeypatch):
+    monkeypatch.setitem(commands.COMMANDS, 'fail', lambda f: 1 / 0)
+    job = Job.create(command='fail', payload='', session=session)
+    commands.enqueue(job).result()
+    resp = client.get('/job/{}'.format(job.id))
+    assert resp.json['status'] == Job.FAILED
+    assert 'ZeroDivisionError' in resp.json['error']
+
+
+def test_pending_jobs_are_claimed_from_the_table(session, monkeypatch):
+    calls = []
+    monkeypatch.setitem(commands.COMMANDS, 'ok',
+                        lambda f: calls.append(f.read()))
+    first = Job.create(command='ok', payload='first', session=session)
+    second = Job.create(command='ok', payload='second', session=session)
+    for future in commands.run_pending():
+        future.result()
+    assert sorted(calls) == ['first', 'second']
+    for job in (first, second):
+        assert Job.get(Job.pk == job.pk).status == Job.DONE
+    # Already claimed, so not run again.
+    commands.enqueue(first).result()
+    assert len(calls) == 2
+
+
+def test_stale_running_jobs_are_requeued(session):
+    stale = Job.create(command='ok', payload='', session=session,
+                       status=Job.RUNNING,
+                       modified_at=utcnow() - Job.STALE_DELAY * 2)
+    running = Job.create(command='ok', payload='', session=session,
+                         status=Job.RUNNING)
+    assert Job.requeue_stale() == 1
+    assert Job.get(Job.pk == stale.pk).status == Job.PENDING
+    assert Job.get(Job.pk == running.pk).status == Job.RUNNING
+
+
+@authorize
+def test_unknown_job_is_404(client):
+    resp = client.get('/job/{}'.format('not-a-uuid'))
+    assert resp.status == falcon.HTTP_404
+    resp = client.get('/job/{}'.format('8d5c3b04-0e8b-4b5e-a1c2-1d4b6f1a3f00'))
+    assert resp.status == falcon.HTTP_404
+
+
 def test_cannot_use_bal_import_without_auth(staff, client):
     factories.MunicipalityFactory(name="Acigné", insee="35001")
     content = """cle_interop,uid_adresse,voie_nom,numero,suffixe,commune_nom,position,x,y,long,lat,source,date_der_maj\n
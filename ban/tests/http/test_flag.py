@@ -58,3 +58,17 @@ def test_cannot_flag_without_token(client, url):
     uri = url('group-flag-version', identifier=group.id, ref=1)
     resp = client.post(uri)
     assert resp.status == falcon.HTTP_401
+
+
+@authorize
+def test_get_versions_contain_flags(client, url, session):
+    group = GroupFactory()
+    group.name = 'Another name'
+    group.increment_version()
+    group.save()
+    group.load_version(1).flag()
+    uri = url('group-versions', identifier=group.id)
+    resp = client.get(uri)
+    assert resp.status == falcon.HTTP_200
+    assert resp.json['collection'][0]['flags'][0]['by'] == 'laposte'
+    assert resp.json['collection'][1]['flags'] == []
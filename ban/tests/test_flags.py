@@ -1,6 +1,8 @@
 import pytest
 
+from ban.commands.bench import QueryCounter
 from ban.core import context
+from ban.core.versioning import Version
 
 from .factories import GroupFactory, SessionFactory
 
@@ -80,3 +82,31 @@ def test_version_flags_attribute_returns_flags(session):
     assert version.flags.count()
     flag = version.flags[0]
     assert flag.created_at
+
+
+def test_prefetch_flags_attaches_flags_to_versions(session):
+    group = GroupFactory()
+    group.name = 'Another name'
+    group.increment_version()
+    group.save()
+    group.load_version(1).flag()
+    versions = Version.prefetch_flags(group.versions)
+    assert len(versions[0]._prefetched_flags) == 1
+    assert versions[1]._prefetched_flags == []
+    assert versions[0].as_resource['flags'][0]['by'] == 'laposte'
+    assert versions[1].as_resource['flags'] == []
+
+
+def test_prefetch_flags_runs_a_single_query(session):
+    group = GroupFactory()
+    group.name = 'Another name'
+    group.increment_version()
+    group.save()
+    group.load_version(1).flag()
+    group.load_version(2).flag()
+    versions = list(group.versions)
+    with QueryCounter(Version._meta.database) as counter:
+        versions = Version.prefetch_flags(versions)
+        resources = [version.as_resource for version in versions]
+    assert counter.count == 1
+    assert [len(r['flags']) for r in resources] == [1, 1]
@@ -1,5 +1,6 @@
 from ban.core import models
-from ban.core.versioning import IdentifierRedirect
+from ban.core.versioning import Diff, IdentifierRedirect
+from ban.utils import make_diff
 
 from . import factories
 
@@ -51,3 +52,65 @@ def test_resource_update_should_refresh_if_target_is_becomming_source():
     assert IdentifierRedirect.select().count() == 2
     assert IdentifierRedirect.follow(models.Municipality, 'insee', '54321') == '12321'  # noqa
     assert IdentifierRedirect.follow(models.Municipality, 'insee', '12345') == '12321'  # noqa
+
+
+def test_follow_is_cached(monkeypatch):
+    municipality = factories.MunicipalityFactory(insee="12345")
+    municipality.insee = '54321'
+    municipality.increment_version()
+    municipality.save()
+    assert IdentifierRedirect.follow(models.Municipality, 'insee', '12345') == '54321'  # noqa
+
+    def select(*args, **kwargs):
+        assert False, 'Should not hit the db'
+
+    monkeypatch.setattr(IdentifierRedirect, 'select', select)
+    assert IdentifierRedirect.follow(models.Municipality, 'insee', '12345') == '54321'  # noqa
+
+
+def test_cache_is_invalidated_on_identifier_change():
+    municipality = factories.MunicipalityFactory(insee="12345")
+    # Cache the miss.
+    assert not IdentifierRedirect.follow(models.Municipality, 'insee', '12345')  # noqa
+    municipality.insee = '54321'
+    municipality.increment_version()
+    municipality.save()
+    assert IdentifierRedirect.follow(models.Municipality, 'insee', '12345') == '54321'  # noqa
+    municipality.insee = '12321'
+    municipality.increment_version()
+    municipality.save()
+    assert IdentifierRedirect.follow(models.Municipality, 'insee', '12345') == '12321'  # noqa
+
+
+def test_coerce_follows_redirect():
+    municipality = factories.MunicipalityFactory(insee="12345")
+    municipality.insee = '54321'
+    municipality.increment_version()
+    municipality.save()
+    assert models.Municipality.coerce('insee:12345') == municipality
+
+
+def test_resolve_chains():
+    pairs = [('A', 'B'), ('B', 'C'), ('X', 'Y'), ('C', 'D')]
+    assert IdentifierRedirect.resolve_chains(pairs) == {
+        'A': 'D', 'B': 'D', 'C': 'D', 'X': 'Y'}
+
+
+def test_from_diffs_refresh_chains_in_bulk():
+    municipality = factories.MunicipalityFactory(insee="12345")
+    Diff.ACTIVE = False
+    try:
+        for insee in ['54321', '12321']:
+            municipality.insee = insee
+            municipality.increment_version()
+            municipality.save()
+    finally:
+        Diff.ACTIVE = True
+    assert not IdentifierRedirect.select().count()
+    versions = list(municipality.versions)
+    diffs = [Diff(old=old, new=new, diff=make_diff(old.data, new.data))
+             for old, new in zip(versions, versions[1:])]
+    IdentifierRedirect.from_diffs(diffs)
+    assert IdentifierRedirect.select().count() == 2
+    assert IdentifierRedirect.follow(models.Municipality, 'insee', '12345') == '12321'  # noqa
+    assert IdentifierRedirect.follow(models.Municipality, 'insee', '54321') == '12321'  # noqa
@@ -0,0 +1,143 @@
+import pytest
+
+from ban.core import lookups, models
+
+from .factories import GroupFactory, MunicipalityFactory
+
+
+def test_lookup_cache_only_calls_loader_once():
+    cache = lookups.LookupCache()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return 12
+
+    assert cache.get('Group.fantoir', '900080203', loader) == 12
+    assert cache.get('Group.fantoir', '900080203', loader) == 12
+    assert len(calls) == 1
+    assert cache.stats == {'Group.fantoir': [1, 1]}
+
+
+def test_lookup_cache_does_not_cache_misses():
+    cache = lookups.LookupCache()
+    assert cache.get('Group.fantoir', '900080203', lambda: None) is None
+    assert cache.get('Group.fantoir', '900080203', lambda: 12) == 12
+
+
+def test_preloaded_lookup_cache_is_authoritative():
+    cache = lookups.LookupCache()
+    cache.preload('Municipality.insee', [('90008', 1)])
+
+    def loader():
+        assert False, 'Should not be called'
+
+    assert cache.get('Municipality.insee', '90008', loader) == 1
+    assert cache.get('Municipality.insee', '33001', loader) is None
+    assert cache.stats == {'Municipality.insee': [2, 0]}
+
+
+def test_lookup_without_active_cache_calls_loader():
+    assert lookups.lookup('Group.fantoir', '900080203', lambda: 12) == 12
+
+
+def test_coerce_pk_uses_active_cache(monkeypatch):
+    municipality = MunicipalityFactory(insee='90008')
+    with lookups.activate() as cache:
+        assert models.Municipality.coerce_pk('insee:90008') == municipality.pk
+
+        def coerce(*args, **kwargs):
+            assert False, 'Should not hit the db'
+
+        monkeypatch.setattr(models.Municipality, 'coerce', coerce)
+        assert models.Municipality.coerce_pk('insee:90008') == municipality.pk
+    assert cache.stats == {'Municipality.insee': [1, 1]}
+    assert not lookups.active()
+
+
+def test_foreign_key_coercion_uses_active_cache(session):
+    group = GroupFactory(fantoir='900080203')
+    with lookups.activate() as cache:
+        for number in ['1', '2']:
+            validator = models.HouseNumber.validator(
+                number=number, parent='fantoir:900080203')
+            assert not validator.errors
+            assert validator.document['parent'] == group.pk
+    assert cache.stats['Group.fantoir'][0] >= 1
+
+
+def test_coerce_pk_falls_back_on_preloaded_miss():
+    cache = lookups.LookupCache()
+    cache.preload('Municipality.insee', [])
+    with lookups.activate(cache):
+        with pytest.raises(models.Municipality.DoesNotExist):
+            models.Municipality.coerce_pk('insee:90008')
+
+
+def test_stored_lookups_are_dropped_when_rolled_back():
+    database = models.Municipality._meta.database
+    with lookups.activate() as cache:
+        with database.atomic():
+            lookups.store('Municipality.insee', '90008', 1, database)
+            try:
+                with database.atomic():
+                    lookups.store('Municipality.insee', '33001', 2, database)
+                    raise ValueError
+            except ValueError:
+                pass
+        assert cache.get('Municipality.insee', '90008') == 1
+        assert cache.get('Municipality.insee', '33001') is None
+        try:
+            with database.atomic():
+                lookups.store('Municipality.insee', '33001', 2, database)
+                raise ValueError
+        except ValueError:
+            pass
+        assert cache.get('Municipality.insee', '33001') is None
+
+
+def test_reserved_placeholders_resolve_until_sent_to_main_process():
+    with lookups.activate():
+        # What a forked worker gets.
+        cache = lookups.LookupCache()
+        lookups.share(cache, forked=True)
+        try:
+            pk = lookups.reserve([('Group.fantoir', '900080203')])
+            assert lookups.is_placeholder(pk)
+            assert cache.get('Group.fantoir', '900080203') == pk
+            stored, stats = lookups.flush()
+            assert stored == [('Group.fantoir', '900080203', pk)]
+            assert not lookups.flush()[0]
+        finally:
+            lookups.share(None)
+
+
+def test_forked_worker_stores_and_stats_are_merged_in_main_cache():
+    main = lookups.LookupCache()
+    main.preload('Municipality.insee', [('90008', 1)])
+    with lookups.activate(main):
+        cache = lookups.LookupCache()
+        cache.preload('Municipality.insee', [('90008', 1)])
+        lookups.share(cache, forked=True)
+        try:
+            assert lookups.lookup('Municipality.insee', '90008', None) == 1
+            assert lookups.lookup('Municipality.insee', '33001', None) is None
+            lookups.store('Municipality.insee', '33001', 2)
+            lookups.store('Municipality.insee', '33002', 3)
+            # Rolled back.
+            cache.discard('Municipality.insee', '33002')
+            collected = lookups.flush()
+        finally:
+            lookups.share(None)
+        assert collected == ([('Municipality.insee', '33001', 2)],
+                             {'Municipality.insee': [2, 0]})
+        main.merge(*collected)
+        assert main.get('Municipality.insee', '33001') == 2
+        assert main.get('Municipality.insee', '33002') is None
+        assert main.stats == {'Municipality.insee': [4, 0]}
+
+
+def test_non_forked_workers_have_nothing_to_send():
+    with lookups.activate():
+        lookups.store('Municipality.insee', '33001', 2)
+        assert lookups.flush() == ([], {})
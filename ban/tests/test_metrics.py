@@ -0,0 +1,77 @@
+import json
+
+from ban.core import context, metrics, models
+
+from .factories import MunicipalityFactory
+
+
+def test_stage_is_only_timed_when_metrics_are_collected():
+    context.set('metrics', None)
+    with metrics.stage('parse'):
+        pass
+    collected = metrics.Metrics()
+    context.set('metrics', collected)
+    try:
+        with metrics.stage('parse'):
+            pass
+        with metrics.stage('parse'):
+            pass
+    finally:
+        context.set('metrics', None)
+    assert collected.data['stages']['parse']['count'] == 2
+
+
+def test_metrics_merge_adds_histograms_and_workers():
+    main = metrics.Metrics()
+    main.time('validate', 0.001)
+    main.rows(10, 0.5, worker='1/a')
+    other = metrics.Metrics()
+    other.time('validate', 0.003)
+    other.time('validate', 0.0000005)
+    other.rows(30, 0.5, worker='1/a')
+    other.rows(5, 1, worker='2/b')
+    main.merge(other.data)
+    summary = main.__json__()
+    validate = summary['stages']['validate']
+    assert validate['count'] == 3
+    assert validate['max'] == 0.003
+    assert sum(count for bound, count in validate['histogram']) == 3
+    # 0.5µs, 1ms, 3ms.
+    assert validate['p50'] == 1024 / 1e6
+    assert validate['p99'] == 4096 / 1e6
+    assert summary['rows'] == 45
+    assert summary['workers']['1/a'] == {'rows': 40, 'chunks': 2, 'time': 1,
+                                         'rows_per_second': 40}
+    assert summary['workers']['2/b']['chunks'] == 1
+    assert 'validate: 3 calls in' in str(main)
+
+
+def test_metrics_tick_writes_json_lines(config, capsys):
+    collected = metrics.Metrics()
+    collected.rows(10, 1, worker='1/a')
+    collected.tick()
+    assert capsys.readouterr()[1] == ''
+    config.METRICS_EVERY = 1
+    collected.last -= 1
+    collected.tick()
+    # Not again before METRICS_EVERY seconds.
+    collected.tick()
+    lines = capsys.readouterr()[1].splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])['rows'] == 10
+
+
+def test_validation_and_versions_are_timed(session):
+    collected = metrics.Metrics()
+    context.set('metrics', collected)
+    try:
+        municipality = MunicipalityFactory()
+        validator = models.Municipality.validator(
+            instance=municipality, update=True, name='Other name', version=2)
+        validator.save()
+    finally:
+        context.set('metrics', None)
+    stages = collected.data['stages']
+    assert stages['validate']['count'] == 1
+    assert stages['save']['count'] == 2
+    assert stages['version']['count'] == 2
@@ -1,6 +1,8 @@
 import pytest
+from cerberus import Validator
 
 from ban.core import models
+from ban.core.validators import VersionedResourceValidator
 
 from .factories import (GroupFactory, HouseNumberFactory, MunicipalityFactory,
                         PositionFactory)
@@ -381,3 +383,48 @@ def test_giving_wrong_version_should_patch_if_possible_with_update(session):
     housenumber = validator.save()
     assert housenumber.number == "19"
     assert housenumber.ordinal == "bis"
+
+
+class CerberusValidator(VersionedResourceValidator):
+    """Resolve the schema rules through Cerberus for each document."""
+
+    def _validate_definition(self, definition, field, value):
+        return Validator._validate_definition(self, definition, field, value)
+
+    def _validate_required_fields(self, document):
+        return Validator._validate_required_fields(self, document)
+
+
+@pytest.mark.parametrize('data', [
+    {},
+    {'name': 'Rue des Girafes', 'kind': models.Group.WAY,
+     'municipality': 'insee:12345', 'fantoir': '123456789', 'laposte': ''},
+    {'name': '', 'kind': 'invalid', 'municipality': 'insee:54321',
+     'fantoir': '1234', 'version': 'x', 'unknown': 'value'},
+    {'name': None, 'kind': None, 'municipality': None, 'laposte': None,
+     'alias': 'Rue des Zèbres', 'version': 2},
+    {'name': 'x' * 201, 'kind': models.Group.AREA, 'fantoir': 1234567890,
+     'ign': 12},
+])
+def test_compiled_validator_matches_cerberus(session, data):
+    MunicipalityFactory(insee="12345")
+    for update in (False, True):
+        compiled = models.Group._meta.validator(models.Group)
+        compiled(dict(data), update=update)
+        expected = CerberusValidator(models.Group)
+        expected(dict(data), update=update)
+        assert compiled.errors == expected.errors
+        assert compiled.document == expected.document
+
+
+def test_schema_is_compiled_once_per_model(session, monkeypatch):
+    first = models.Group.validator(name='Rue des Girafes')
+    assert 'kind' in first.errors
+
+    def validate_schema(self, schema):
+        raise AssertionError('Schema should not be checked again')
+
+    monkeypatch.setattr(Validator, 'validate_schema', validate_schema)
+    second = models.Group.validator(name='Rue des Girafes')
+    assert second.compiled is first.compiled
+    assert second.errors == first.errors
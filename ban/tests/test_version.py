@@ -1,8 +1,11 @@
+import json
+
 import peewee
 import pytest
 
 from ban.core import models
-from ban.core.versioning import Version
+from ban.core.encoder import dumps
+from ban.core.versioning import Version, VersionCache
 
 from .factories import (GroupFactory, HouseNumberFactory, MunicipalityFactory,
                         PositionFactory, PostCodeFactory)
@@ -188,3 +191,82 @@ def test_position_as_version():
         'center': {'coordinates': (-1.1111, 48.8888), 'type': 'Point'},
         'comment': None,
         'id': position.id}
+
+
+def test_store_version_fills_version_cache():
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    data = Version.cache.get('Municipality', municipality.pk, 1)
+    assert data == municipality.load_version(1).data
+
+
+def test_load_version_data_does_not_query_when_cached(monkeypatch):
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    municipality.name = 'Orvanne'
+    municipality.increment_version()
+    municipality.save()
+
+    def load_version(*args, **kwargs):
+        assert False, 'Should not hit the db'
+
+    monkeypatch.setattr(municipality, 'load_version', load_version)
+    assert municipality.load_version_data(1)['name'] == 'Moret-sur-Loing'
+    assert municipality.load_version_data(2)['name'] == 'Orvanne'
+
+
+def test_load_version_data_fallbacks_to_db():
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    Version.cache.clear()
+    assert municipality.load_version_data(1)['name'] == 'Moret-sur-Loing'
+    assert len(Version.cache) == 1
+
+
+def test_version_cache_is_only_filled_on_commit():
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    database = municipality._meta.database
+    with database.atomic():
+        municipality.name = 'Orvanne'
+        municipality.increment_version()
+        municipality.save()
+        assert Version.cache.get('Municipality', municipality.pk, 2) is None
+    assert Version.cache.get('Municipality', municipality.pk, 2)
+
+
+def test_rolled_back_versions_are_not_cached():
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    database = municipality._meta.database
+    with database.atomic():
+        try:
+            # A savepoint, as for each row of a batch chunk.
+            with database.atomic():
+                municipality.name = 'Orvanne'
+                municipality.increment_version()
+                municipality.save()
+                raise peewee.DatabaseError
+        except peewee.DatabaseError:
+            pass
+    assert Version.cache.get('Municipality', municipality.pk, 2) is None
+    assert Version.cache.get('Municipality', municipality.pk, 1)
+
+
+def test_version_cache_is_bounded():
+    cache = VersionCache(size=2)
+    cache.set('Group', 1, 1, '{"name": "a"}')
+    cache.set('Group', 1, 2, '{"name": "b"}')
+    cache.set('Group', 1, 3, '{"name": "c"}')
+    assert len(cache) == 2
+    assert cache.get('Group', 1, 1) is None
+    assert cache.get('Group', 1, 3) == {'name': 'c'}
+
+
+def test_bulk_create_stores_first_versions(session):
+    group = GroupFactory()
+    housenumbers = models.HouseNumber.bulk_create([
+        models.HouseNumber(number=str(i), parent=group) for i in range(3)])
+    assert models.HouseNumber.select().count() == 3
+    for housenumber in housenumbers:
+        housenumber = models.HouseNumber.get(pk=housenumber.pk)
+        assert housenumber.version == 1
+        assert housenumber.cia
+        version = housenumber.load_version()
+        assert version.data == json.loads(dumps(housenumber.as_version))
+        assert version.diff.old is None
@@ -7,6 +7,7 @@ from ban import db
 from ban.commands.reporter import Reporter
 from ban.commands.db import models, create as createdb, truncate as truncatedb
 from ban.core import context
+from ban.core.versioning import IdentifierRedirect, Version
 from ban.http import application, reverse
 
 
@@ -29,6 +30,8 @@ def pytest_unconfigure(config):
 
 def pytest_runtest_setup(item):
     truncatedb(force=True)
+    Version.cache.clear()
+    IdentifierRedirect.cache.clear()
     context.set('session', None)
 
 